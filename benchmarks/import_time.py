@@ -0,0 +1,133 @@
+"""Startup (import) time of every plotting/pipeline entry point.
+
+Each script's top-level imports (including its ``sys.path`` bootstrap) are
+replayed in a fresh interpreter under ``python -X importtime``, without
+running the script body, so the numbers are the fixed cost a scheduler pays
+per launch. Reports the total import time, the heaviest top-level imports
+and whether pyplot/seaborn/scipy were loaded eagerly.
+
+    python benchmarks/import_time.py                       # all scripts
+    python benchmarks/import_time.py scripts/locus/top10dm-plots.py --repeat 5
+    python benchmarks/import_time.py --json before.json
+    python benchmarks/import_time.py --baseline before.json
+"""
+import argparse
+import ast
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+HEAVY_MODULES = ("matplotlib.pyplot", "seaborn", "scipy")
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def entry_points():
+    """All ``.py`` scripts under ``scripts/`` (relative to the repo root)."""
+    pattern = os.path.join(REPO_ROOT, "scripts", "**", "*.py")
+    return sorted(os.path.relpath(p, REPO_ROOT) for p in glob.glob(pattern, recursive=True))
+
+
+def import_prelude(path):
+    """Source of the top-level imports and ``sys.path`` edits of ``path``."""
+    with open(path, encoding="utf-8") as fh:
+        tree = ast.parse(fh.read(), filename=path)
+    keep = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            keep.append(node)
+        elif (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+              and ast.unparse(node.value.func).startswith("sys.path.")):
+            keep.append(node)
+    return ast.unparse(ast.Module(body=keep, type_ignores=[]))
+
+
+def measure(path, python=sys.executable):
+    """One ``-X importtime`` run of ``path``'s imports.
+
+    Returns ``{"total_us", "modules", "top_level", "heavy"}`` where
+    ``top_level`` maps each directly imported package to its cumulative
+    time and ``heavy`` lists the ``HEAVY_MODULES`` that were loaded.
+    """
+    code = f"__file__ = {path!r}\nexec(compile({import_prelude(path)!r}, __file__, 'exec'))"
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run([python, "-X", "importtime", "-c", code], cwd=REPO_ROOT, env=env,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {path} failed:\n{proc.stderr.strip().splitlines()[-1]}")
+
+    total = 0
+    modules = set()
+    top_level = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), match[3], match[4]
+        total += self_us
+        modules.add(name)
+        if len(indent) == 1:
+            top_level[name] = top_level.get(name, 0) + cumulative_us
+    heavy = [m for m in HEAVY_MODULES if m in modules]
+    return {"total_us": total, "modules": len(modules), "top_level": top_level, "heavy": heavy}
+
+
+def benchmark(scripts, repeat=3, python=sys.executable):
+    """Best-of-``repeat`` ``measure`` result per script."""
+    results = {}
+    for script in scripts:
+        runs = [measure(os.path.join(REPO_ROOT, script), python) for _ in range(repeat)]
+        results[script] = min(runs, key=lambda r: r["total_us"])
+    return results
+
+
+def print_report(results, baseline=None, top=3):
+    width = max(len(s) for s in results)
+    header = f"{'entry point':<{width}}  {'import ms':>9}"
+    if baseline:
+        header += f"  {'baseline':>9}  {'change':>7}"
+    print(header + "  eager heavy imports / slowest top-level imports")
+    for script, result in results.items():
+        row = f"{script:<{width}}  {result['total_us'] / 1000:>9.1f}"
+        if baseline:
+            before = baseline.get(script)
+            if before:
+                change = result["total_us"] / before["total_us"] - 1
+                row += f"  {before['total_us'] / 1000:>9.1f}  {change:>+7.0%}"
+            else:
+                row += f"  {'-':>9}  {'-':>7}"
+        slowest = sorted(result["top_level"].items(), key=lambda kv: -kv[1])[:top]
+        row += "  " + (",".join(result["heavy"]) or "-") + " / " + ", ".join(f"{n} {us / 1000:.0f}ms" for n, us in slowest)
+        print(row)
+    total = sum(r["total_us"] for r in results.values())
+    print(f"{'total':<{width}}  {total / 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup import time of each entry point with python -X importtime.")
+    parser.add_argument("scripts", nargs="*", help="Scripts to measure, relative to the repo root (default: every script under scripts/)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per script; the fastest is reported (default: 3)")
+    parser.add_argument("--top", type=int, default=3, help="Slowest top-level imports to list per script (default: 3)")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter to measure (default: the current one)")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier --json run to compare against")
+    args = parser.parse_args()
+
+    scripts = args.scripts or entry_points()
+    results = benchmark(scripts, max(args.repeat, 1), args.python)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)["scripts"]
+    print_report(results, baseline, args.top)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"python": sys.version.split()[0], "scripts": results}, fh, indent=1)
+        print(f"Saved results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
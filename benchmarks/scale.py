@@ -0,0 +1,183 @@
+"""Run time and peak memory of every pipeline task at growing cohort sizes.
+
+For each scale factor a synthetic cohort (``synthetic_cohort.py``) is
+written to its own workspace and the scheduler's task graph (steps 1-6
+and the plotting scripts of ``python -m methpipe schedule``) is run there
+one task at a time, so the measurements do not compete for the CPU. Each
+task's wall time and peak RSS are reported per scale together with the
+growth exponent between the smallest and largest scale (1.0 = linear,
+2.0 = quadratic in the scaled dimension).
+
+By default the number of patients grows (a bigger cohort); ``--grow cgis``
+grows the number of CpG island rows instead and ``--grow both`` grows both.
+The per-patient plot scripts render dozens of figures per patient and
+dominate from 10x on; ``--tasks`` restricts a run to the tasks of interest.
+
+    python benchmarks/scale.py                                # 1x, 10x, 100x
+    python benchmarks/scale.py --scales 1,10 --tasks filter,merge,ratio,gene-matrix
+    python benchmarks/scale.py --grow cgis --json after.json --baseline before.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from methpipe import scheduler
+
+import synthetic_cohort
+
+
+def cohort_size(scale, grow, patients, healthy, cgis):
+    """``(patients, healthy, cgis)`` of the cohort at ``scale``."""
+    if grow in ("patients", "both"):
+        patients, healthy = patients * scale, healthy * scale
+    if grow in ("cgis", "both"):
+        cgis = cgis * scale
+    return patients, healthy, cgis
+
+
+def run_scale(scale, workdir, args):
+    """Generate the cohort for ``scale`` in ``workdir`` and run the tasks there one by one."""
+    patients, healthy, cgis = cohort_size(scale, args.grow, args.patients, args.healthy, args.cgis)
+    workspace = os.path.join(workdir, f"scale-{scale}x")
+    shutil.rmtree(workspace, ignore_errors=True)
+
+    print(f"=== {scale}x: {patients} patients, {healthy} healthy, {cgis} CGIs ===")
+    started = time.perf_counter()
+    cohort = synthetic_cohort.generate_cohort(os.path.join(workspace, "data"), patients, healthy, cgis,
+                                              args.runs, seed=args.seed)
+    cohort["generate_seconds"] = round(time.perf_counter() - started, 2)
+
+    graph = scheduler.TaskGraph(scheduler.pipeline_tasks(workers=args.workers))
+    if args.tasks:
+        graph = graph.subgraph(args.tasks)
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        results = scheduler.run_graph(graph, cpus=1, echo=lambda line: print("  " + line))
+    finally:
+        os.chdir(cwd)
+    tasks = {name: {"status": r["status"], "seconds": round(r["seconds"], 3), "memory_mb": round(r["memory_mb"], 1)}
+             for name, r in ((name, results[name]) for name in graph.order)}
+    return {"scale": scale, "cohort": cohort, "tasks": tasks, "workspace": workspace}
+
+
+def growth_exponent(small, large):
+    """Slope of log(value) against log(scale) between two ``(scale, value)`` points."""
+    (s0, v0), (s1, v1) = small, large
+    if s1 == s0 or v0 <= 0 or v1 <= 0:
+        return None
+    return math.log(v1 / v0) / math.log(s1 / s0)
+
+
+def print_report(report, baseline=None):
+    runs = report["runs"]
+    names = list(dict.fromkeys(name for run in runs for name in run["tasks"]))
+    width = max([len(n) for n in names] + [5])
+    header = f"{'task':<{width}}" + "".join(f"  {str(r['scale']) + 'x s':>9}  {'MB':>6}" for r in runs) + "  growth"
+    if baseline:
+        header += "  vs baseline"
+    print(header)
+    for name in names + ["total"]:
+        row = f"{name:<{width}}"
+        points = []
+        for run in runs:
+            if name == "total":
+                ok = [t for t in run["tasks"].values() if t["status"] == "ok"]
+                seconds, memory = sum(t["seconds"] for t in ok), max((t["memory_mb"] for t in ok), default=0.0)
+                status = "ok"
+            else:
+                task = run["tasks"].get(name, {"status": "-", "seconds": 0.0, "memory_mb": 0.0})
+                seconds, memory, status = task["seconds"], task["memory_mb"], task["status"]
+            if status == "ok":
+                row += f"  {seconds:>9.2f}  {memory:>6.0f}"
+                points.append((run["scale"], seconds))
+            else:
+                row += f"  {status:>9}  {'-':>6}"
+        exponent = growth_exponent(points[0], points[-1]) if len(points) > 1 else None
+        row += f"  {exponent:>6.2f}" if exponent is not None else f"  {'-':>6}"
+        if baseline:
+            row += "  " + baseline_change(name, runs, baseline)
+        print(row)
+
+
+def baseline_change(name, runs, baseline):
+    """Per-scale run time change of ``name`` against the same scale in ``baseline``."""
+    before = {run["scale"]: run for run in baseline["runs"]}
+    changes = []
+    for run in runs:
+        old = before.get(run["scale"])
+        if old is None:
+            continue
+        if name == "total":
+            # Only the tasks measured (successfully) in both reports
+            shared = [n for n, t in run["tasks"].items()
+                      if t["status"] == "ok" and old["tasks"].get(n, {}).get("status") == "ok"]
+            new_s = sum(run["tasks"][n]["seconds"] for n in shared)
+            old_s = sum(old["tasks"][n]["seconds"] for n in shared)
+        else:
+            new_s = run["tasks"].get(name, {}).get("seconds", 0.0)
+            old_s = old["tasks"].get(name, {}).get("seconds", 0.0)
+        if new_s and old_s:
+            changes.append(f"{run['scale']}x {new_s / old_s - 1:+.0%}")
+    return ", ".join(changes) or "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time and memory-profile every pipeline task on synthetic cohorts of growing size.")
+    parser.add_argument("--scales", default="1,10,100", help="Comma-separated scale factors (default: 1,10,100)")
+    parser.add_argument("--grow", choices=("patients", "cgis", "both"), default="patients",
+                        help="What the scale factor multiplies (default: patients)")
+    parser.add_argument("--patients", type=int, default=8, help="Patients at 1x (default: 8)")
+    parser.add_argument("--healthy", type=int, default=4, help="Healthy controls at 1x (default: 4)")
+    parser.add_argument("--cgis", type=int, default=2000, help="CpG island rows at 1x (default: 2000)")
+    parser.add_argument("--runs", type=int, default=3, help="EMSeq runs (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the cohort (default: 0)")
+    parser.add_argument("--tasks", type=lambda text: [t.strip() for t in text.split(",") if t.strip()],
+                        help="Comma-separated tasks to measure, plus the tasks producing their inputs (default: all)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for the bubble plots (default: 1)")
+    parser.add_argument("--workdir", help="Folder for the generated workspaces (default: a temporary folder, removed afterwards)")
+    parser.add_argument("--json", help="Write the report to this JSON file")
+    parser.add_argument("--baseline", help="JSON report from an earlier --json run to compare against")
+    args = parser.parse_args()
+
+    scales = sorted({int(s) for s in args.scales.split(",") if s.strip()})
+    workdir = args.workdir or tempfile.mkdtemp(prefix="methpipe-scale-")
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "grow": args.grow,
+        "base": {"patients": args.patients, "healthy": args.healthy, "cgis": args.cgis, "runs": args.runs, "seed": args.seed},
+        "runs": [],
+    }
+    try:
+        for scale in scales:
+            run = run_scale(scale, workdir, args)
+            if not args.workdir:
+                del run["workspace"]
+            report["runs"].append(run)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    print()
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=1)
+        print(f"Saved results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
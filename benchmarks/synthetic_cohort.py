@@ -0,0 +1,203 @@
+"""Synthetic EM-seq cohort in the input formats of the pipeline.
+
+Writes one Glob20 and one GlobMin80 count workbook per EMSeq run plus the
+patient ID lists into a ``data/`` folder, so every step and plotting script
+can run on it:
+
+- run workbooks ``EMSeq-<run>-Run-1_CG80_CH20_Tot10_<Glob20|GlobMin80>_cpgi_counts.xlsx``
+  with a ``Header`` label column, the ``Info_*`` / methylation QC rows, the
+  "Total CpG island fragments counts..." row and one
+  ``CGI_chr<c>_<start>_<end>_<GENE...>_<probe>`` row per CpG island;
+- sample columns named like the real runs: ``INNOV_LS-24-<n>`` healthy
+  controls, ``LOI_<patient>_<timepoint>`` and
+  ``<patient>_<timepoint>_<date>[_Replicate-Barcode-<n>]``, with the
+  timepoints ``Baseline``, ``C<n>D<d>`` and ``C<n>D1-Off-tx`` / ``Off-tx``;
+- ``Patient ID list fot EMseq16-18-20.xlsx`` (read by the rank slope plots)
+  and ``patient_ids.xlsx`` (matched by the ``*patient*`` globs), both with
+  every patient and healthy control ID.
+
+GlobMin80 counts are Poisson around a per-CGI depth; Glob20 counts are a
+binomial share of them whose rate depends on the CGI, the patient and the
+timepoint, so the plots have real differences to show. The same seed gives
+the same files.
+
+    python benchmarks/synthetic_cohort.py /tmp/cohort/data
+    python benchmarks/synthetic_cohort.py /tmp/cohort/data --patients 80 --cgis 20000 --seed 3
+"""
+import argparse
+import os
+import string
+
+import numpy as np
+import pandas as pd
+
+TOTAL_ROW_LABEL = "Total CpG island fragments counts for this particular spreadsheet"
+SLOPE_PATIENT_FILE = "Patient ID list fot EMseq16-18-20.xlsx"
+PATIENT_FILE = "patient_ids.xlsx"
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ["X", "Y"]
+# Relative CpG island counts per chromosome (roughly those of hg38)
+CHROMOSOME_WEIGHTS = [2462, 1247, 1163, 836, 1031, 1152, 1345, 879, 1134, 1014, 1325, 1158,
+                      540, 722, 788, 1357, 1542, 421, 2394, 773, 335, 620, 876, 50]
+# Glob20 rate multiplier per timepoint kind
+TIMEPOINT_EFFECT = {"Healthy": 0.6, "Baseline": 1.5, "Off-tx": 1.2}
+
+
+def gene_symbols(rng, count):
+    """``count`` distinct gene-like symbols (``KLF4``, ``LOC100288069``, ``LINC01128`` ...)."""
+    symbols = set()
+    letters = np.array(list(string.ascii_uppercase))
+    while len(symbols) < count:
+        kind = rng.random()
+        if kind < 0.1:
+            symbols.add(f"LOC{rng.integers(100000000, 110000000)}")
+        elif kind < 0.15:
+            symbols.add(f"LINC{rng.integers(0, 3000):05d}")
+        else:
+            symbols.add("".join(rng.choice(letters, rng.integers(2, 6))) + str(rng.integers(1, 20)))
+    return sorted(symbols)
+
+
+def cgi_labels(rng, count):
+    """``count`` CGI row labels, sorted by chromosome and position, with 0-3 genes each."""
+    weights = np.array(CHROMOSOME_WEIGHTS, dtype=float)
+    chromosomes = rng.choice(len(CHROMOSOMES), size=count, p=weights / weights.sum())
+    starts = rng.integers(10000, 240000000, size=count)
+    lengths = rng.integers(200, 3000, size=count)
+    genes = gene_symbols(rng, max(count * 3 // 4, 1))
+    gene_counts = rng.choice(4, size=count, p=[0.2, 0.6, 0.15, 0.05])
+    probes = np.where(rng.random(count) < 0.97, 0, rng.integers(1, 4, size=count))
+
+    labels = []
+    for i in np.lexsort((starts, chromosomes)):
+        names = rng.choice(genes, gene_counts[i], replace=False) if gene_counts[i] else []
+        labels.append("_".join(["CGI", f"chr{CHROMOSOMES[chromosomes[i]]}", str(starts[i]),
+                                str(starts[i] + lengths[i]), *names, str(probes[i])]))
+    return labels
+
+
+def patient_ids(rng, count):
+    """``count`` distinct IDs like ``MN010-112``."""
+    ids = set()
+    while len(ids) < count:
+        letters = "".join(rng.choice(list(string.ascii_uppercase), 2))
+        ids.add(f"{letters}{rng.integers(0, 1000):03d}-{rng.integers(0, 1000):03d}")
+    return sorted(ids)
+
+
+def patient_samples(rng, patient, loi):
+    """``[(sample name, timepoint kind, cycle)]`` for one patient's course of treatment."""
+    cycles = sorted(rng.choice(np.arange(1, 9), rng.integers(1, 4), replace=False))
+    timepoints = [("Baseline", "Baseline", 0)]
+    for cycle in cycles:
+        day = "D4-7" if loi and cycle == 1 else rng.choice(["D1", "D1", "D15"])
+        timepoints.append((f"C{cycle}{day}", "On-Treatment", cycle))
+    if rng.random() < 0.8:
+        name = f"C{cycles[-1] + 1}D1-Off-tx" if rng.random() < 0.5 else "Off-tx"
+        timepoints.append((name, "Off-tx", cycles[-1] + 1))
+
+    samples = []
+    date = pd.Timestamp("2017-01-01") + pd.Timedelta(days=int(rng.integers(0, 900)))
+    for timepoint, kind, cycle in timepoints:
+        if loi:
+            samples.append((f"LOI_{patient}_{timepoint}", kind, cycle))
+            continue
+        name = f"{patient}_{timepoint}_{date:%Y.%m.%d}"
+        if rng.random() < 0.08:
+            barcodes = rng.choice(np.arange(1, 25), 2, replace=False)
+            samples.extend((f"{name}_Replicate-Barcode-{b}", kind, cycle) for b in barcodes)
+        else:
+            samples.append((name, kind, cycle))
+        date += pd.Timedelta(days=int(rng.integers(20, 60)))
+    return samples
+
+
+def count_workbooks(rng, labels, samples, run):
+    """``(glob20, globmin80)`` frames of one run, in the layout of the sequencing core's workbooks."""
+    n_cgis, n_samples = len(labels), len(samples)
+    depth = rng.lognormal(4.5, 1.0, size=n_cgis)[:, None] * rng.uniform(0.5, 1.5, size=n_samples)[None, :]
+    globmin80 = rng.poisson(depth)
+
+    effect = np.array([TIMEPOINT_EFFECT.get(kind, 1.5 * 0.85 ** cycle) * factor for _, kind, cycle, factor in samples])
+    rate = rng.beta(1.0, 60.0, size=n_cgis)[:, None] * effect[None, :]
+    glob20 = rng.binomial(globmin80, np.clip(rate, 0.0, 1.0))
+
+    names = [name for name, *_ in samples]
+    info = pd.DataFrame(
+        [["Info_EMSeq"] + [str(run)] * n_samples,
+         ["Info_Pool"] + [str(p) for p in rng.integers(1, 5, size=n_samples)],
+         ["Info_Barcode"] + [str(b) for b in rng.integers(1, 25, size=n_samples)],
+         ["C methylated in CpG context"] + [f"{v:.1f}%" for v in rng.normal(94.0, 0.3, size=n_samples)],
+         ["C methylated in CHG context"] + [f"{v:.1f}%" for v in rng.normal(12.0, 3.0, size=n_samples)]],
+        columns=["Header"] + names)
+
+    frames = []
+    for counts in (glob20, globmin80):
+        total = pd.DataFrame([[TOTAL_ROW_LABEL] + counts.sum(axis=0).tolist()], columns=["Header"] + names)
+        cgis = pd.DataFrame(counts, columns=names)
+        cgis.insert(0, "Header", labels)
+        frames.append(pd.concat([info, total, cgis], ignore_index=True))
+    return frames[0], frames[1]
+
+
+def generate_cohort(data_dir, patients=8, healthy=4, cgis=2000, runs=3, loi_share=0.25, seed=0):
+    """Write a synthetic cohort into ``data_dir`` and return a summary dict.
+
+    Patients and healthy controls are spread round-robin over ``runs``
+    EMSeq runs (numbered 16, 18, 20, ...); every run covers the same CGIs.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    labels = cgi_labels(rng, cgis)
+    patient_list = patient_ids(rng, patients)
+    control_list = [f"INNOV_LS-24-{11000 + i:05d}" for i in range(healthy)]
+
+    run_samples = [[] for _ in range(runs)]
+    for i, control in enumerate(control_list):
+        run_samples[i % runs].append((control, "Healthy", 0, rng.lognormal(0.0, 0.2)))
+    for i, patient in enumerate(patient_list):
+        factor = rng.lognormal(0.0, 0.3)
+        for name, kind, cycle in patient_samples(rng, patient, loi=rng.random() < loi_share):
+            run_samples[i % runs].append((name, kind, cycle, factor))
+
+    files = []
+    for i, samples in enumerate(run_samples):
+        run = 16 + 2 * i
+        for group, frame in zip(("Glob20", "GlobMin80"), count_workbooks(rng, labels, samples, run)):
+            path = os.path.join(data_dir, f"EMSeq-{run}-Run-1_CG80_CH20_Tot10_{group}_cpgi_counts.xlsx")
+            frame.to_excel(path, index=False)
+            files.append(path)
+
+    ids = pd.DataFrame({"Patient ID": patient_list + control_list})
+    for name in (SLOPE_PATIENT_FILE, PATIENT_FILE):
+        path = os.path.join(data_dir, name)
+        ids.to_excel(path, index=False)
+        files.append(path)
+
+    return {
+        "patients": patients,
+        "healthy": healthy,
+        "samples": sum(len(s) for s in run_samples),
+        "cgis": cgis,
+        "runs": runs,
+        "seed": seed,
+        "input_bytes": sum(os.path.getsize(path) for path in files),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic EM-seq cohort (run workbooks and patient ID lists).")
+    parser.add_argument("data_dir", help="Folder to write the input files to (the pipeline's data/ folder)")
+    parser.add_argument("--patients", type=int, default=8, help="Number of patients (default: 8)")
+    parser.add_argument("--healthy", type=int, default=4, help="Number of INNOV healthy controls (default: 4)")
+    parser.add_argument("--cgis", type=int, default=2000, help="Number of CpG island rows (default: 2000)")
+    parser.add_argument("--runs", type=int, default=3, help="Number of EMSeq runs (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+
+    summary = generate_cohort(args.data_dir, args.patients, args.healthy, args.cgis, args.runs, seed=args.seed)
+    print(f"Wrote {summary['samples']} samples ({summary['patients']} patients, {summary['healthy']} healthy) × "
+          f"{summary['cgis']} CGIs in {summary['runs']} run(s) to {args.data_dir} ({summary['input_bytes'] / 2 ** 20:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+from methpipe.cli import main
+
+main()
@@ -0,0 +1,108 @@
+import io
+import os
+import queue
+import threading
+import time
+import zipfile
+
+# Formats that are already compressed; deflating them again only costs time
+STORED_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".zip", ".npz", ".xlsx")
+
+
+def figure_bytes(fig, fmt="png", **savefig_kwargs):
+    """Render ``fig`` into memory and return the encoded bytes."""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt, **savefig_kwargs)
+    return buffer.getvalue()
+
+
+class FigureArchive:
+    """Zip archive that figures and tables are written into directly.
+
+    Figures are rendered into in-memory buffers and streamed into the zip,
+    so nothing is written to (and re-read from) the plot folder. Entries
+    whose extension is in ``stored_extensions`` (PNG by default) are
+    stored as-is; everything else (SVG, CSV, ...) is deflated with
+    ``compresslevel``.
+
+    ``write`` is thread-safe, so several producer threads can feed one
+    archive. With ``background=True`` entries are handed to a dedicated
+    writer thread through a bounded queue (``max_pending`` entries), so
+    compressing and writing overlap with rendering the next figure.
+    """
+
+    def __init__(self, path, compression=zipfile.ZIP_DEFLATED, compresslevel=6,
+                 stored_extensions=STORED_EXTENSIONS, background=False, max_pending=32):
+        self.path = path
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.stored_extensions = tuple(e.lower() for e in stored_extensions)
+        self.names = []
+        self._zip = zipfile.ZipFile(path, "w")
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._error = None
+        if background:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._writer = threading.Thread(target=self._drain, name="figure-archive-writer", daemon=True)
+            self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def savefig(self, fig, arcname, **savefig_kwargs):
+        """Render ``fig`` in the format given by ``arcname``'s extension and add it."""
+        fmt = os.path.splitext(arcname)[1].lstrip(".").lower() or "png"
+        data = figure_bytes(fig, fmt, **savefig_kwargs)
+        self.write(arcname, data)
+        return data
+
+    def write_csv(self, frame, arcname, **to_csv_kwargs):
+        """Add ``frame.to_csv(...)`` as ``arcname`` without touching the disk."""
+        self.write(arcname, frame.to_csv(**to_csv_kwargs).encode("utf-8"))
+
+    def write(self, arcname, data):
+        """Add ``data`` (bytes) as ``arcname``; queued when writing in the background."""
+        if self._error is not None:
+            raise self._error
+        if self._queue is not None:
+            self._queue.put((arcname, data))
+        else:
+            self._write(arcname, data)
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._queue = None
+        self._zip.close()
+        if self._error is not None:
+            raise self._error
+
+    def _write(self, arcname, data):
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        if arcname.lower().endswith(self.stored_extensions):
+            info.compress_type = zipfile.ZIP_STORED
+            level = None
+        else:
+            info.compress_type = self.compression
+            level = self.compresslevel
+        with self._lock:
+            self._zip.writestr(info, data, compresslevel=level)
+            self.names.append(arcname)
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except Exception as exc:  # surfaced on the next write() / close()
+                    self._error = exc
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+from methpipe.archive import figure_bytes
+from methpipe.chromosomes import chromosome_partitions
+
+LOD_AGGREGATES = ("max", "mean", "sum")
+
+BubbleLOD = namedtuple("BubbleLOD", ["how", "threshold", "bin_px"])
+BubbleLOD.__doc__ = """Density-binned level-of-detail settings for bubble plots.
+
+Chromosomes with at least ``threshold`` CGIs in a timepoint row are drawn
+as one bubble per ``bin_px``-pixel-wide genomic bin and row, whose value is
+the ``how`` (``max``, ``mean`` or ``sum``) of the CGIs in the bin; smaller
+chromosomes keep full detail.
+"""
+
+BubbleSource = namedtuple("BubbleSource", ["midpoints", "values", "column_pos", "timepoint_cols", "chrom_rows"])
+BubbleSource.__doc__ = """Bubble plot data of one collapsed matrix, grouped by chromosome.
+
+``midpoints`` and the rows of ``values`` (the collapsed (Patient, Timepoint)
+columns) are ordered so that ``chrom_rows[chrom]`` is a slice; CGIs whose
+label has no coordinates are dropped. ``column_pos`` maps a (Patient,
+Timepoint) label to its column in ``values`` and ``timepoint_cols`` maps a
+timepoint to the columns of all patients.
+"""
+
+
+def bubble_source(collapsed):
+    """``BubbleSource`` for a CGI × (Patient, Timepoint) collapsed matrix."""
+    coords = pd.Series(collapsed.index, dtype=object).str.extract(r"CGI_(chr\w+)_(\d+)_(\d+)", expand=True)
+    keep = coords.notna().all(axis=1).to_numpy()
+    coords = coords[keep]
+    midpoints = (coords[1].astype(np.int64).to_numpy() + coords[2].astype(np.int64).to_numpy()) // 2
+
+    order, chrom_rows = chromosome_partitions(coords[0])
+    columns = collapsed.columns
+    timepoints = columns.get_level_values(1)
+    return BubbleSource(
+        midpoints[order],
+        collapsed.to_numpy(dtype=float)[keep][order],
+        {label: i for i, label in enumerate(columns)},
+        {tp: np.flatnonzero(timepoints == tp) for tp in timepoints.unique()},
+        chrom_rows,
+    )
+
+
+def density_bins(x, y, values, xlim, n_bins, how="max"):
+    """Aggregate bubbles into ``n_bins`` equal-width x bins per distinct ``y``.
+
+    Returns ``(x, y, values)`` of the non-empty bins, with x at the bin
+    centres, ordered by row and then by bin.
+    """
+    if how not in LOD_AGGREGATES:
+        raise ValueError(f"Unknown LOD aggregate {how!r}; expected one of {LOD_AGGREGATES}")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    values = np.asarray(values, dtype=float)
+    lo, hi = xlim
+    n_bins = max(int(n_bins), 1)
+    width = (hi - lo) / n_bins if hi > lo else 1.0
+
+    bins = np.clip(((x - lo) / width).astype(np.intp), 0, n_bins - 1)
+    rows, row_codes = np.unique(y, return_inverse=True)
+    keys = row_codes.astype(np.int64) * n_bins + bins
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    ordered = values[order]
+    if how == "max":
+        agg = np.maximum.reduceat(ordered, starts)
+    else:
+        agg = np.add.reduceat(ordered, starts)
+        if how == "mean":
+            agg = agg / np.diff(np.r_[starts, len(keys)])
+    bin_keys = keys[starts]
+    return lo + (bin_keys % n_bins + 0.5) * width, rows[bin_keys // n_bins], agg
+
+
+class BubbleFigureTemplate:
+    """A bubble plot figure whose fixed layout is built once and reused.
+
+    The caller builds the skeleton (figure, axes, colorbar, bubble-size
+    legend, labels, margins) around an empty ``scatter`` on ``ax`` and
+    wraps it in a template. Each plot then only swaps the scatter's
+    offsets, sizes and colors, the title text and the x-limits before
+    saving, instead of rebuilding the whole figure.
+    """
+
+    def __init__(self, fig, ax, scatter, size_scale=1.0):
+        self.fig = fig
+        self.ax = ax
+        self.scatter = scatter
+        self.size_scale = size_scale
+
+    def render(self, x, y, values, title, xlim, lod=None):
+        """Point the template at a new set of bubbles.
+
+        With a ``BubbleLOD`` the bubbles of dense chromosomes are first
+        aggregated into pixel-width bins (see ``density_bins``), so the
+        number of markers is bounded by the axes width.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if lod is not None and len(x) and np.unique(y, return_counts=True)[1].max() >= lod.threshold:
+            n_bins = self.axes_pixel_width() / max(lod.bin_px, 1)
+            x, y, values = density_bins(x, y, values, xlim, n_bins, lod.how)
+        self.scatter.set_offsets(np.column_stack([x, y]))
+        self.scatter.set_sizes(values ** 0.5 * self.size_scale)
+        self.scatter.set_array(values)
+        self.ax.title.set_text(title)
+        self.ax.set_xlim(*xlim)
+
+    def axes_pixel_width(self):
+        """Width of the plot area in (PNG) pixels."""
+        return self.ax.get_position().width * self.fig.get_figwidth() * self.fig.dpi
+
+    def encode(self, filename_base, formats=("png", "svg")):
+        """Render the current state in memory: ``[(name, bytes), ...]`` per format."""
+        return [(f"{filename_base}.{ext}", figure_bytes(self.fig, ext)) for ext in formats]
+
+    def render_cached(self, cache, filename_base, x, y, values, title, xlim, lod=None, formats=("png", "svg")):
+        """``render`` + ``encode`` through a ``methpipe.figcache.FigureCache``.
+
+        The key covers the bubbles, title, limits, LOD settings and bubble
+        scale, so a figure whose exact inputs were rendered before is
+        served from the cache without touching the template.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        values = np.asarray(values, dtype=float)
+        names = [f"{filename_base}.{ext}" for ext in formats]
+        key = cache.key("bubble", x, y, values, title, [float(v) for v in xlim], lod, self.size_scale)
+
+        def draw():
+            self.render(x, y, values, title, xlim, lod)
+            return [data for _, data in self.encode(filename_base, formats)]
+        return cache.fetch(key, names, draw)
+
+    def save(self, filename_base, formats=("png", "svg"), archive=None):
+        """Save the current state once per format; returns the written names.
+
+        With an ``archive`` (``methpipe.archive.FigureArchive``) the figure
+        is rendered in memory and ``filename_base`` is the name inside the
+        zip; otherwise it is a path on disk.
+        """
+        names = []
+        for ext in formats:
+            name = f"{filename_base}.{ext}"
+            if archive is not None:
+                archive.savefig(self.fig, name)
+            else:
+                self.fig.savefig(name)
+            names.append(name)
+        return names
+
+    def close(self):
+        import matplotlib.pyplot as plt
+        plt.close(self.fig)
+
+
+def padded_xlim(x, pad=0.1):
+    """x-limits with ``pad`` × range of padding on both sides."""
+    x_min, x_max = np.min(x), np.max(x)
+    x_range = x_max - x_min
+    return x_min - pad * x_range, x_max + pad * x_range
@@ -0,0 +1,129 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+from methpipe.replicates import paired_columns
+
+CHR_ORDER = [str(i) for i in range(1, 23)] + ["X", "Y"]
+
+
+def chromosome_codes(labels, order=CHR_ORDER):
+    """Integer chromosome code per CGI label (position in ``order``; -1 if unknown)."""
+    chrom = pd.Series(list(labels), dtype=object).astype(str).str.extract(r"chr([^_]+)")[0]
+    return pd.Categorical(chrom, categories=order).codes.astype(np.intp)
+
+
+def delta_matrix(collapsed, t0, t1):
+    """CGI × patient matrix of ``t1 - t0`` for every patient that has both timepoints.
+
+    ``collapsed`` has (Patient, Timepoint) MultiIndex columns.
+    """
+    patients, before, after = paired_columns(collapsed.columns, t0, t1)
+    values = collapsed.to_numpy(dtype=float)
+    return pd.DataFrame(values[:, after] - values[:, before], index=collapsed.index, columns=pd.Index(patients, name=collapsed.columns.names[0]))
+
+
+def chromosome_sums(deltas, codes, n_chrom):
+    """Per-chromosome × patient sums and counts of the non-NaN deltas."""
+    values = np.asarray(deltas, dtype=float)
+    n_rows, n_patients = values.shape
+    valid = ~np.isnan(values) & (codes >= 0)[:, None]
+    flat = (codes[:, None] * n_patients + np.arange(n_patients))[valid]
+    size = n_chrom * n_patients
+    sums = np.bincount(flat, weights=values[valid], minlength=size).reshape(n_chrom, n_patients)
+    counts = np.bincount(flat, minlength=size).reshape(n_chrom, n_patients).astype(float)
+    return sums, counts
+
+
+def chromosome_mean_deltas(deltas, codes, order=CHR_ORDER, n_boot=0, ci=0.95, seed=0):
+    """Mean delta per chromosome, pooled over CGIs and patients.
+
+    With ``n_boot > 0`` a percentile confidence interval is added by
+    resampling patients with replacement. All replicates are evaluated at
+    once from the per-patient sums and counts (one matrix product), so the
+    cost is independent of the number of CGIs.
+    """
+    sums, counts = chromosome_sums(deltas, codes, len(order))
+    return chromosome_summary(sums, counts, order, n_boot, ci, seed)
+
+
+def chromosome_summary(sums, counts, order=CHR_ORDER, n_boot=0, ci=0.95, seed=0):
+    """``chromosome_mean_deltas`` from per-chromosome × patient ``sums`` and ``counts``.
+
+    Used directly when the sums were computed per chromosome shard.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums.sum(axis=1) / counts.sum(axis=1)
+    summary = pd.DataFrame({"Chromosome": order, "Mean_Delta": mean})
+
+    if n_boot:
+        n_patients = sums.shape[1]
+        if n_patients:
+            rng = np.random.default_rng(seed)
+            weights = rng.multinomial(n_patients, np.full(n_patients, 1.0 / n_patients), size=n_boot).T
+            with np.errstate(invalid="ignore", divide="ignore"):
+                boot = (sums @ weights) / (counts @ weights)
+            alpha = (1 - ci) / 2
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)  # chromosomes without any data
+                lower, upper = np.nanquantile(boot, [alpha, 1 - alpha], axis=1)
+        else:
+            lower = upper = np.full(len(order), np.nan)
+        summary["CI_Lower"] = lower
+        summary["CI_Upper"] = upper
+    return summary
+
+
+def chromosome_partitions(chroms):
+    """Group rows by chromosome into contiguous row ranges.
+
+    Returns ``(order, rows)``: ``order`` permutes the rows so that every
+    chromosome is a single block (the identity when the rows are already
+    grouped, e.g. sorted by coordinate; otherwise a stable sort that keeps
+    each chromosome's row order) and ``rows`` maps each chromosome, in
+    order of first appearance, to its ``slice`` of the reordered rows.
+    """
+    codes, labels = pd.factorize(np.asarray(chroms, dtype=object))
+    if np.all(codes[1:] >= codes[:-1]):
+        order = np.arange(len(codes))
+    else:
+        order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+    return order, {chrom: slice(bounds[i], bounds[i + 1]) for i, chrom in enumerate(labels)}
+
+
+# === Per-chromosome shard tasks (see methpipe.shards) ===
+
+def shard_delta_sums(block, chrom, pairs):
+    """Per-patient sums and counts of one chromosome's deltas, for every ``(before, after)`` column pair.
+
+    The rows are reduced in their original order, so the merged sums equal
+    ``chromosome_sums`` over the whole matrix.
+    """
+    values = block["values"]
+    single = np.zeros(len(values), dtype=np.intp)
+    results = []
+    for before, after in pairs:
+        sums, counts = chromosome_sums(values[:, after] - values[:, before], single, 1)
+        results.append((sums[0], counts[0]))
+    return results
+
+
+def shard_cgi_deltas(block, chrom, pairs, min_pairs=2):
+    """Mean ``t1 - t0`` change and number of patients of every CGI row of one chromosome.
+
+    ``pairs`` is a list of ``(before, after)`` column positions; only patients
+    with both values count, and rows with fewer than ``min_pairs`` patients
+    get ``NaN``. Missing deltas count as zero in a masked row sum.
+    """
+    values = block["values"]
+    results = []
+    for before, after in pairs:
+        deltas = values[:, after] - values[:, before]
+        valid = ~np.isnan(deltas)
+        n = valid.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(valid, deltas, 0.0).sum(axis=1) / n
+        mean[n < min_pairs] = np.nan
+        results.append((mean, n))
+    return results
@@ -0,0 +1,512 @@
+"""``python -m methpipe``: one entry point for the preprocessing steps and plots.
+
+Each step is a subcommand that reads its inputs from ``output/`` (or
+``data/``) and writes its result there, like the matching
+``scripts/step_*.py``. ``run`` chains several steps in one process and
+hands the DataFrames from step to step in memory; only the last step's
+result (plus any steps named with ``--save``) is written.
+"""
+import argparse
+import glob
+import os
+import runpy
+import shlex
+import sys
+import time
+
+from methpipe import dtypes, matrixstore, metrics, progress, service, shards, steps, workqueue
+
+STEPS = ("filter", "merge", "ratio", "annotate", "map", "gene-matrix")
+STEP_HELP = {
+    "filter": "Step 1: keep the sample columns of the patients in data/*patient*.xlsx",
+    "merge": "Step 2: merge the filtered Glob20 / GlobMin80 runs",
+    "ratio": "Step 3: scaled Glob20 / GlobMin80 fragment ratio matrix (× 1000, as step_3_convert_to_aberrant_signals.py)",
+    "annotate": "Step 4: split CGI labels into a gene annotation table",
+    "map": "Step 5: build the gene → CGI map",
+    "gene-matrix": "Step 6: sum CpG rows per gene into a gene methylation matrix",
+}
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+
+
+class Pipeline:
+    """Pipeline steps sharing their results in memory.
+
+    A step takes its inputs from the results of earlier steps in the same
+    ``Pipeline`` and only falls back to reading the files an earlier run
+    wrote to ``output_dir``, so ``run("merge")`` followed by
+    ``run("ratio")`` never re-parses the merged workbooks. Results are
+    written (with the file names the step scripts use) for the steps in
+    ``save``.
+    """
+
+    def __init__(self, data_dir=steps.DATA_DIR, output_dir=steps.OUTPUT_DIR, save=(), progress=True):
+        self.data_dir = data_dir
+        self.output_dir = output_dir
+        self.save = set(save)
+        self.progress = progress
+        self.results = {}
+        self.written = []
+
+    def run(self, step):
+        start = time.perf_counter()
+        summary = getattr(self, "_" + step.replace("-", "_"))()
+        print(f"[{step}] {summary} ({time.perf_counter() - start:.1f} s)")
+
+    def _input(self, name, load):
+        if name not in self.results:
+            with metrics.stage("load", input=name):
+                self.results[name] = load()
+        return self.results[name]
+
+    def _write(self, step, filename, write, store=None):
+        """Write ``filename`` if ``step`` is saved; ``store(path)`` then writes its matrix store."""
+        if step in self.save:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, filename)
+            with metrics.stage("archive", output=filename):
+                write(path)
+                if store is not None:
+                    store(path)
+            self.written.append(path)
+
+    # === Steps ===
+
+    def _filter(self):
+        with metrics.stage("load", input="runs"):
+            runs, patient_ids = steps.load_raw_runs(self.data_dir)
+        with metrics.stage("filter"):
+            filtered = {fname: steps.filter_patient_columns(df, patient_ids) for fname, df in runs.items()}
+        self.results["filtered"] = filtered
+        for fname, df in filtered.items():
+            self._write("filter", f"{fname}{steps.FILTERED_SUFFIX}", lambda path, df=df: df.to_excel(path, index=False))
+        return f"{len(filtered)} run file(s) filtered to {len(patient_ids)} patient(s)"
+
+    def _merge(self):
+        filtered = self._input("filtered", lambda: steps.load_filtered_runs(self.output_dir))
+        with metrics.stage("align"):
+            merged = steps.merge_run_groups(filtered)
+        self.results["merged"] = merged
+        for group, df in merged.items():
+            self._write("merge", steps.MERGED_FILES[group], lambda path, df=df: df.to_excel(path, index=False))
+        return ", ".join(f"{group}: {df.shape[0]} rows × {df.shape[1] - 1} samples" for group, df in merged.items())
+
+    def _ratio(self):
+        merged = self._input("merged", lambda: steps.read_merged_runs(self.output_dir))
+        missing = [group for group in steps.MERGED_FILES if group not in merged]
+        if missing:
+            raise ValueError(f"No merged {' / '.join(missing)} runs to compute the ratio matrix from.")
+        with metrics.stage("ratio"):
+            ratio = steps.scaled_ratio_matrix(merged["glob20"], merged["globmin80"])
+        self.results["ratio"] = ratio
+        self._write("ratio", steps.RATIO_MATRIX_FILE, lambda path: ratio.to_excel(path, index=False),
+                    store=steps.save_ratio_store)
+        return f"{ratio.shape[0]} rows × {ratio.shape[1] - 1} samples"
+
+    def _annotate(self):
+        if "ratio" in self.results:
+            labels = self.results["ratio"].iloc[:, 0]
+        else:
+            with metrics.stage("load", input="ratio"):
+                labels = steps.read_matrix_labels(steps.find_excel_file(self.output_dir, "matrix"))
+        with metrics.stage("match"):
+            annotation = steps.gene_annotation(labels)
+        self.results["annotation"] = annotation
+        self._write("annotate", steps.ANNOTATION_FILE, lambda path: annotation.to_csv(path, index=False))
+        return f"{len(annotation)} CGIs annotated"
+
+    def _map(self):
+        annotation = self._input("annotation", lambda: steps.read_table(steps.find_annotation_file(self.output_dir)))
+        with metrics.stage("match"):
+            gene_map = steps.gene_cgi_map(annotation)
+        self.results["gene_map"] = gene_map
+        self._write("map", steps.GENE_MAP_FILE, lambda path: gene_map.to_csv(path, index=False))
+        return f"{len(gene_map)} gene-CGI pairs"
+
+    def _gene_matrix(self):
+        if "merged" in self.results and "glob20" in self.results["merged"]:
+            merged = self.results["merged"]["glob20"]
+            cpg_matrix = merged.set_index(merged.columns[0])
+            cpg_matrix_file = os.path.join(self.output_dir, steps.MERGED_FILES["glob20"])
+        else:
+            with metrics.stage("load", input="merged"):
+                cpg_matrix_file = steps.find_file(self.output_dir, "merged_output_glob20")
+                cpg_matrix = steps.read_cpg_matrix(cpg_matrix_file)
+        gene_map = self._input("gene_map", lambda: steps.read_table(steps.find_file(self.output_dir, "cgi_map")))
+        gene_matrix = steps.gene_methylation_matrix(cpg_matrix, gene_map, progress=self.progress, matrix_path=cpg_matrix_file)
+        self.results["gene_matrix"] = gene_matrix
+        self._write("gene-matrix", steps.GENE_MATRIX_FILE, lambda path: gene_matrix.to_csv(path), store=lambda path: steps.save_matrix_store(gene_matrix, path))
+        return f"{gene_matrix.shape[0]} genes × {gene_matrix.shape[1]} samples"
+
+
+# === Plot scripts ===
+
+def plot_scripts():
+    """``{name: path}`` of the plotting scripts (file name without ``.py``)."""
+    paths = glob.glob(os.path.join(SCRIPTS_DIR, "*", "*.py")) + [os.path.join(SCRIPTS_DIR, "plot-by-cycle.py")]
+    return {os.path.splitext(os.path.basename(p))[0]: p for p in sorted(paths) if os.path.exists(p)}
+
+
+def plot_script_path(name):
+    """``(name, path)`` of a plotting script given by name (with or without ``.py``)."""
+    scripts = plot_scripts()
+    name = name[:-3] if name.endswith(".py") else name
+    if name not in scripts:
+        raise SystemExit(f"Unknown plot script {name!r}; see 'python -m methpipe plot --list'.")
+    return name, scripts[name]
+
+
+def run_plot(name, args=()):
+    """Run a plotting script in this process, as ``python <script> <args>`` would."""
+    name, path = plot_script_path(name)
+    start = time.perf_counter()
+    saved_argv = sys.argv
+    sys.argv = [path] + list(args)
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as exc:
+        if exc.code not in (None, 0):
+            raise
+    finally:
+        # The script's last stage ends with the script, not with whatever runs next
+        metrics.end()
+        sys.argv = saved_argv
+        if "matplotlib.pyplot" in sys.modules:
+            sys.modules["matplotlib.pyplot"].close("all")
+    print(f"[plot {name}] done ({time.perf_counter() - start:.1f} s)")
+
+
+# === Command line ===
+
+def parse_steps(text):
+    chosen = {s.strip() for s in text.split(",") if s.strip()}
+    unknown = chosen - set(STEPS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown step(s) {', '.join(sorted(unknown))}; choose from {', '.join(STEPS)}")
+    return [s for s in STEPS if s in chosen]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m methpipe", description="Methylation pipeline steps and plots.")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    for step in STEPS:
+        sub.add_parser(step, help=STEP_HELP[step], description=STEP_HELP[step])
+
+    plot = sub.add_parser("plot", help="Run a plotting script (scripts/global, scripts/locus) in this process")
+    plot.add_argument("script", nargs="?", help="Script name, e.g. top10dm-plots or bubbleplot_generator_v9_gridsoff")
+    plot.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments passed on to the script")
+    plot.add_argument("--list", action="store_true", help="List the available plotting scripts")
+
+    run = sub.add_parser("run", help="Chain steps (and plots) in one process, passing DataFrames in memory",
+                         description="Run the selected steps in order in one process. Each step uses the previous step's "
+                                     "result from memory; only the last step's output (plus --save steps) is written.")
+    run.add_argument("--steps", type=parse_steps, default=list(STEPS), help=f"Comma-separated steps to run (default: {','.join(STEPS)})")
+    run.add_argument("--save", type=parse_steps, default=[], help="Comma-separated steps whose intermediate output is also written")
+    run.add_argument("--save-intermediates", action="store_true", help="Write the output of every step")
+    run.add_argument("--plot", action="append", default=[], metavar="'SCRIPT [ARGS]'",
+                     help="Plotting script to run after the steps (repeatable). Plot scripts read output/, so every step's output is written when plots are requested.")
+    run.add_argument("--no-progress", action="store_true", help="Hide the tqdm progress bars (progress events are still sent)")
+    run.add_argument("--metrics", metavar="FILE", help=f"Append per-stage timing and memory records to FILE (sets {metrics.METRICS_ENV})")
+    run.add_argument("--progress", metavar="TARGET", help=f"Send progress events of the long loops to a file, unix:PATH or tcp:HOST:PORT (sets {progress.PROGRESS_ENV})")
+    run.add_argument("--store", action="store_true", help=f"Also write memory-mapped stores of the ratio and gene matrices (sets {matrixstore.STORE_ENV})")
+    run.add_argument("--dtypes", choices=dtypes.POLICIES, help=f"Dtype policy of the matrices and labels (sets {dtypes.DTYPES_ENV}; default: float64)")
+    run.add_argument("--workers", type=int, default=None, help=f"Worker processes of the chromosome-sharded locus plots (sets {shards.WORKERS_ENV}; default: 1, bubble plots: all CPUs)")
+
+    schedule = sub.add_parser("schedule", help="Run steps and plot scripts as a dependency graph, independent branches concurrently",
+                              description="Run the pipeline tasks (steps 1-6 and the plotting scripts) as subprocesses. "
+                                          "Tasks whose inputs are ready run concurrently within the CPU and memory budget.")
+    schedule.add_argument("--dry-run", action="store_true", help="Print the plan and the critical path without running anything")
+    schedule.add_argument("--tasks", type=lambda text: [t.strip() for t in text.split(",") if t.strip()],
+                          help="Comma-separated tasks to run, plus the tasks producing their inputs (default: all)")
+    schedule.add_argument("--no-upstream", action="store_true", help="With --tasks, run only the named tasks and use existing input files")
+    schedule.add_argument("--cpus", type=int, default=os.cpu_count() or 1, help="CPU budget (default: all CPUs)")
+    schedule.add_argument("--memory-mb", type=int, default=None, help="Memory budget in MB (default: 75%% of physical memory)")
+    schedule.add_argument("--workers", type=int, default=None, help="Worker processes for the bubble plots and the other chromosome-sharded locus plots (default: min(4, CPUs))")
+    schedule.add_argument("--metrics", metavar="FILE", help=f"Append every task's per-stage timing and memory records to FILE (sets {metrics.METRICS_ENV})")
+    schedule.add_argument("--progress", metavar="TARGET", help=f"Send every task's progress events to a file, unix:PATH or tcp:HOST:PORT (sets {progress.PROGRESS_ENV})")
+    schedule.add_argument("--store", action="store_true", help=f"Also write memory-mapped stores of the ratio and gene matrices (sets {matrixstore.STORE_ENV})")
+    schedule.add_argument("--dtypes", choices=dtypes.POLICIES, help=f"Dtype policy of every task (sets {dtypes.DTYPES_ENV}; default: float64)")
+
+    report = sub.add_parser("metrics", help="Summarize a per-stage metrics file",
+                            description=f"Sum the stage records in a {metrics.METRICS_ENV} file per script and stage.")
+    report.add_argument("file", nargs="?", default=metrics.metrics_path(), help=f"JSONL metrics file (default: ${metrics.METRICS_ENV})")
+    report.add_argument("--script", action="append", default=[], help="Only records of this script (repeatable)")
+
+    events = sub.add_parser("progress", help="Throughput per loop from a progress event file, or listen for events",
+                            description=f"Items per second of every loop in a {progress.PROGRESS_ENV} event file, optionally "
+                                        "compared with an earlier run. With --listen, receive events on a socket instead.")
+    events.add_argument("file", nargs="?", help="JSONL progress event file (with --listen: also append the received events to it)")
+    events.add_argument("--baseline", metavar="FILE", help="Event file of an earlier run to compare the loop rates against")
+    events.add_argument("--threshold", type=float, default=0.2, help="Flag loops this much slower than the baseline (default: 0.2)")
+    events.add_argument("--listen", metavar="ADDRESS", help="Print events sent to unix:PATH or tcp:HOST:PORT until interrupted")
+
+    store = sub.add_parser("store", help="Write memory-mapped stores of matrix files (read zero-copy by the pipeline)",
+                           description="Convert matrix files (first column: row labels) into matrix stores under "
+                                       f"{matrixstore.STORE_DIRNAME}/ next to them. Readers use a store while its source file is unchanged.")
+    store.add_argument("files", nargs="*", help=f"Matrix files (default: output/{steps.RATIO_MATRIX_FILE} and output/{steps.GENE_MATRIX_FILE})")
+
+    policy = sub.add_parser("dtypes", help="Memory of the float64 and compact dtype policies on the files in output/",
+                            description="Load the scaled ratio matrix, the merged runs and the gene matrix inputs from output/ "
+                                        "under both dtype policies, report their memory and check that the compact results "
+                                        "stay within tolerance of float64.")
+    policy.add_argument("--rtol", type=float, default=dtypes.RTOL, help=f"Largest allowed relative difference (default: {dtypes.RTOL:g})")
+    policy.add_argument("--no-gene-matrix", action="store_true", help="Skip the gene methylation matrix (step 6 matches every gene against every CGI)")
+
+    queue = sub.add_parser("queue", help="Inspect a distributed work queue, or run one with local worker processes",
+                           description="Scripts with a distributed mode (--queue DIR --submit/--work/--reduce) split their jobs "
+                                       "into task files that workers on any host sharing the folder claim by atomic rename.")
+    actions = queue.add_subparsers(dest="queue_command", metavar="action")
+    status = actions.add_parser("status", help="Pending, running, done and failed tasks of a queue")
+    status.add_argument("dir", help="Queue folder")
+    requeue = actions.add_parser("requeue", help="Put claimed tasks of workers that died (and optionally failed tasks) back to pending")
+    requeue.add_argument("dir", help="Queue folder")
+    requeue.add_argument("--stale", type=float, default=None, metavar="SECONDS", help="Only tasks claimed longer ago than this (default: every claimed task)")
+    requeue.add_argument("--failed", action="store_true", help="Also retry failed tasks")
+    local = actions.add_parser("local", help="Submit, work and reduce a script's queue with local processes standing in for hosts")
+    local.add_argument("--hosts", type=int, default=2, help="Worker processes (default: 2)")
+    local.add_argument("--dir", default=None, help=f"Queue folder (default: output/{workqueue.QUEUE_DIRNAME}/<script>)")
+    local.add_argument("script", help="Script with a distributed mode: bubbleplot_generator_v9_gridsoff or heatmap-lineplot-barplot_v3")
+    local.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments passed on to every role of the script")
+
+    serve = sub.add_parser("serve", help="Answer gene / region / patient / timepoint slice queries over HTTP from memory",
+                           description="Load the scaled ratio matrix, the gene map and the sample metadata once and answer "
+                                       "/slice, /samples, /genes and /stats queries on a TCP port or Unix socket until interrupted.")
+    serve.add_argument("--matrix", help="Scaled ratio matrix (default: the *ratios_matrix* workbook in output/)")
+    serve.add_argument("--gene-map", help=f"Gene → CGI map (default: output/{steps.GENE_MAP_FILE} if present)")
+    serve.add_argument("--patients", help="Patient list workbook (default: data/*patient*.xlsx)")
+    serve.add_argument("--listen", default=service.DEFAULT_LISTEN, metavar="ADDRESS", help=f"tcp:HOST:PORT or unix:PATH (default: {service.DEFAULT_LISTEN})")
+    serve.add_argument("--memory-mb", type=int, default=service.DEFAULT_MEMORY_MB, help=f"Cap on the resident data plus the cache (default: {service.DEFAULT_MEMORY_MB})")
+    serve.add_argument("--cache-mb", type=int, default=service.DEFAULT_CACHE_MB, help=f"Cap on the aggregate cache alone (default: {service.DEFAULT_CACHE_MB})")
+    serve.add_argument("--dtypes", choices=dtypes.POLICIES, help=f"Dtype policy of the loaded matrix (sets {dtypes.DTYPES_ENV}; default: float64)")
+    serve.add_argument("--verbose", action="store_true", help="Log every request to stderr")
+    return parser
+
+
+def schedule_command(args):
+    from methpipe import scheduler
+
+    graph = scheduler.TaskGraph(scheduler.pipeline_tasks(workers=args.workers))
+    if args.tasks:
+        graph = graph.subgraph(args.tasks, upstream=not args.no_upstream)
+    memory_mb = args.memory_mb or scheduler.default_memory_budget()
+    history = scheduler.read_history()
+    if args.dry_run:
+        scheduler.print_plan(graph, args.cpus, memory_mb, history)
+        return
+
+    path = metrics.metrics_path()
+    offset = os.path.getsize(path) if path and os.path.exists(path) else 0
+    start = time.perf_counter()
+    results = scheduler.run_graph(graph, args.cpus, memory_mb, history)
+    scheduler.update_history(results)
+    counts = {status: sum(r["status"] == status for r in results.values()) for status in ("ok", "failed", "skipped")}
+    print(f"Finished in {time.perf_counter() - start:.1f} s: {counts['ok']} ok, {counts['failed']} failed, {counts['skipped']} skipped")
+    if path and os.path.exists(path) and os.path.getsize(path) > offset:
+        metrics.print_summary(metrics.read_records(path, offset), title=f"Stage metrics (this run's tasks, {path})")
+    if counts["failed"]:
+        raise SystemExit(1)
+
+
+def metrics_command(args):
+    if not args.file:
+        raise SystemExit(f"No metrics file given and {metrics.METRICS_ENV} is not set.")
+    records = metrics.read_records(args.file)
+    if args.script:
+        records = [r for r in records if r["script"] in args.script]
+    if not records:
+        raise SystemExit(f"No stage records in {args.file}.")
+    metrics.print_summary(records, title=f"Stage metrics ({args.file}, {len(records)} records)")
+
+
+def progress_command(args):
+    if args.listen:
+        progress.listen(args.listen, args.file)
+        return
+    if not args.file:
+        raise SystemExit("Give a progress event file (or --listen ADDRESS).")
+    rates = progress.loop_rates(progress.read_events(args.file))
+    if not rates:
+        raise SystemExit(f"No finished loops in {args.file}.")
+    baseline = progress.loop_rates(progress.read_events(args.baseline)) if args.baseline else None
+    print(f"Loop throughput ({args.file})")
+    slower = progress.print_rates(rates, baseline, args.threshold)
+    if slower:
+        print(f"{slower} loop(s) more than {args.threshold:.0%} slower than {args.baseline}")
+
+
+def store_command(args):
+    from methpipe.dataset import read_matrix_values
+
+    files = args.files or [path for path in (os.path.join(steps.OUTPUT_DIR, steps.RATIO_MATRIX_FILE),
+                                             os.path.join(steps.OUTPUT_DIR, steps.GENE_MATRIX_FILE)) if os.path.exists(path)]
+    if not files:
+        raise SystemExit("No matrix files given or found in output/.")
+    for path in files:
+        start = time.perf_counter()
+        values = read_matrix_values(path)
+        if path.endswith(steps.GENE_MATRIX_FILE):
+            values.columns.name = "Sample"
+        store = matrixstore.save_store(values, path)
+        print(f"{path}: {values.shape[0]} rows × {values.shape[1]} columns → {store} ({time.perf_counter() - start:.1f} s)")
+
+
+def dtypes_command(args):
+    from methpipe.dataset import load_analysis_dataset
+
+    patient_file = next(iter(sorted(glob.glob(os.path.join(steps.DATA_DIR, "*patient*.xlsx")))), None)
+    if patient_file is None:
+        raise SystemExit(f"No *patient*.xlsx file in {steps.DATA_DIR}/.")
+    patient_ids = steps.read_patient_ids(patient_file)
+    ratio_file = steps.find_excel_file(steps.OUTPUT_DIR, "ratios_matrix")
+
+    # {policy: {row name: (frames measured together, numeric values compared or None)}}
+    results = {}
+    for name in dtypes.POLICIES:
+        with dtypes.using(name):
+            dataset = load_analysis_dataset(ratio_file, patient_ids)
+            merged = steps.read_merged_runs(steps.OUTPUT_DIR)
+            ratio = steps.scaled_ratio_matrix(merged["glob20"], merged["globmin80"])
+            rows = {
+                "cgi_matrix": ((dataset.cgi_matrix,), dataset.cgi_matrix),
+                "sample_meta": ((dataset.sample_meta,), None),
+                "collapsed": ((dataset.collapsed,), dataset.collapsed),
+                "merged runs": ((merged["glob20"], merged["globmin80"]), None),
+                "ratio matrix (step 3)": ((ratio,), ratio.iloc[:, 1:]),
+            }
+            if not args.no_gene_matrix:
+                cpg_matrix = merged["glob20"].set_index(merged["glob20"].columns[0])
+                gene_map = steps.read_table(steps.find_file(steps.OUTPUT_DIR, "cgi_map"))
+                gene_matrix = steps.gene_methylation_matrix(cpg_matrix, gene_map, progress=False)
+                rows["gene matrix (step 6)"] = ((gene_matrix,), gene_matrix)
+            results[name] = rows
+
+    rows = []
+    for name, (reference, reference_values) in results["float64"].items():
+        compacted, compacted_values = results["compact"][name]
+        diff = None if reference_values is None else dtypes.max_relative_difference(compacted_values, reference_values)
+        rows.append((name, dtypes.footprint_mb(*reference), dtypes.footprint_mb(*compacted), diff))
+
+    print(f"Dtype policies on {ratio_file} and the merged runs (tolerance {args.rtol:g})")
+    failed = dtypes.print_report(rows, args.rtol)
+    if failed:
+        raise SystemExit(f"Out of tolerance: {', '.join(failed)}")
+
+
+def serve_command(args):
+    patient_file = args.patients or next(iter(sorted(glob.glob(os.path.join(steps.DATA_DIR, "*patient*.xlsx")))), None)
+    if patient_file is None:
+        raise SystemExit(f"No *patient*.xlsx file in {steps.DATA_DIR}/ (give --patients).")
+    ratio_file = args.matrix or steps.find_excel_file(steps.OUTPUT_DIR, "ratios_matrix")
+    gene_map_file = args.gene_map or os.path.join(steps.OUTPUT_DIR, steps.GENE_MAP_FILE)
+    if not os.path.exists(gene_map_file):
+        if args.gene_map:
+            raise SystemExit(f"No gene map at {gene_map_file}.")
+        print(f"No {gene_map_file}: gene queries are disabled (run 'python -m methpipe map').")
+        gene_map_file = None
+
+    start = time.perf_counter()
+    index = service.load_index(ratio_file, steps.read_patient_ids(patient_file), gene_map_file)
+    try:
+        query_service = service.QueryService(index, memory_mb=args.memory_mb, cache_mb=args.cache_mb)
+    except MemoryError as exc:
+        raise SystemExit(str(exc))
+    print(f"Loaded {ratio_file} in {time.perf_counter() - start:.1f} s")
+    service.serve(query_service, args.listen, verbose=args.verbose)
+
+
+def queue_command(args):
+    if args.queue_command == "status":
+        workqueue.print_status(workqueue.TaskQueue(args.dir))
+    elif args.queue_command == "requeue":
+        ids = workqueue.TaskQueue(args.dir).requeue(stale=args.stale, failed=args.failed)
+        print(f"Requeued {len(ids)} task(s)")
+    elif args.queue_command == "local":
+        local_queue(args)
+    else:
+        raise SystemExit("Choose an action: status, requeue or local (see 'python -m methpipe queue -h').")
+
+
+def local_queue(args):
+    """Run the submit, work and reduce roles of a script, with ``args.hosts`` local workers."""
+    import subprocess
+
+    name, path = plot_script_path(args.script)
+    queue_dir = args.dir or os.path.join("output", workqueue.QUEUE_DIRNAME, name)
+    workqueue.TaskQueue(queue_dir).clear()
+    command = [sys.executable, path] + list(args.script_args) + ["--queue", queue_dir]
+    start = time.perf_counter()
+    if subprocess.run(command + ["--submit"]).returncode:
+        raise SystemExit(f"{name} --submit failed")
+    workers = [subprocess.Popen(command + ["--work"]) for _ in range(args.hosts)]
+    failed = sum(1 for worker in workers if worker.wait())
+    if failed:
+        raise SystemExit(f"{failed} of {args.hosts} worker(s) of {name} exited with an error")
+    if subprocess.run(command + ["--reduce"]).returncode:
+        raise SystemExit(f"{name} --reduce failed (see 'python -m methpipe queue status {queue_dir}')")
+    print(f"[queue {name}] {args.hosts} worker(s) done in {time.perf_counter() - start:.1f} s")
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return
+    if getattr(args, "metrics", None):
+        # Set before anything is measured; subprocesses of schedule inherit it
+        os.environ[metrics.METRICS_ENV] = args.metrics
+    if args.command in ("run", "schedule") and args.progress:
+        os.environ[progress.PROGRESS_ENV] = args.progress
+    if args.command in ("run", "schedule", "serve") and args.dtypes:
+        os.environ[dtypes.DTYPES_ENV] = args.dtypes
+    if args.command in ("run", "schedule") and args.store:
+        os.environ[matrixstore.STORE_ENV] = "1"
+    if args.command == "run" and args.workers:
+        os.environ[shards.WORKERS_ENV] = str(args.workers)
+    if args.command == "metrics":
+        metrics_command(args)
+        return
+    if args.command == "progress":
+        progress_command(args)
+        return
+    if args.command == "dtypes":
+        dtypes_command(args)
+        return
+    if args.command == "store":
+        store_command(args)
+        return
+    if args.command == "queue":
+        queue_command(args)
+        return
+    if args.command == "serve":
+        serve_command(args)
+        return
+    if args.command == "plot":
+        if args.list or not args.script:
+            for name, path in plot_scripts().items():
+                print(f"{name:<45} {os.path.relpath(path, os.path.dirname(SCRIPTS_DIR))}")
+            return
+        run_plot(args.script, args.script_args)
+        return
+    if args.command == "schedule":
+        schedule_command(args)
+        return
+    if args.command in STEPS:
+        Pipeline(save=[args.command]).run(args.command)
+        return
+
+    start = time.perf_counter()
+    save = set(args.save)
+    if args.steps:
+        save.add(args.steps[-1])
+    if args.save_intermediates or args.plot:
+        save.update(args.steps)
+    pipeline = Pipeline(save=save, progress=not args.no_progress)
+    for step in args.steps:
+        pipeline.run(step)
+    for spec in args.plot:
+        name, *script_args = shlex.split(spec)
+        run_plot(name, script_args)
+    for path in pipeline.written:
+        print(f"Saved {path}")
+    print(f"Finished {len(args.steps)} step(s) and {len(args.plot)} plot script(s) in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,207 @@
+import hashlib
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from methpipe import dtypes, matrixstore
+from methpipe.replicates import collapse_replicates
+
+CACHE_VERSION = "1"
+CACHE_DIRNAME = ".methpipe-cache"
+
+AnalysisDataset = namedtuple("AnalysisDataset", ["cgi_matrix", "sample_meta", "matrix", "collapsed"])
+AnalysisDataset.__doc__ = """Parsed locus-level view of a scaled ratio matrix.
+
+``cgi_matrix`` is the numeric CGI × sample table (every sample, indexed by
+``CpG_Island``), ``sample_meta`` the Sample/Patient/Timepoint table for all
+of its columns, ``matrix`` the non-Healthy samples that belong to a patient
+with (Patient, Timepoint) MultiIndex columns, and ``collapsed`` that matrix
+with replicates averaged per (Patient, Timepoint).
+"""
+
+
+def normalize_timepoint(sample):
+    if "Baseline" in sample:
+        return "Baseline"
+    elif "Off-tx" in sample:
+        return "Post-Treatment"
+    elif "INNOV" in sample:
+        return "Healthy"
+    else:
+        return "On-Treatment"
+
+
+def match_patient(sample, patient_ids):
+    return next((pid for pid in patient_ids if pid in sample), None)
+
+
+def read_matrix_file(path):
+    return pd.read_excel(path) if path.endswith(".xlsx") else pd.read_csv(path)
+
+
+def read_matrix_values(path):
+    """Numeric content of a matrix file: first column as the row labels, other cells as numbers."""
+    df = read_matrix_file(path)
+    return df.set_index(df.columns[0]).apply(pd.to_numeric, errors="coerce")
+
+
+def parse_analysis_dataset(df, patient_ids):
+    """Build an ``AnalysisDataset`` from the raw scaled-matrix sheet."""
+    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
+    cpg_df = df.iloc[start_idx:].reset_index(drop=True)
+    cpg_df = cpg_df.rename(columns={cpg_df.columns[0]: "CpG_Island"})
+    cpg_df = cpg_df.dropna(how="all", subset=cpg_df.columns[1:])
+    cgi_matrix = cpg_df.set_index("CpG_Island").apply(pd.to_numeric, errors="coerce").astype(float)
+
+    samples = cgi_matrix.columns
+    sample_meta = pd.DataFrame({
+        "Sample": samples,
+        "Patient": [match_patient(s, patient_ids) for s in samples],
+        "Timepoint": [normalize_timepoint(s) for s in samples]
+    })
+    return _assemble(cgi_matrix, sample_meta, None)
+
+
+def dataset_from_store(matrix, patient_ids):
+    """Build an ``AnalysisDataset`` from a mapped ratio matrix store (see ``methpipe.matrixstore``).
+
+    Same rows as ``parse_analysis_dataset``; ``cgi_matrix`` is a view of
+    the mapped values rather than a copy.
+    """
+    labels = matrix.rows.astype(str)
+    cgi_rows = np.flatnonzero(labels.str.contains("CGI_chr"))
+    if not len(cgi_rows):
+        raise ValueError("no CGI_chr rows in the matrix store")
+    start = cgi_rows[0]
+    values = matrix.values[start:]
+    keep = ~np.isnan(values).all(axis=1) if values.dtype.kind == "f" else np.ones(len(values), dtype=bool)
+    rows = slice(start, None) if keep.all() else start + np.flatnonzero(keep)
+    values = matrix.values[rows]
+    if matrix.header.get("order") == "F" and not values.flags.f_contiguous:
+        values = np.asfortranarray(values)  # the row selection copied: keep the store's (and a parsed frame's) layout
+    cgi_matrix = pd.DataFrame(values, index=pd.Index(labels[rows], name="CpG_Island"),
+                              columns=matrix.columns, copy=False)
+
+    samples = cgi_matrix.columns
+    sample_meta = pd.DataFrame({
+        "Sample": samples,
+        "Patient": [match_patient(s, patient_ids) for s in samples],
+        "Timepoint": [normalize_timepoint(s) for s in samples]
+    })
+    return _assemble(cgi_matrix, sample_meta, None)
+
+
+def _assemble(cgi_matrix, sample_meta, collapsed):
+    valid_samples = sample_meta.dropna()
+    valid_samples = valid_samples[valid_samples["Timepoint"] != "Healthy"]
+
+    matrix = cgi_matrix[valid_samples["Sample"].tolist()]
+    matrix.columns = pd.MultiIndex.from_frame(valid_samples[["Patient", "Timepoint"]])
+    if collapsed is None:
+        collapsed = collapse_replicates(matrix)
+    return AnalysisDataset(cgi_matrix, sample_meta, matrix, collapsed)
+
+
+def compact_dataset(dataset):
+    """``dataset`` in the dtypes of the active policy (see ``methpipe.dtypes``).
+
+    The matrices share one interned label index; the MultiIndex columns
+    already store Patient / Timepoint as codes, so only ``sample_meta``
+    becomes categorical.
+    """
+    if not dtypes.compact():
+        return dataset
+    labels = dtypes.as_label_index(dataset.cgi_matrix.index)
+    return AnalysisDataset(
+        dtypes.as_values(dataset.cgi_matrix).set_axis(labels, axis=0),
+        dtypes.as_categories(dataset.sample_meta, ["Patient", "Timepoint"]),
+        dtypes.as_values(dataset.matrix).set_axis(labels, axis=0),
+        dtypes.as_values(dataset.collapsed).set_axis(labels, axis=0),
+    )
+
+
+def dataset_key(path, patient_ids):
+    """Cache key: hash of the input file bytes plus the patient list."""
+    digest = hashlib.sha256()
+    digest.update(f"v{CACHE_VERSION}\0".encode())
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    digest.update("\0".join(patient_ids).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _str_array(values):
+    return np.array(["" if pd.isna(v) else str(v) for v in values], dtype=str)
+
+
+def save_analysis_dataset(dataset, cache_path):
+    """Write ``dataset`` as an uncompressed ``.npz`` (no pickled objects)."""
+    meta = dataset.sample_meta
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez(
+            fh,
+            cgi_labels=_str_array(dataset.cgi_matrix.index),
+            cgi_values=dataset.cgi_matrix.to_numpy(dtype=float),
+            samples=_str_array(meta["Sample"]),
+            patients=_str_array(meta["Patient"]),
+            timepoints=_str_array(meta["Timepoint"]),
+            collapsed_patients=_str_array(dataset.collapsed.columns.get_level_values(0)),
+            collapsed_timepoints=_str_array(dataset.collapsed.columns.get_level_values(1)),
+            collapsed_values=dataset.collapsed.to_numpy(dtype=float),
+        )
+    os.replace(tmp_path, cache_path)
+
+
+def read_analysis_dataset(cache_path):
+    """Load a dataset written by ``save_analysis_dataset``."""
+    with np.load(cache_path, allow_pickle=False) as npz:
+        labels = pd.Index(npz["cgi_labels"].tolist(), name="CpG_Island")
+        cgi_matrix = pd.DataFrame(npz["cgi_values"], index=labels, columns=npz["samples"].tolist())
+        sample_meta = pd.DataFrame({
+            "Sample": npz["samples"].tolist(),
+            "Patient": [p or None for p in npz["patients"].tolist()],
+            "Timepoint": npz["timepoints"].tolist(),
+        })
+        columns = pd.MultiIndex.from_arrays(
+            [npz["collapsed_patients"].tolist(), npz["collapsed_timepoints"].tolist()],
+            names=["Patient", "Timepoint"],
+        )
+        collapsed = pd.DataFrame(npz["collapsed_values"], index=labels, columns=columns)
+    return _assemble(cgi_matrix, sample_meta, collapsed)
+
+
+def load_analysis_dataset(path, patient_ids, cache_dir=None, use_cache=True):
+    """Parsed ``AnalysisDataset`` for the matrix file at ``path``.
+
+    The first call parses the workbook and stores the result under
+    ``cache_dir`` (default: a ``.methpipe-cache`` folder next to the input);
+    later calls with the same file contents and patient list load the
+    binary copy instead of re-reading the workbook. The cache always holds
+    float64 values; the dataset is returned in the active dtype policy.
+    An up-to-date matrix store of ``path`` is mapped instead (copy-on-write,
+    so ``cgi_matrix`` is shared with other processes reading the store).
+    """
+    patient_ids = [str(p) for p in patient_ids]
+    store = matrixstore.fresh_store(path)
+    if store is not None:
+        return compact_dataset(dataset_from_store(matrixstore.open_matrix(store, mmap_mode="c"), patient_ids))
+    if not use_cache:
+        return compact_dataset(parse_analysis_dataset(read_matrix_file(path), patient_ids))
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRNAME)
+    base = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f"{base}.{dataset_key(path, patient_ids)[:16]}.npz")
+    if os.path.exists(cache_path):
+        try:
+            return compact_dataset(read_analysis_dataset(cache_path))
+        except (OSError, ValueError, KeyError):
+            pass  # unreadable or outdated cache entry: rebuild it below
+
+    dataset = parse_analysis_dataset(read_matrix_file(path), patient_ids)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_analysis_dataset(dataset, cache_path)
+    return compact_dataset(dataset)
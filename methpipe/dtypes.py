@@ -0,0 +1,189 @@
+"""Dtype policy for the matrices, sample metadata and CGI labels.
+
+The default policy (``float64``) keeps pandas' own dtypes. With
+``METHPIPE_DTYPES=compact`` (or ``--dtypes compact`` on ``python -m methpipe
+run``/``schedule``):
+
+- ratio and averaged matrices are stored as float32;
+- raw fragment counts (Glob20 / GlobMin80 CGI rows) as uint32 when every
+  value is a non-negative integer, otherwise float32;
+- the Patient / Timepoint columns of sample metadata as categoricals;
+- CGI labels as interned strings, so the label columns of the run, merged
+  and ratio frames (and the dataset indexes) share one object per label.
+
+Sums and means are still computed in float64 (``collapse_values``, the
+t-tests) and only their results are stored compactly. ``python -m methpipe
+dtypes`` reports the memory of both policies on the current ``output/``
+files and checks that the compact results stay within ``RTOL`` of float64.
+"""
+import os
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+DTYPES_ENV = "METHPIPE_DTYPES"
+POLICIES = ("float64", "compact")
+# float32 has a 24-bit mantissa (~6e-8 relative rounding error); sums over a few
+# hundred CGIs stay far below this
+RTOL = 1e-5
+UINT32_MAX = np.iinfo(np.uint32).max
+
+
+def policy():
+    """The active policy: ``"compact"`` or ``"float64"`` (the default)."""
+    value = (os.environ.get(DTYPES_ENV) or "float64").strip().lower()
+    if value not in POLICIES:
+        raise ValueError(f"{DTYPES_ENV}={value!r}; choose from {', '.join(POLICIES)}")
+    return value
+
+
+def compact():
+    return policy() == "compact"
+
+
+@contextmanager
+def using(name):
+    """Switch to policy ``name`` for the ``with`` block."""
+    if name not in POLICIES:
+        raise ValueError(f"unknown dtype policy {name!r}; choose from {', '.join(POLICIES)}")
+    saved = os.environ.get(DTYPES_ENV)
+    os.environ[DTYPES_ENV] = name
+    try:
+        yield
+    finally:
+        if saved is None:
+            del os.environ[DTYPES_ENV]
+        else:
+            os.environ[DTYPES_ENV] = saved
+
+
+def float_dtype():
+    """Dtype of ratio and averaged matrices under the active policy."""
+    return np.float32 if compact() else float
+
+
+def as_values(df):
+    """``df`` as floats of the active policy (ratio and averaged matrices)."""
+    return df.astype(float_dtype()) if compact() else df
+
+
+def as_counts(df):
+    """``df`` as uint32 (non-negative integer counts) or float32 under the compact policy.
+
+    Object columns (as read from the workbooks) are converted with
+    ``pd.to_numeric``; pass only the CGI rows, not the ``Info_*`` rows.
+    """
+    if not compact():
+        return df
+    values = df.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    finite = np.isfinite(values)
+    if finite.all() and (values >= 0).all() and (values <= UINT32_MAX).all() and (values == np.round(values)).all():
+        values = values.astype(np.uint32)
+    else:
+        values = values.astype(np.float32)
+    return pd.DataFrame(values, index=df.index, columns=df.columns)
+
+
+def intern_labels(values):
+    """Interned copies of string labels (non-strings are left as they are)."""
+    return [sys.intern(v) if isinstance(v, str) else v for v in values]
+
+
+def as_labels(df, column=0):
+    """``df`` with its label column (position ``column``) interned under the compact policy."""
+    if not compact():
+        return df
+    df = df.copy(deep=False)
+    df.isetitem(column, intern_labels(df.iloc[:, column]))
+    return df
+
+
+def as_label_index(index):
+    return pd.Index(intern_labels(index), name=index.name) if compact() else index
+
+
+def as_categories(df, columns):
+    """``df`` with ``columns`` as pandas categoricals under the compact policy."""
+    if not compact():
+        return df
+    return df.astype({column: "category" for column in columns})
+
+
+# === Reports ===
+
+def footprint_mb(*frames):
+    """Memory of DataFrames together, in MB.
+
+    Unlike ``memory_usage(deep=True)``, a Python object referenced from
+    several cells or frames (an interned label, a category) is counted
+    once, so the saving of interning shows.
+    """
+    seen = set()
+    total = 0
+
+    def add_objects(values):
+        nonlocal total
+        for value in values:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+
+    def add_array(values):
+        nonlocal total
+        if isinstance(values, pd.MultiIndex):
+            total += sum(codes.nbytes for codes in values.codes)
+            for level in values.levels:
+                add_array(level)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            total += values.cat.codes.nbytes if isinstance(values, pd.Series) else values.codes.nbytes
+            add_array(values.cat.categories if isinstance(values, pd.Series) else values.categories)
+        else:
+            array = values.to_numpy()
+            total += array.nbytes
+            if array.dtype == object:
+                add_objects(array)
+
+    for frame in frames:
+        add_array(frame.index)
+        if isinstance(frame, pd.DataFrame):
+            add_array(frame.columns)
+            for i in range(frame.shape[1]):
+                add_array(frame.iloc[:, i])
+        else:
+            add_array(frame)
+    return total / 2 ** 20
+
+
+def max_relative_difference(compact_values, reference):
+    """Largest ``|a - b| / max(|b|, 1)`` over the values that are finite in both."""
+    a = np.asarray(compact_values, dtype=float)
+    b = np.asarray(reference, dtype=float)
+    if a.shape != b.shape:
+        raise ValueError(f"shape {a.shape} != {b.shape}")
+    if (np.isnan(a) != np.isnan(b)).any():
+        return np.inf
+    both = np.isfinite(a) & np.isfinite(b)
+    if not both.any():
+        return 0.0
+    return float(np.max(np.abs(a[both] - b[both]) / np.maximum(np.abs(b[both]), 1.0)))
+
+
+def print_report(rows, rtol=RTOL, echo=print):
+    """Print ``[(name, float64 MB, compact MB, max relative difference)]``; returns the rows out of tolerance."""
+    width = max([len(name) for name, *_ in rows] + [5])
+    echo(f"  {'frame':<{width}}  {'float64 MB':>10}  {'compact MB':>10}  {'saved':>6}  {'max rel diff':>12}")
+    failed = []
+    for name, before, after, diff in rows:
+        saved = 1 - after / before if before else 0.0
+        flag = ""
+        if diff is not None and diff > rtol:
+            flag = "  ❌ out of tolerance"
+            failed.append(name)
+        diff_text = f"{diff:>12.2e}" if diff is not None else f"{'-':>12}"
+        echo(f"  {name:<{width}}  {before:>10.2f}  {after:>10.2f}  {saved:>6.0%}  {diff_text}{flag}")
+    total_before = sum(row[1] for row in rows)
+    total_after = sum(row[2] for row in rows)
+    echo(f"  {'total':<{width}}  {total_before:>10.2f}  {total_after:>10.2f}  {1 - total_after / total_before if total_before else 0:>6.0%}")
+    return failed
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+FIGURE_CACHE_VERSION = "1"
+FIGURE_CACHE_DIR = os.path.join("plots", ".figure-cache")
+MANIFEST_NAME = "manifest.json"
+
+
+def _feed(digest, part):
+    """Add ``part`` (arrays, frames, containers or scalars) to ``digest``."""
+    if isinstance(part, pd.DataFrame):
+        digest.update(b"frame")
+        _feed(digest, part.index)
+        _feed(digest, part.columns)
+        for _, column in part.items():
+            _feed(digest, column)
+    elif isinstance(part, (pd.Series, pd.Index)):
+        digest.update(b"series" if isinstance(part, pd.Series) else b"index")
+        _feed(digest, [part.name] if not isinstance(part, pd.MultiIndex) else list(part.names))
+        if isinstance(part, pd.Series):
+            _feed(digest, part.index)
+        if isinstance(part.dtype, pd.CategoricalDtype):
+            _feed(digest, list(part.dtype.categories))
+            _feed(digest, part.dtype.ordered)
+            _feed(digest, np.asarray(part.cat.codes if isinstance(part, pd.Series) else part.codes))
+        else:
+            _feed(digest, part.to_numpy() if not isinstance(part, pd.MultiIndex) else list(part))
+    elif isinstance(part, np.ndarray):
+        digest.update(f"array{part.dtype.str}{part.shape}".encode())
+        if part.dtype.kind in "biufcmM":
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part.tolist()).encode("utf-8"))
+    elif isinstance(part, (list, tuple)):
+        digest.update(f"seq{len(part)}[".encode())
+        for item in part:
+            _feed(digest, item)
+        digest.update(b"]")
+    elif isinstance(part, dict):
+        _feed(digest, sorted((repr(k), v) for k, v in part.items()))
+    else:
+        digest.update(f"{type(part).__name__}:{part!r}\0".encode("utf-8"))
+
+
+def figure_key(*parts):
+    """Content hash of a figure's data slice and render parameters."""
+    digest = hashlib.sha256()
+    digest.update(f"v{FIGURE_CACHE_VERSION}\0".encode())
+    for part in parts:
+        _feed(digest, part)
+    return digest.hexdigest()
+
+
+# methpipe modules whose code draws or saves the cached figures
+RENDER_MODULES = ("archive.py", "bubbleplot.py", "figcache.py", "headless.py", "slopeplot.py")
+RENDER_PACKAGES = ("matplotlib", "seaborn")
+
+
+def _package_version(name):
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "none"
+
+
+def script_salt(path):
+    """Salt for a plotting script: its source, the methpipe rendering code and the plotting library versions.
+
+    Editing the script (layout, styling, savefig options), one of the
+    ``RENDER_MODULES`` or upgrading matplotlib or seaborn therefore
+    invalidates the figures it cached.
+    """
+    digest = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for source in [path] + [os.path.join(package_dir, name) for name in RENDER_MODULES]:
+        with open(source, "rb") as fh:
+            digest.update(fh.read())
+        digest.update(b"\0")
+    for name in RENDER_PACKAGES:
+        digest.update(f"{name}={_package_version(name)}\0".encode())
+    return digest.hexdigest()
+
+
+def figure_cache_enabled():
+    """``False`` when ``METHPIPE_FIGURE_CACHE`` is set to ``0``/``off``/``no``."""
+    return os.environ.get("METHPIPE_FIGURE_CACHE", "1").strip().lower() not in ("0", "off", "no", "false")
+
+
+class FigureCache:
+    """Content-hash cache of rendered figures with a manifest.
+
+    A figure's key hashes the exact data slice it shows plus its render
+    parameters (and the script ``salt``). ``fetch`` returns the stored
+    bytes when the key is known and only calls ``render`` otherwise, so a
+    rerun after adding one patient re-renders just the figures whose
+    inputs changed. Blobs live under ``cache_dir`` as ``<key><ext>``;
+    ``manifest.json`` records every key with the file name it was last
+    produced for.
+
+    Worker processes can share a cache directory: each keeps the entries
+    it added in ``added`` and the parent folds them in with ``merge``
+    before calling ``save``.
+    """
+
+    def __init__(self, cache_dir=FIGURE_CACHE_DIR, salt="", enabled=None):
+        self.cache_dir = cache_dir
+        self.salt = salt
+        self.enabled = figure_cache_enabled() if enabled is None else enabled
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        self.entries = self._read_manifest() if self.enabled else {}
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        return figure_key(self.salt, *parts)
+
+    def fetch(self, key, names, render):
+        """``[(name, bytes), ...]`` for ``names``, from the cache or from ``render()``.
+
+        ``render`` is called on a miss and must return the bytes of every
+        name in the same order.
+        """
+        if self.enabled:
+            cached = self._read(key, names)
+            if cached is not None:
+                self.hits += 1
+                self._record(key, names)
+                return list(zip(names, cached))
+        self.misses += 1
+        blobs = list(render())
+        if self.enabled:
+            for name, data in zip(names, blobs):
+                self._write_blob(self._blob_path(key, name), data)
+            self._record(key, names)
+        return list(zip(names, blobs))
+
+    def fetch_file(self, key, path, render):
+        """Like ``fetch`` for a single figure that is written to ``path`` on disk."""
+        ((_, data),) = self.fetch(key, [os.path.basename(path)], lambda: [render()])
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return data
+
+    def take_added(self):
+        added, self.added = self.added, {}
+        return added
+
+    def merge(self, added):
+        self.entries.update(added)
+
+    def save(self):
+        """Write the manifest (merged with entries other runs wrote meanwhile)."""
+        if not self.enabled:
+            return
+        self.merge(self.take_added())
+        entries = self._read_manifest()
+        entries.update(self.entries)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        payload = {"version": FIGURE_CACHE_VERSION, "figures": entries}
+        self._write_blob(self.manifest_path, json.dumps(payload, indent=1, sort_keys=True).encode("utf-8"))
+
+    def summary(self):
+        return f"{self.hits} figure(s) reused from cache, {self.misses} rendered"
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, encoding="utf-8") as fh:
+                payload = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if payload.get("version") != FIGURE_CACHE_VERSION:
+            return {}
+        return payload.get("figures", {})
+
+    def _record(self, key, names):
+        entry = {"files": list(names), "updated": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        self.entries[key] = entry
+        self.added[key] = entry
+
+    def _blob_path(self, key, name):
+        return os.path.join(self.cache_dir, key[:2], key + os.path.splitext(name)[1].lower())
+
+    def _read(self, key, names):
+        if key not in self.entries:
+            return None
+        blobs = []
+        for name in names:
+            try:
+                with open(self._blob_path(key, name), "rb") as fh:
+                    blobs.append(fh.read())
+            except OSError:
+                return None
+        return blobs
+
+    def _write_blob(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
@@ -0,0 +1,148 @@
+"""Inverted gene → matrix row index in CSR form, persisted next to the matrix.
+
+Step 6 and the gene-level locus scripts give a gene every CGI row whose label
+contains the gene name (``gene in label``), which scans every label for every
+gene map row on each run. ``build_gene_index`` does that matching once for a
+matrix's row labels and a gene map's gene names and keeps the result as a
+``GeneIndex``:
+
+- ``genes``: the matched gene names, in order of first appearance in the map;
+- ``indptr`` / ``indices``: the CSR arrays; the rows of ``genes[i]`` are
+  ``indices[indptr[i]:indptr[i + 1]]`` (ascending row positions);
+- ``map_counts``: how many gene map rows name each gene.
+
+``gene_index(labels, gene_names, matrix_path)`` loads the index saved for
+exactly these labels and gene names from
+``.methpipe-store/<matrix file>.genes/<key>.npz`` next to the matrix, or builds
+and saves it, so reading a gene is a row gather
+(``matrix.iloc[index.rows(gene)]``) instead of a string match.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from methpipe import matrixstore
+
+INDEX_VERSION = "1"
+
+
+class GeneIndex:
+    """Row positions of each gene's CGIs, in CSR form (see the module docstring)."""
+
+    def __init__(self, genes, indptr, indices, map_counts):
+        self.genes = list(genes)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.map_counts = np.asarray(map_counts, dtype=np.int64)
+        self.positions = {gene: i for i, gene in enumerate(self.genes)}
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __contains__(self, gene):
+        return gene in self.positions
+
+    def rows(self, gene):
+        """Ascending row positions of the CGIs of ``gene`` (a view of ``indices``)."""
+        i = self.positions[gene]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def row_counts(self):
+        return np.diff(self.indptr)
+
+    def match_counts(self):
+        """(gene map row, CGI row) matches per gene, ordered like ``value_counts`` of the step-6 match table."""
+        counts = pd.Series(self.map_counts * self.row_counts(), index=pd.Index(self.genes, name="gene_name"), name="count")
+        return counts.sort_values(ascending=False, kind="stable")
+
+
+def _gene_names(gene_names):
+    names = pd.Series(gene_names)
+    return names[names.notna()].astype(str).tolist()
+
+
+def build_gene_index(labels, gene_names):
+    """``GeneIndex`` of the row ``labels`` that contain each of ``gene_names`` (missing names are skipped).
+
+    The labels are joined into one newline-separated string that every gene
+    name is searched in; a hit's offset gives its row.
+    """
+    labels = [str(label) for label in labels]
+    if any("\n" in label for label in labels):
+        raise ValueError("row labels contain line breaks")
+    text = "\n".join(labels)
+    offsets = np.cumsum([0] + [len(label) + 1 for label in labels[:-1]]) if labels else np.zeros(0, dtype=np.int64)
+
+    genes, indptr, indices, map_counts = [], [0], [], []
+    for gene, count in pd.Series(_gene_names(gene_names), dtype=object).value_counts(sort=False).items():
+        if not gene:
+            rows = np.arange(len(labels))
+        else:
+            hits = []
+            at = text.find(gene)
+            while at != -1:
+                hits.append(at)
+                at = text.find(gene, at + 1)
+            rows = np.unique(np.searchsorted(offsets, hits, side="right") - 1) if hits else ()
+        if len(rows):
+            genes.append(gene)
+            indices.append(rows)
+            indptr.append(indptr[-1] + len(rows))
+            map_counts.append(count)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    return GeneIndex(genes, indptr, indices, map_counts)
+
+
+def index_key(labels, gene_names):
+    """Hash of the row labels and gene names an index is built from."""
+    digest = hashlib.sha256()
+    digest.update(f"v{INDEX_VERSION}\0".encode())
+    digest.update("\n".join(str(label) for label in labels).encode("utf-8"))
+    digest.update(b"\0\0")
+    digest.update("\n".join(gene_names).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def index_path(matrix_path, key):
+    """File of the index with ``key`` for the matrix file ``matrix_path``."""
+    return os.path.join(f"{matrixstore.store_path(matrix_path)}.genes", f"{key[:16]}.npz")
+
+
+def save_gene_index(index, path):
+    """Write ``index`` as an uncompressed ``.npz`` (no pickled objects)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez(fh, genes=np.array(index.genes, dtype=str), indptr=index.indptr,
+                 indices=index.indices, map_counts=index.map_counts)
+    os.replace(tmp_path, path)
+
+
+def read_gene_index(path):
+    """Load an index written by ``save_gene_index``."""
+    with np.load(path, allow_pickle=False) as npz:
+        return GeneIndex(npz["genes"].tolist(), npz["indptr"], npz["indices"], npz["map_counts"])
+
+
+def gene_index(labels, gene_names, matrix_path=None):
+    """``GeneIndex`` of the row ``labels`` of a matrix and the ``gene_names`` column of a gene map.
+
+    With ``matrix_path`` the index is read from (or saved to) the index
+    folder of that file; the file name is a hash of the labels and gene
+    names, so an index is only reused for the same inputs.
+    """
+    labels = [str(label) for label in labels]
+    gene_names = _gene_names(gene_names)
+    if matrix_path is None:
+        return build_gene_index(labels, gene_names)
+    path = index_path(matrix_path, index_key(labels, gene_names))
+    if os.path.exists(path):
+        try:
+            return read_gene_index(path)
+        except (OSError, ValueError, KeyError):
+            pass  # unreadable index: rebuild it below
+    index = build_gene_index(labels, gene_names)
+    save_gene_index(index, path)
+    return index
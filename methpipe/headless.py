@@ -0,0 +1,56 @@
+import importlib
+import os
+import sys
+
+# The scripts save their figures to files and never show them, so pyplot needs no interactive backend.
+# Setting MPLBACKEND before matplotlib is imported skips backend detection entirely.
+os.environ["MPLBACKEND"] = "Agg"
+if "matplotlib" in sys.modules:
+    sys.modules["matplotlib"].use("Agg")
+
+
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access.
+
+    ``sns = LazyModule("seaborn")`` costs nothing at startup; the first
+    ``sns.heatmap(...)`` imports seaborn and later accesses go straight to
+    the real module.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module {self.__dict__['_name']!r} ({state})>"
+
+
+def lazy_function(module_name, function_name):
+    """``function_name`` from ``module_name``, imported on the first call."""
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), function_name)(*args, **kwargs)
+    call.__name__ = call.__qualname__ = function_name
+    call.__doc__ = f"Lazy ``{module_name}.{function_name}``."
+    return call
+
+
+plt = LazyModule("matplotlib.pyplot")
+sns = LazyModule("seaborn")
+ttest_rel = lazy_function("scipy.stats", "ttest_rel")
@@ -0,0 +1,171 @@
+"""Memory-mapped copies of the matrix files for zero-copy reads.
+
+``write_store`` saves a numeric matrix (the gene methylation matrix, the
+scaled ratio matrix) as a folder of plain files:
+
+- ``values.npy``: the values as one (rows × columns) array, opened with
+  ``np.load(mmap_mode=...)``. ``write_store`` defaults to C order (a few
+  rows only read those pages); ``save_store``, which writes the pipeline's
+  stores, uses column-major order like a frame parsed from the file, so a
+  sample column reads contiguous pages;
+- ``rows.txt`` / ``columns.txt``: the row and column labels, one per line;
+- ``header.json``: format version, shape, dtype, order, the index and
+  column names, and the size and mtime of the source file it was made from.
+
+A store lives in ``.methpipe-store/<file name>/`` next to its source file
+(``output/.methpipe-store/gene_methylation_matrix.csv/``), so the scripts'
+``*matrix*`` file lookups never see it. ``open_matrix`` maps a store;
+``fresh_store`` returns a source file's store only while the source is
+unchanged, and the pipeline readers (``load_analysis_dataset``,
+``steps.read_gene_matrix``) use it instead of parsing the file.
+
+Set ``METHPIPE_MATRIX_STORE=1`` (``--store`` on ``python -m methpipe
+run``/``schedule``) to have steps 3 and 6 write the stores of their
+matrices, or convert existing files:
+
+    python -m methpipe store output/gene_methylation_matrix.csv output/scaled_fragment_ratios_matrix.xlsx
+"""
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+STORE_ENV = "METHPIPE_MATRIX_STORE"
+FORMAT = "methpipe-matrix"
+FORMAT_VERSION = 1
+STORE_DIRNAME = ".methpipe-store"
+
+MappedMatrix = namedtuple("MappedMatrix", ["values", "rows", "columns", "header"])
+MappedMatrix.__doc__ = """A matrix store opened with ``open_matrix``.
+
+``values`` is the ``np.memmap`` of ``values.npy``, ``rows`` and ``columns``
+the label Indexes (named as in the header) and ``header`` the parsed
+``header.json``. ``as_frame(matrix)`` wraps it in a DataFrame without copying.
+"""
+
+
+def enabled():
+    """Whether the steps should also write stores of their matrices (``METHPIPE_MATRIX_STORE=1``)."""
+    return (os.environ.get(STORE_ENV) or "0").strip().lower() not in ("", "0", "false", "no")
+
+
+def store_path(source):
+    """Folder of the store made from the file ``source``."""
+    return os.path.join(os.path.dirname(os.path.abspath(source)), STORE_DIRNAME, os.path.basename(source))
+
+
+def _source_stamp(source):
+    stat = os.stat(source)
+    return {"path": os.path.basename(source), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _write_labels(path, labels):
+    labels = ["" if pd.isna(label) else str(label) for label in labels]
+    if any("\n" in label for label in labels):
+        raise ValueError(f"labels for {path} contain line breaks")
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write("".join(label + "\n" for label in labels))
+
+
+def _read_labels(path, name):
+    with open(path, encoding="utf-8") as fh:
+        return pd.Index(fh.read().split("\n")[:-1], name=name)
+
+
+def write_store(frame, path, source=None, dtype=None, order="C"):
+    """Write the numeric DataFrame ``frame`` as a store folder at ``path``.
+
+    ``source`` is the file the frame was read from (recorded so that readers
+    can tell when the store is out of date); ``dtype`` defaults to the
+    frame's own (float64 when its columns differ). The folder is written
+    next to ``path`` and renamed into place.
+    """
+    values = frame.to_numpy(dtype=dtype)
+    if values.dtype == object:
+        raise ValueError("only numeric matrices can be stored")
+    values = np.asfortranarray(values) if order == "F" else np.ascontiguousarray(values)
+    header = {
+        "format": FORMAT,
+        "version": FORMAT_VERSION,
+        "shape": list(values.shape),
+        "dtype": values.dtype.str,
+        "order": order,
+        "row_name": frame.index.name,
+        "column_name": frame.columns.name,
+        "source": _source_stamp(source) if source else None,
+    }
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "values.npy"), values)
+    _write_labels(os.path.join(tmp_path, "rows.txt"), frame.index)
+    _write_labels(os.path.join(tmp_path, "columns.txt"), frame.columns)
+    with open(os.path.join(tmp_path, "header.json"), "w", encoding="utf-8") as fh:
+        json.dump(header, fh, indent=1)
+    if os.path.isdir(path):
+        old_path = f"{path}.{os.getpid()}.old"
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        for name in os.listdir(old_path):
+            os.remove(os.path.join(old_path, name))
+        os.rmdir(old_path)
+    else:
+        os.replace(tmp_path, path)
+    return path
+
+
+def open_matrix(path, mmap_mode="r"):
+    """Map the store folder ``path``; values are read from disk only when touched.
+
+    ``mmap_mode="c"`` (copy-on-write) lets callers modify the returned
+    arrays in memory without ever writing to the file.
+    """
+    with open(os.path.join(path, "header.json"), encoding="utf-8") as fh:
+        header = json.load(fh)
+    if header.get("format") != FORMAT or header.get("version") != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} {FORMAT} store")
+    values = np.load(os.path.join(path, "values.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+    rows = _read_labels(os.path.join(path, "rows.txt"), header["row_name"])
+    columns = _read_labels(os.path.join(path, "columns.txt"), header["column_name"])
+    if values.shape != (len(rows), len(columns)):
+        raise ValueError(f"{path}: values {values.shape} do not match {len(rows)} row and {len(columns)} column labels")
+    return MappedMatrix(values, rows, columns, header)
+
+
+def as_frame(matrix, rows=None):
+    """DataFrame view of a ``MappedMatrix`` (no copy); ``rows`` (positions or a slice) selects rows first.
+
+    A slice keeps the view; an array of positions copies just those rows.
+    """
+    values, labels = matrix.values, matrix.rows
+    if rows is not None:
+        values, labels = values[rows], labels[rows]
+    return pd.DataFrame(values, index=labels, columns=matrix.columns, copy=False)
+
+
+def fresh_store(source):
+    """The store folder of ``source`` if it exists and was made from the current file, else ``None``."""
+    path = store_path(source)
+    try:
+        with open(os.path.join(path, "header.json"), encoding="utf-8") as fh:
+            recorded = json.load(fh).get("source")
+    except (OSError, ValueError):
+        return None
+    if not recorded or recorded != _source_stamp(source):
+        return None
+    return path
+
+
+def save_store(frame, source, dtype=None):
+    """Write ``frame`` (the numeric content of the file ``source``) as the store of ``source``.
+
+    The values are written column-major (``order="F"``): a frame mapped
+    from the store then has the same memory layout as one parsed from the
+    file, so column reductions add in the same order and give the same
+    floats whether or not a store was used.
+    """
+    path = store_path(source)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return write_store(frame, path, source=source, dtype=dtype, order="F")
@@ -0,0 +1,277 @@
+"""Per-stage timing and memory metrics for the steps and plotting scripts.
+
+Every step and plot script marks its stages (``load``, ``filter``,
+``align``, ``ratio``, ``match``, ``aggregate``, ``stats``, ``render``,
+``archive``). Nothing is measured unless ``METHPIPE_METRICS`` names a JSONL
+file; then every finished stage appends one record to it with the wall
+time, CPU time and peak RSS of the stage (where there is no ``/proc`` to
+sample, ``rss_mb`` and ``peak_rss_mb`` are empty and ``process_peak_rss_mb``
+holds the peak of the whole process so far), and the process prints a summary
+table when it exits. Set ``METHPIPE_TRACEMALLOC=N`` as well to add the
+``N`` source lines that allocated the most memory during each stage (this
+slows the run down noticeably).
+
+Script code marks stages with ``begin(name)`` (the stage lasts until the
+next ``begin``, ``end()`` or the end of the process); a function that is
+one stage uses ``with stage(name):``. Stages are not meant to be nested.
+
+    METHPIPE_METRICS=output/metrics.jsonl python scripts/locus/top10dm-plots_using-map_v4.py
+    METHPIPE_METRICS=output/metrics.jsonl python -m methpipe schedule
+    python -m methpipe metrics output/metrics.jsonl
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+METRICS_ENV = "METHPIPE_METRICS"
+TRACEMALLOC_ENV = "METHPIPE_TRACEMALLOC"
+STAGES = ("load", "filter", "align", "ratio", "match", "aggregate", "stats", "render", "archive")
+RSS_SAMPLE_SECONDS = 0.005
+
+
+def metrics_path():
+    return os.environ.get(METRICS_ENV) or None
+
+
+def script_name():
+    """Name of the running script (``methpipe`` for ``python -m methpipe``)."""
+    name = os.path.splitext(os.path.basename(sys.argv[0] if sys.argv and sys.argv[0] else "python"))[0]
+    return "methpipe" if name == "__main__" else name
+
+
+def maxrss_mb(usage):
+    """``ru_maxrss`` of a ``resource.getrusage``/``os.wait4`` result in MB (kilobytes on Linux, bytes on macOS)."""
+    return usage.ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 1024)
+
+
+def _current_rss_mb():
+    """Current RSS from ``/proc``, or ``None`` where there is no ``/proc`` (macOS, Windows)."""
+    try:
+        with open("/proc/self/statm", "rb") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _process_peak_rss_mb():
+    """Highest RSS of the process since it started, or ``None`` without ``resource``."""
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    return maxrss_mb(resource.getrusage(resource.RUSAGE_SELF))
+
+
+class _RssSampler:
+    """Background thread that tracks the highest RSS seen since ``reset``."""
+
+    def __init__(self, interval=RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self.peak = 0.0
+        self._thread = None
+        self._pid = None
+
+    def reset(self):
+        self.peak = _current_rss_mb()
+        if self.peak is None:
+            return  # nothing to sample without /proc
+        if self._pid != os.getpid():
+            # First use in this process (threads do not survive a fork)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="methpipe-rss-sampler", daemon=True)
+            self._thread.start()
+
+    def sample(self):
+        rss = _current_rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak or 0.0, rss)
+        return self.peak
+
+    def _run(self):
+        while True:
+            self.sample()
+            time.sleep(self.interval)
+
+
+class Recorder:
+    """Measures stages and appends their records to a JSONL file."""
+
+    def __init__(self, path, top_allocations=0):
+        self.path = path
+        self.top_allocations = top_allocations
+        self._sampler = _RssSampler()
+        self._open = None
+        self._pid = os.getpid()
+        self._offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if top_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self, name, fields):
+        self.finish()
+        self._sampler.reset()
+        snapshot = None
+        if self.top_allocations:
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        self._open = (name, fields, time.perf_counter(), time.process_time(), snapshot)
+
+    def finish(self):
+        if self._open is None:
+            return
+        name, fields, wall_start, cpu_start, snapshot = self._open
+        self._open = None
+        record = {
+            "script": script_name(),
+            "pid": os.getpid(),
+            "ppid": os.getppid(),
+            "stage": name,
+            "wall_s": round(time.perf_counter() - wall_start, 4),
+            "cpu_s": round(time.process_time() - cpu_start, 4),
+            "peak_rss_mb": None,
+            "rss_mb": None,
+        }
+        peak, rss = self._sampler.sample(), _current_rss_mb()
+        if peak is not None and rss is not None:
+            record["peak_rss_mb"], record["rss_mb"] = round(peak, 1), round(rss, 1)
+        else:
+            # Without /proc only the peak of the whole process so far is known, not the stage's
+            process_peak = _process_peak_rss_mb()
+            record["process_peak_rss_mb"] = None if process_peak is None else round(process_peak, 1)
+        record.update(fields)
+        if snapshot is not None:
+            record["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            record["top_allocations"] = top_allocations(snapshot, self.top_allocations)
+        record["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # One write() per record in append mode, so processes writing the same file do not interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.finish()
+        if os.getpid() != self._pid or not os.path.exists(self.path):
+            return
+        # This process's records plus those of its worker processes (multiprocessing pools)
+        records = [r for r in read_records(self.path, self._offset) if self._pid in (r["pid"], r.get("ppid"))]
+        if records:
+            print_summary(records, title=f"Stage metrics ({script_name()}, written to {self.path})")
+
+
+def top_allocations(before, limit):
+    """The ``limit`` source lines whose allocations grew the most since snapshot ``before``."""
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"))
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+    stats = after.compare_to(before.filter_traces(ignore), "lineno")
+    return [{"where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+             "size_kb": round(stat.size_diff / 1024, 1), "count": stat.count_diff}
+            for stat in sorted(stats, key=lambda s: -s.size_diff)[:limit] if stat.size_diff > 0]
+
+
+_recorder = None
+
+
+def _forget_parent_stage():
+    # A forked worker must not finish (and record) the stage its parent had open
+    if _recorder is not None:
+        _recorder._open = None
+
+
+os.register_at_fork(after_in_child=_forget_parent_stage)
+
+
+def recorder():
+    """The process's ``Recorder``, or ``None`` when ``METHPIPE_METRICS`` is unset."""
+    global _recorder
+    path = metrics_path()
+    if path is None:
+        return None
+    if _recorder is None or _recorder.path != path:
+        try:
+            top = int(os.environ.get(TRACEMALLOC_ENV) or 0)
+        except ValueError:
+            top = 0
+        _recorder = Recorder(path, top)
+        atexit.register(_recorder.close)
+    return _recorder
+
+
+def begin(name, **fields):
+    """Start stage ``name``; it runs until the next ``begin``, ``end()`` or process exit."""
+    rec = recorder()
+    if rec is not None:
+        rec.start(name, fields)
+
+
+def end():
+    """Finish the stage started with ``begin``."""
+    if _recorder is not None:
+        _recorder.finish()
+
+
+@contextmanager
+def stage(name, **fields):
+    """Measure the ``with`` block as stage ``name`` (extra ``fields`` go into its record)."""
+    rec = recorder()
+    if rec is None:
+        yield
+        return
+    rec.start(name, fields)
+    try:
+        yield
+    finally:
+        rec.finish()
+
+
+# === Reports ===
+
+def read_records(path, offset=0):
+    """Records of the JSONL file ``path``, from byte ``offset`` on."""
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        return [json.loads(line) for line in fh.read().decode("utf-8").splitlines() if line.strip()]
+
+
+def summarize(records):
+    """``{(script, stage): {"calls", "wall_s", "cpu_s", "peak_rss_mb"}}`` in first-seen order.
+
+    ``peak_rss_mb`` is ``None`` when no record of the stage has a per-stage peak.
+    """
+    summary = {}
+    for record in records:
+        row = summary.setdefault((record["script"], record["stage"]),
+                                 {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": None})
+        row["calls"] += 1
+        row["wall_s"] += record["wall_s"]
+        row["cpu_s"] += record["cpu_s"]
+        if record.get("peak_rss_mb") is not None:
+            row["peak_rss_mb"] = max(row["peak_rss_mb"] or 0.0, record["peak_rss_mb"])
+    return summary
+
+
+def print_summary(records, title="Stage metrics", echo=print):
+    summary = summarize(records)
+    total_wall = sum(row["wall_s"] for row in summary.values()) or 1.0
+    width = max([len(script) for script, _ in summary] + [6])
+    echo(title)
+    echo(f"  {'script':<{width}}  {'stage':<9}  {'calls':>5}  {'wall s':>8}  {'share':>5}  {'cpu s':>8}  {'peak MB':>7}")
+    for (script, name), row in summary.items():
+        echo(f"  {script:<{width}}  {name:<9}  {row['calls']:>5}  {row['wall_s']:>8.2f}  {row['wall_s'] / total_wall:>5.0%}"
+             f"  {row['cpu_s']:>8.2f}  {'-' if row['peak_rss_mb'] is None else format(row['peak_rss_mb'], '.0f'):>7}")
+    allocations = {}
+    for record in records:
+        for alloc in record.get("top_allocations", ()):
+            allocations[alloc["where"]] = allocations.get(alloc["where"], 0.0) + alloc["size_kb"]
+    if allocations:
+        echo("  Largest allocations (summed over stages):")
+        for where, size_kb in sorted(allocations.items(), key=lambda kv: -kv[1])[:10]:
+            echo(f"    {size_kb / 1024:>8.1f} MB  {where}")
@@ -0,0 +1,281 @@
+"""Machine-readable progress events for the long loops of the steps and plots.
+
+``progress(iterable, desc)`` is used in place of ``tqdm(iterable, desc=desc)``:
+it still draws the tqdm bar (unless ``disable``), and when
+``METHPIPE_PROGRESS`` is set it also sends JSON events for the loop to a
+file or socket, so a batch scheduler can follow run time and ETA:
+
+- a path appends one JSON line per event to that file;
+- ``unix:/path/to.sock`` or ``tcp:host:port`` sends the same lines over a
+  stream socket (``python -m methpipe progress --listen ADDRESS`` is a
+  minimal listener).
+
+Each event has ``event`` (``start``, ``update`` or ``end``), ``script``,
+``pid``, ``stage`` (the loop's description, e.g. "Matching CpGs"),
+``done``, ``total``, ``elapsed_s``, ``rate`` (items per second since the
+loop started), ``eta_s`` and ``time``. Updates are sent at most once every
+``METHPIPE_PROGRESS_INTERVAL`` seconds (default 1) per loop; ``start`` and
+``end`` are always sent. ``end`` events carry the loop's final rate, which
+``python -m methpipe progress FILE --baseline OLD`` compares between runs.
+
+    METHPIPE_PROGRESS=output/progress.jsonl python -m methpipe run
+    python -m methpipe progress output/progress.jsonl --baseline before.jsonl
+"""
+import json
+import os
+import socket
+import sys
+import time
+
+from methpipe.metrics import script_name
+
+PROGRESS_ENV = "METHPIPE_PROGRESS"
+INTERVAL_ENV = "METHPIPE_PROGRESS_INTERVAL"
+DEFAULT_INTERVAL = 1.0
+
+
+def progress_target():
+    return os.environ.get(PROGRESS_ENV) or None
+
+
+def parse_address(target):
+    """``(family, address)`` of a ``unix:`` or ``tcp:`` target, ``None`` for a file path."""
+    if target.startswith("unix:"):
+        return socket.AF_UNIX, target[len("unix:"):]
+    if target.startswith("tcp:"):
+        host, _, port = target[len("tcp:"):].rpartition(":")
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return None
+
+
+class EventSink:
+    """Sends event lines to a file (one ``write`` per line) or a stream socket.
+
+    A socket that cannot be reached is reported once on stderr; the run
+    continues without events.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.address = parse_address(target)
+        self.pid = os.getpid()
+        self._sock = None
+        self._broken = False
+
+    def send(self, event):
+        if self._broken:
+            return
+        line = (json.dumps(event) + "\n").encode("utf-8")
+        try:
+            if self.address is None:
+                directory = os.path.dirname(self.target)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                fd = os.open(self.target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+                return
+            if self._sock is None:
+                family, address = self.address
+                self._sock = socket.socket(family, socket.SOCK_STREAM)
+                self._sock.connect(address)
+            self._sock.sendall(line)
+        except OSError as exc:
+            self._broken = True
+            print(f"⚠️ Progress events to {self.target} stopped: {exc}", file=sys.stderr)
+
+
+_sink = None
+
+
+def sink():
+    """The process's ``EventSink``, or ``None`` when ``METHPIPE_PROGRESS`` is unset."""
+    global _sink
+    target = progress_target()
+    if target is None:
+        return None
+    if _sink is None or _sink.target != target or _sink.pid != os.getpid():
+        # A forked worker opens its own socket rather than sharing its parent's
+        _sink = EventSink(target)
+    return _sink
+
+
+def _interval():
+    try:
+        return float(os.environ.get(INTERVAL_ENV) or DEFAULT_INTERVAL)
+    except ValueError:
+        return DEFAULT_INTERVAL
+
+
+class LoopReporter:
+    """Builds and rate-limits the events of one loop."""
+
+    def __init__(self, stage, total, sink, interval):
+        self.stage = stage
+        self.total = total
+        self.sink = sink
+        self.interval = interval
+        self.started = time.perf_counter()
+        self._next = self.started + interval
+
+    def event(self, kind, done):
+        elapsed = time.perf_counter() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - done) / rate if self.total is not None and rate > 0 else None
+        return {
+            "event": kind,
+            "script": script_name(),
+            "pid": os.getpid(),
+            "stage": self.stage,
+            "done": done,
+            "total": self.total,
+            "elapsed_s": round(elapsed, 3),
+            "rate": round(rate, 3),
+            "eta_s": round(eta, 1) if eta is not None else None,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def start(self):
+        self.sink.send(self.event("start", 0))
+
+    def update(self, done):
+        now = time.perf_counter()
+        if now >= self._next:
+            self._next = now + self.interval
+            self.sink.send(self.event("update", done))
+
+    def finish(self, done):
+        self.sink.send(self.event("end", done))
+
+
+def progress(iterable, desc, total=None, disable=False):
+    """Iterate over ``iterable`` with a tqdm bar and, if configured, progress events.
+
+    ``disable`` hides the bar only; events are sent whenever
+    ``METHPIPE_PROGRESS`` is set.
+    """
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+    if not disable:
+        from tqdm import tqdm
+
+        iterable = tqdm(iterable, desc=desc, total=total)
+    events = sink()
+    if events is None:
+        yield from iterable
+        return
+
+    reporter = LoopReporter(desc, total, events, _interval())
+    reporter.start()
+    done = 0
+    try:
+        for item in iterable:
+            yield item
+            done += 1
+            reporter.update(done)
+    finally:
+        reporter.finish(done)
+
+
+# === Reports ===
+
+def read_events(path):
+    with open(path, encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def loop_rates(events):
+    """``{(script, stage): {"loops", "done", "seconds", "rate"}}`` from the ``end`` events, in first-seen order."""
+    rates = {}
+    for event in events:
+        if event.get("event") != "end":
+            continue
+        row = rates.setdefault((event["script"], event["stage"]), {"loops": 0, "done": 0, "seconds": 0.0, "rate": 0.0})
+        row["loops"] += 1
+        row["done"] += event["done"]
+        row["seconds"] += event["elapsed_s"]
+    for row in rates.values():
+        row["rate"] = row["done"] / row["seconds"] if row["seconds"] > 0 else 0.0
+    return rates
+
+
+def print_rates(rates, baseline=None, threshold=0.2, echo=print):
+    """Print per-loop throughput; with ``baseline``, flag loops more than ``threshold`` slower.
+
+    Returns the number of flagged loops.
+    """
+    width = max([len(f"{script}: {stage}") for script, stage in rates] + [4])
+    header = f"  {'loop':<{width}}  {'items':>8}  {'seconds':>8}  {'items/s':>9}"
+    echo(header + ("  vs baseline" if baseline is not None else ""))
+    slower = 0
+    for (script, stage), row in rates.items():
+        line = f"  {script + ': ' + stage:<{width}}  {row['done']:>8}  {row['seconds']:>8.2f}  {row['rate']:>9.1f}"
+        old = (baseline or {}).get((script, stage))
+        if old and old["rate"] > 0 and row["rate"] > 0:
+            change = row["rate"] / old["rate"] - 1
+            line += f"  {change:+.0%}"
+            if change < -threshold:
+                line += "  ⚠️ slower"
+                slower += 1
+        elif baseline is not None:
+            line += "  -"
+        echo(line)
+    return slower
+
+
+def listen(target, path=None, echo=print):
+    """Accept event streams on a ``unix:`` or ``tcp:`` ``target`` and print (and optionally append) them."""
+    import selectors
+
+    family, address = parse_address(target) or (None, None)
+    if family is None:
+        raise ValueError(f"{target!r} is not a unix: or tcp: address")
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.unlink(address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen()
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    buffers = {}
+    echo(f"Listening for progress events on {target}")
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is server:
+                    conn, _ = server.accept()
+                    selector.register(conn, selectors.EVENT_READ)
+                    buffers[conn] = b""
+                    continue
+                conn = key.fileobj
+                data = conn.recv(65536)
+                if not data:
+                    selector.unregister(conn)
+                    conn.close()
+                    del buffers[conn]
+                    continue
+                *lines, buffers[conn] = (buffers[conn] + data).split(b"\n")
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    if path:
+                        with open(path, "ab") as fh:
+                            fh.write(line + b"\n")
+                    echo(format_event(json.loads(line)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+
+def format_event(event):
+    total = event["total"] if event["total"] is not None else "?"
+    eta = f", eta {event['eta_s']:.0f} s" if event.get("eta_s") is not None else ""
+    return (f"[{event['script']} {event['pid']}] {event['stage']}: {event['event']} "
+            f"{event['done']}/{total} ({event['rate']:.1f}/s{eta})")
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+
+class CappedRanks:
+    """Per-sample gene ranks with a rank cap, computed from one partial sort.
+
+    Equivalent to ``matrix.rank(axis=0, method="min", ascending=False)``
+    followed by ``ranks[ranks >= cap] = cap``, but only the top ``cap - 1``
+    values of each column are ever sorted; every other gene gets the cap
+    value in bulk. All requested caps are served from a single pass over
+    the matrix (using the largest cap) and cached.
+    """
+
+    def __init__(self, matrix, caps=(501,)):
+        self.matrix = matrix
+        self.caps = sorted({int(c) for c in caps})
+        if not self.caps or self.caps[0] < 2:
+            raise ValueError("Rank caps must be integers >= 2.")
+        self._base = None
+        self._base_cap = None
+        self._cache = {}
+
+    def get(self, cap):
+        """Return the rank DataFrame capped at ``cap`` (cached)."""
+        cap = int(cap)
+        if cap not in self._cache:
+            if self._base is None or cap > self._base_cap:
+                self._compute(max(cap, self.caps[-1]))
+            capped = np.minimum(self._base, cap)
+            self._cache[cap] = pd.DataFrame(capped, index=self.matrix.index, columns=self.matrix.columns)
+        return self._cache[cap]
+
+    def _compute(self, cap):
+        values = self.matrix.to_numpy(dtype=float)
+        n_rows, n_cols = values.shape
+        nan = np.isnan(values)
+        key = -values
+        key[nan] = np.inf
+
+        k = min(cap - 1, n_rows)
+        ranks = np.full(values.shape, float(cap))
+        if k > 0:
+            top = np.partition(key, k - 1, axis=0)[:k] if k < n_rows else key.copy()
+            top.sort(axis=0)
+            threshold = top[-1]
+            exact = key <= threshold
+            for j in range(n_cols):
+                rows = np.flatnonzero(exact[:, j])
+                # "min" rank = 1 + number of strictly larger values
+                ranks[rows, j] = np.searchsorted(top[:, j], key[rows, j], side="left") + 1
+        ranks = np.minimum(ranks, cap)
+        ranks[nan] = np.nan
+
+        self._base = ranks
+        self._base_cap = cap
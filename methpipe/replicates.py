@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+ReplicateCodes = namedtuple("ReplicateCodes", ["codes", "labels", "order", "starts"])
+ReplicateCodes.__doc__ = """Integer encoding of (Patient, Timepoint) sample columns.
+
+``codes`` holds the group code of every input column (-1 for columns with a
+missing patient or timepoint), ``labels`` is the sorted (Patient, Timepoint)
+MultiIndex so that ``labels[code]`` is the label of a group, ``order`` the
+stable column order that makes each group contiguous (excluded columns
+dropped) and ``starts`` the offset of every group within that order.
+"""
+
+
+def replicate_codes(columns):
+    """Encode (Patient, Timepoint) columns as integer group codes.
+
+    Groups are numbered in sorted label order, which matches
+    ``groupby(level=[0, 1])``.
+    """
+    columns = pd.MultiIndex.from_tuples(list(columns)) if not isinstance(columns, pd.MultiIndex) else columns
+    patient_codes, patients = pd.factorize(columns.get_level_values(0), sort=True)
+    timepoint_codes, timepoints = pd.factorize(columns.get_level_values(1), sort=True)
+    valid = (patient_codes >= 0) & (timepoint_codes >= 0)
+
+    n_timepoints = max(len(timepoints), 1)
+    combined = patient_codes.astype(np.int64) * n_timepoints + timepoint_codes
+    present, dense = np.unique(combined[valid], return_inverse=True)
+    codes = np.full(len(columns), -1, dtype=np.intp)
+    codes[valid] = dense
+
+    labels = pd.MultiIndex.from_arrays(
+        [np.asarray(patients)[present // n_timepoints], np.asarray(timepoints)[present % n_timepoints]],
+        names=list(columns.names),
+    )
+    order = np.flatnonzero(valid)[np.argsort(dense, kind="stable")]
+    starts = np.searchsorted(codes[order], np.arange(len(present)))
+    return ReplicateCodes(codes, labels, order, starts)
+
+
+def collapse_values(values, rc):
+    """Per-group NaN-aware column means of a 2-D array (rows × columns)."""
+    values = np.asarray(values, dtype=float)
+    if not len(rc.starts):
+        return np.empty((values.shape[0], 0))
+    block = values[:, rc.order]
+    nan = np.isnan(block)
+    sums = np.add.reduceat(np.where(nan, 0.0, block), rc.starts, axis=1)
+    counts = np.add.reduceat(~nan, rc.starts, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def collapse_replicates(matrix, rc=None):
+    """Average replicate columns per (Patient, Timepoint), NaN-aware.
+
+    Equivalent to ``matrix.T.groupby(level=[0, 1]).mean().T`` but works on
+    integer group codes with a single column sort and ``np.add.reduceat``.
+    Pass a precomputed ``ReplicateCodes`` to reuse the encoding.
+    """
+    rc = rc if rc is not None else replicate_codes(matrix.columns)
+    return pd.DataFrame(collapse_values(matrix.to_numpy(dtype=float), rc), index=matrix.index, columns=rc.labels)
+
+
+def paired_columns(labels, t0, t1):
+    """Patients present at both timepoints and their column positions in ``labels``.
+
+    Returns ``(patients, before, after)`` so that ``values[:, after] -
+    values[:, before]`` is the per-patient change from ``t0`` to ``t1``.
+    """
+    position = {label: i for i, label in enumerate(labels)}
+    patients = [p for p in labels.get_level_values(0).unique() if (p, t0) in position and (p, t1) in position]
+    before = np.array([position[(p, t0)] for p in patients], dtype=np.intp)
+    after = np.array([position[(p, t1)] for p in patients], dtype=np.intp)
+    return patients, before, after
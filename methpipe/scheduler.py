@@ -0,0 +1,399 @@
+"""Dependency-graph scheduler for the pipeline steps and plotting scripts.
+
+Every task declares the files it reads and writes. A task depends on the
+tasks that write its inputs; tasks writing the same output are run one
+after the other in declaration order. Ready tasks are started as
+subprocesses, highest "remaining path length" first, whenever their CPU and
+memory estimates fit in the budget.
+"""
+import glob
+import heapq
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from methpipe.metrics import maxrss_mb
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(REPO_ROOT, "scripts")
+LOG_DIR = os.path.join("output", ".methpipe-logs")
+HISTORY_PATH = os.path.join("output", ".methpipe-cache", "schedule-history.json")
+HISTORY_VERSION = 2
+
+Task = namedtuple("Task", ["name", "command", "inputs", "outputs", "cpus", "memory_mb", "seconds"],
+                  defaults=(1, 500, 10.0))
+Task.__doc__ = """One schedulable command.
+
+``inputs`` and ``outputs`` are paths (or glob patterns) relative to the
+working directory; a task depends on every task that declares one of its
+inputs as an output. ``cpus``, ``memory_mb`` and ``seconds`` are the
+resource and duration estimates used for packing and for the critical
+path until a previous run has recorded measured values.
+"""
+
+
+# === Pipeline declaration ===
+
+PATIENT_FILE = "data/*patient*.xlsx"
+SLOPE_PATIENT_FILE = "data/Patient ID list fot EMseq16-18-20.xlsx"
+FILTERED_RUNS = "output/*_samples-of-interest.xlsx"
+MERGED_GLOB20 = "output/merged_output_glob20.xlsx"
+MERGED_GLOBMIN80 = "output/merged_output_globmin80.xlsx"
+RATIO_MATRIX = "output/scaled_fragment_ratios_matrix.xlsx"
+GENE_ANNOTATION = "output/structured_gene_annotation.csv"
+GENE_CGI_MAP = "output/gene_cgi_map.csv"
+GENE_MATRIX = "output/gene_methylation_matrix.csv"
+
+
+def pipeline_tasks(python=sys.executable, workers=None):
+    """The default pipeline: steps 1-6, the global plots and the locus plots."""
+    workers = workers or min(4, os.cpu_count() or 1)
+
+    def step(name, inputs, outputs, memory_mb=800, seconds=5.0):
+        return Task(name, [python, "-m", "methpipe", name], inputs, outputs, 1, memory_mb, seconds)
+
+    def script(path, inputs, outputs, args=(), cpus=1, memory_mb=800, seconds=20.0):
+        name = os.path.splitext(os.path.basename(path))[0]
+        return Task(name, [python, os.path.join(SCRIPTS_DIR, path)] + list(args), inputs, outputs, cpus, memory_mb, seconds)
+
+    return [
+        step("filter", ["data/*.xlsx"], [FILTERED_RUNS]),
+        step("merge", [FILTERED_RUNS], [MERGED_GLOB20, MERGED_GLOBMIN80]),
+        step("ratio", [MERGED_GLOB20, MERGED_GLOBMIN80], [RATIO_MATRIX]),
+        step("annotate", [RATIO_MATRIX], [GENE_ANNOTATION], memory_mb=400, seconds=2.0),
+        step("map", [GENE_ANNOTATION], [GENE_CGI_MAP], memory_mb=400, seconds=2.0),
+        step("gene-matrix", [MERGED_GLOB20, GENE_CGI_MAP], [GENE_MATRIX], seconds=30.0),
+        # Global branch: only needs the ratio matrix
+        script("global/dotplots-by-condition.py", [RATIO_MATRIX], ["plots/dotplots"]),
+        script("global/lineplots-perpatient_v4.py", [RATIO_MATRIX], ["plots/global-lineplots"], seconds=30.0),
+        # Locus branch
+        script("locus/avg-methylation-change-per-chromosome.py", [RATIO_MATRIX, PATIENT_FILE],
+               ["plots/avg-methylation-change-per-chromosome"], args=["--workers", str(workers)], cpus=workers, seconds=10.0),
+        script("locus/bubbleplot_generator_v9_gridsoff.py", [RATIO_MATRIX, PATIENT_FILE], ["plots/bubbleplots.zip"],
+               args=["--workers", str(workers)], cpus=workers, memory_mb=600 * workers, seconds=60.0),
+        script("locus/top10dm-plots_using-map_v4.py", [RATIO_MATRIX, GENE_CGI_MAP, PATIENT_FILE],
+               ["plots/top-10-differential-methylation-plots.zip"], args=["--workers", str(workers)], cpus=workers),
+        script("locus/heatmap-lineplot-barplot_v3.py", [RATIO_MATRIX, GENE_CGI_MAP, PATIENT_FILE],
+               ["plots/heatmaps-lineplots"], seconds=30.0),
+        script("locus/top10genes-heatmap-barplot.py", [RATIO_MATRIX, GENE_CGI_MAP, PATIENT_FILE],
+               ["plots/heatmaps-lineplots"], seconds=30.0),
+        script("locus/generank-slopeplot-21cap.py", [GENE_MATRIX, SLOPE_PATIENT_FILE], ["plots/rank-slopeplot"], seconds=30.0),
+        script("locus/generank-slopeplot-501cap.py", [GENE_MATRIX, SLOPE_PATIENT_FILE], ["plots/rank-slopeplot"], seconds=30.0),
+    ]
+
+
+# === Graph ===
+
+class TaskGraph:
+    """Tasks plus the dependency edges derived from their inputs and outputs."""
+
+    def __init__(self, tasks):
+        self.tasks = {}
+        for task in tasks:
+            if task.name in self.tasks:
+                raise ValueError(f"Duplicate task name {task.name!r}")
+            self.tasks[task.name] = task
+
+        writers = {}
+        for task in self.tasks.values():
+            for output in task.outputs:
+                writers.setdefault(os.path.normpath(output), []).append(task.name)
+        # ``inputs_from``: the tasks whose outputs a task reads. ``deps`` adds
+        # the ordering between tasks writing the same output (declaration order).
+        self.inputs_from = {name: set() for name in self.tasks}
+        for task in self.tasks.values():
+            for path in task.inputs:
+                self.inputs_from[task.name].update(w for w in writers.get(os.path.normpath(path), ()) if w != task.name)
+        self.deps = {name: set(producers) for name, producers in self.inputs_from.items()}
+        for names in writers.values():
+            for before, after in zip(names, names[1:]):
+                self.deps[after].add(before)
+
+        self.dependents = {name: set() for name in self.tasks}
+        for name, deps in self.deps.items():
+            for dep in deps:
+                self.dependents[dep].add(name)
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        position = {name: i for i, name in enumerate(self.tasks)}
+        waiting = {name: len(deps) for name, deps in self.deps.items()}
+        ready = [(position[name], name) for name, n in waiting.items() if n == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, name = heapq.heappop(ready)
+            order.append(name)
+            for dependent in self.dependents[name]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, (position[dependent], dependent))
+        if len(order) != len(self.tasks):
+            cycle = sorted(set(self.tasks) - set(order))
+            raise ValueError(f"Dependency cycle between tasks: {', '.join(cycle)}")
+        return order
+
+    def subgraph(self, names, upstream=True):
+        """``TaskGraph`` of ``names``, plus the tasks producing their inputs when ``upstream``."""
+        unknown = set(names) - set(self.tasks)
+        if unknown:
+            raise ValueError(f"Unknown task(s): {', '.join(sorted(unknown))}")
+        keep = set(names)
+        stack = list(names) if upstream else []
+        while stack:
+            for dep in self.inputs_from[stack.pop()]:
+                if dep not in keep:
+                    keep.add(dep)
+                    stack.append(dep)
+        return TaskGraph([task for name, task in self.tasks.items() if name in keep])
+
+    def external_inputs(self):
+        """Inputs that no task in the graph produces (they must already exist)."""
+        produced = {os.path.normpath(o) for task in self.tasks.values() for o in task.outputs}
+        seen = []
+        for name in self.order:
+            for path in self.tasks[name].inputs:
+                if os.path.normpath(path) not in produced and path not in seen:
+                    seen.append(path)
+        return seen
+
+    def estimates(self, history=None):
+        """Estimated ``(seconds, memory_mb)`` per task: measured values from ``history`` or the declared ones."""
+        history = history or {}
+        result = {}
+        for name, task in self.tasks.items():
+            measured = history.get(name, {})
+            result[name] = (measured.get("seconds", task.seconds), measured.get("memory_mb", task.memory_mb))
+        return result
+
+    def remaining_path(self, seconds):
+        """Longest estimated path from each task to the end of the graph (its scheduling priority)."""
+        remaining = {}
+        for name in reversed(self.order):
+            remaining[name] = seconds[name] + max((remaining[d] for d in self.dependents[name]), default=0.0)
+        return remaining
+
+    def critical_path(self, seconds):
+        """``(total seconds, [task, ...])`` of the longest dependency chain."""
+        finish = {}
+        previous = {}
+        for name in self.order:
+            start, previous[name] = max(((finish[d], d) for d in self.deps[name]), default=(0.0, None))
+            finish[name] = start + seconds[name]
+        if not finish:
+            return 0.0, []
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return total, path[::-1]
+
+
+# === Scheduling ===
+
+def default_memory_budget():
+    """Three quarters of the physical memory, in MB."""
+    try:
+        return int(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") * 0.75 / 2 ** 20)
+    except (ValueError, OSError, AttributeError):
+        return 8192
+
+
+def _dispatch(graph, cpus, memory_mb, seconds, memory, launch, wait):
+    """List-scheduling loop shared by ``run_graph`` and ``simulate``.
+
+    Starts every ready task that fits in the free CPUs/memory, highest
+    remaining path first; a task larger than the whole budget runs once
+    nothing else is running. ``wait`` blocks until a task finishes and
+    returns ``(name, ok)``. Returns the names of tasks skipped because a
+    dependency failed.
+    """
+    priority = graph.remaining_path(seconds)
+    waiting = {name: set(deps) for name, deps in graph.deps.items()}
+    ready = [name for name in graph.order if not waiting[name]]
+    running = {}
+    free_cpus, free_mem = cpus, memory_mb
+    skipped = set()
+    while ready or running:
+        ready.sort(key=lambda n: -priority[n])
+        for name in list(ready):
+            need_cpus = min(graph.tasks[name].cpus, cpus)
+            need_mem = min(memory[name], memory_mb)
+            if (need_cpus <= free_cpus and need_mem <= free_mem) or not running:
+                ready.remove(name)
+                running[name] = (need_cpus, need_mem)
+                free_cpus -= need_cpus
+                free_mem -= need_mem
+                launch(name)
+        name, ok = wait()
+        need_cpus, need_mem = running.pop(name)
+        free_cpus += need_cpus
+        free_mem += need_mem
+        if ok:
+            for dependent in graph.dependents[name]:
+                waiting[dependent].discard(name)
+                if not waiting[dependent] and dependent not in skipped:
+                    ready.append(dependent)
+        else:
+            stack = list(graph.dependents[name])
+            while stack:
+                dependent = stack.pop()
+                if dependent not in skipped:
+                    skipped.add(dependent)
+                    stack.extend(graph.dependents[dependent])
+    return skipped
+
+
+def simulate(graph, cpus, memory_mb, history=None):
+    """Planned ``{task: (start, end)}`` (estimated seconds) under the budget."""
+    estimates = graph.estimates(history)
+    seconds = {name: est[0] for name, est in estimates.items()}
+    memory = {name: est[1] for name, est in estimates.items()}
+    clock = [0.0]
+    events = []
+    plan = {}
+
+    def launch(name):
+        plan[name] = (clock[0], clock[0] + seconds[name])
+        heapq.heappush(events, (plan[name][1], graph.order.index(name), name))
+
+    def wait():
+        clock[0], _, name = heapq.heappop(events)
+        return name, True
+
+    _dispatch(graph, cpus, memory_mb, seconds, memory, launch, wait)
+    return plan
+
+
+def run_graph(graph, cpus=None, memory_mb=None, history=None, log_dir=LOG_DIR, echo=print):
+    """Run every task of ``graph`` as a subprocess under the budget.
+
+    Each task's output goes to ``<log_dir>/<task>.log``. Returns
+    ``{task: {"status", "seconds", "memory_mb"}}`` with status ``ok``,
+    ``failed`` or ``skipped`` (a dependency failed); ``memory_mb`` is the
+    measured peak RSS of the task's process.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    memory_mb = memory_mb or default_memory_budget()
+    estimates = graph.estimates(history)
+    seconds = {name: est[0] for name, est in estimates.items()}
+    memory = {name: est[1] for name, est in estimates.items()}
+    os.makedirs(log_dir, exist_ok=True)
+    finished = queue.Queue()
+    results = {}
+    start = time.perf_counter()
+
+    def execute(name, task):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+        env.setdefault("MPLBACKEND", "Agg")
+        for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+            env.setdefault(var, str(min(task.cpus, cpus)))
+        began = time.perf_counter()
+        peak_mb = 0.0
+        ok = False
+        log_path = os.path.join(log_dir, f"{name}.log")
+        try:
+            with open(log_path, "wb") as log:
+                proc = subprocess.Popen(task.command, stdout=log, stderr=subprocess.STDOUT, env=env)
+                if hasattr(os, "wait4"):
+                    _, status, usage = os.wait4(proc.pid, 0)
+                    proc.returncode = os.waitstatus_to_exitcode(status)
+                    peak_mb = maxrss_mb(usage)
+                else:
+                    proc.wait()  # no per-process peak memory on this platform
+            ok = proc.returncode == 0
+        except Exception:
+            # Record why the task could not be run; wait() still hears about it below
+            try:
+                with open(log_path, "a", encoding="utf-8") as log:
+                    log.write(f"\n[schedule] {name} could not be run:\n{traceback.format_exc()}")
+            except OSError:
+                pass
+        finally:
+            results[name] = {"status": "ok" if ok else "failed", "seconds": time.perf_counter() - began, "memory_mb": peak_mb}
+            finished.put((name, ok))
+
+    def launch(name):
+        echo(f"[{time.perf_counter() - start:7.1f} s] start  {name}")
+        threading.Thread(target=execute, args=(name, graph.tasks[name]), daemon=True).start()
+
+    def wait():
+        name, ok = finished.get()
+        result = results[name]
+        echo(f"[{time.perf_counter() - start:7.1f} s] {'done  ' if ok else 'FAILED'} {name} "
+             f"({result['seconds']:.1f} s, {result['memory_mb']:.0f} MB)"
+             + ("" if ok else f" - see {os.path.join(log_dir, name + '.log')}"))
+        return name, ok
+
+    for name in _dispatch(graph, cpus, memory_mb, seconds, memory, launch, wait):
+        results[name] = {"status": "skipped", "seconds": 0.0, "memory_mb": 0.0}
+    return results
+
+
+# === Run history ===
+
+def read_history(path=HISTORY_PATH):
+    """``{task: {"seconds", "memory_mb"}}`` measured by the last runs (empty without a history file)."""
+    try:
+        with open(path, encoding="utf-8") as fh:
+            history = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if history.get("version") == HISTORY_VERSION:
+        return history.get("tasks", {})
+    # Version 1 files are the bare task table; on macOS their peaks were bytes / 1024, not MB
+    if sys.platform == "darwin":
+        for entry in history.values():
+            if "memory_mb" in entry:
+                entry["memory_mb"] = round(entry["memory_mb"] / 1024, 1)
+    return history
+
+
+def update_history(results, path=HISTORY_PATH):
+    """Record the measured duration and peak memory of the tasks that succeeded."""
+    history = read_history(path)
+    for name, result in results.items():
+        if result["status"] == "ok":
+            entry = {"seconds": round(result["seconds"], 2)}
+            # Without os.wait4 there is no peak to record: keep the last one (or the declared estimate)
+            memory_mb = result["memory_mb"] or history.get(name, {}).get("memory_mb")
+            if memory_mb:
+                entry["memory_mb"] = round(memory_mb, 1)
+            history[name] = entry
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump({"version": HISTORY_VERSION, "tasks": history}, fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def print_plan(graph, cpus, memory_mb, history=None, echo=print):
+    """Dry run: the planned start/end of every task and the critical path."""
+    estimates = graph.estimates(history)
+    seconds = {name: est[0] for name, est in estimates.items()}
+    plan = simulate(graph, cpus, memory_mb, history)
+    width = max([len(name) for name in graph.order] + [4])
+    echo(f"Plan: {len(graph.order)} task(s), budget {cpus} CPU(s) / {memory_mb} MB"
+         + (" (estimates from the last run where available)" if history else ""))
+    echo(f"  {'task':<{width}}  cpus  mem MB   est s   start     end  after")
+    for name in sorted(graph.order, key=lambda n: (plan[n][0], graph.order.index(n))):
+        task = graph.tasks[name]
+        after = ", ".join(sorted(graph.deps[name], key=graph.order.index)) or "-"
+        echo(f"  {name:<{width}}  {task.cpus:>4}  {estimates[name][1]:>6.0f}  {seconds[name]:>6.1f}"
+             f"  {plan[name][0]:>6.1f}  {plan[name][1]:>6.1f}  {after}")
+    total, path = graph.critical_path(seconds)
+    echo(f"Critical path ({total:.1f} s): {' → '.join(path)}")
+    makespan = max((end for _, end in plan.values()), default=0.0)
+    echo(f"Estimated wall time: {makespan:.1f} s with this budget, {sum(seconds.values()):.1f} s run one by one")
+    missing = [path for path in graph.external_inputs() if not glob.glob(path)]
+    if missing:
+        echo(f"Missing inputs: {', '.join(missing)}")
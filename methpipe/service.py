@@ -0,0 +1,404 @@
+"""Long-lived query service over the scaled ratio matrix, the gene map and the sample metadata.
+
+``python -m methpipe serve`` loads the matrix (through the dataset cache or
+its matrix store), ``gene_cgi_map.csv`` and the patient list once, builds
+in-memory indexes and answers HTTP ``GET`` requests on a TCP port or a
+Unix socket (``--listen tcp:127.0.0.1:8765`` or ``unix:/tmp/methpipe.sock``):
+
+- ``/slice``: CGI rows × samples, filtered by ``gene`` (symbols, matched to
+  CGIs through the gene map coordinates), ``region`` (``chr1:1000-50000``,
+  CGIs overlapping it), ``patient`` and ``timepoint``. Each filter takes
+  comma-separated values and may be repeated. ``agg=mean|sum|median|min|max``
+  reduces the CGIs of every gene (or region, or all selected CGIs) per
+  sample, ignoring missing values; without ``agg`` at most ``limit``
+  (default 1000) rows are returned;
+- ``/samples``: the Sample/Patient/Timepoint table (same filters);
+- ``/genes``: gene symbols with their number of CGIs (``prefix=`` filter);
+- ``/stats``: resident memory, cache use and hit counts; ``/health``.
+
+Aggregates are kept in an LRU cache. ``--memory-mb`` caps the resident
+matrix and indexes plus the cache: the service refuses to start when the
+data alone exceeds the cap, and the cache evicts its least recently used
+entries to stay within what is left (and within ``--cache-mb``).
+
+    python -m methpipe serve --listen tcp:127.0.0.1:8765 --memory-mb 2048
+    curl 'http://127.0.0.1:8765/slice?gene=BRCA1,TP53&patient=QZ802-153&agg=mean'
+"""
+import json
+import math
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import warnings
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from methpipe.progress import parse_address
+
+DEFAULT_LISTEN = "tcp:127.0.0.1:8765"
+DEFAULT_MEMORY_MB = 2048
+DEFAULT_CACHE_MB = 256
+DEFAULT_LIMIT = 1000
+AGGREGATES = {
+    "mean": np.nanmean,
+    "sum": np.nansum,
+    "median": np.nanmedian,
+    "min": np.nanmin,
+    "max": np.nanmax,
+}
+
+
+class QueryError(ValueError):
+    """A request the service cannot answer (reported as HTTP 400)."""
+
+
+# === Indexes ===
+
+class QueryIndex:
+    """The matrix values plus label, gene, region, patient and timepoint indexes.
+
+    ``dataset`` is an ``AnalysisDataset``; ``gene_map`` a DataFrame with
+    ``cgi_id`` (``chr1:35920-37410``) and ``gene_name`` columns.
+    """
+
+    def __init__(self, dataset, gene_map=None):
+        cgi_matrix = dataset.cgi_matrix
+        self.values = cgi_matrix.to_numpy()
+        self.labels = cgi_matrix.index.astype(str)
+        self.samples = pd.Index(cgi_matrix.columns.astype(str))
+        meta = dataset.sample_meta.set_index("Sample").reindex(cgi_matrix.columns)
+        self.sample_patients = [None if pd.isna(p) else str(p) for p in meta["Patient"]]
+        self.sample_timepoints = [str(t) for t in meta["Timepoint"]]
+        self.patient_columns = self._positions(self.sample_patients)
+        self.timepoint_columns = self._positions(self.sample_timepoints)
+
+        # CGI coordinates, and per chromosome the rows sorted by start for overlap queries
+        coords = pd.Series(self.labels, dtype=object).str.extract(r"CGI_(chr[^_]+)_(\d+)_(\d+)")
+        has_coords = coords.notna().all(axis=1).to_numpy()
+        rows = np.flatnonzero(has_coords)
+        chroms = coords[0].to_numpy()[rows]
+        starts = coords[1].to_numpy()[rows].astype(np.int64)
+        ends = coords[2].to_numpy()[rows].astype(np.int64)
+        self.regions = {}
+        for chrom in pd.unique(chroms):
+            on_chrom = chroms == chrom
+            order = np.argsort(starts[on_chrom], kind="stable")
+            chrom_starts = starts[on_chrom][order]
+            chrom_ends = ends[on_chrom][order]
+            self.regions[chrom] = (chrom_starts, chrom_ends, rows[on_chrom][order], int((chrom_ends - chrom_starts).max()))
+
+        # Gene symbol -> CGI rows, through the gene map's chr:start-end ids
+        self.gene_rows = {}
+        if gene_map is not None and len(gene_map):
+            map_ids = pd.Series([f"{c}:{s}-{e}" for c, s, e in zip(chroms, starts, ends)], dtype=object)
+            row_of_id = pd.Series(rows, index=map_ids)
+            row_of_id = row_of_id[~row_of_id.index.duplicated()]
+            pairs = gene_map.dropna(subset=["cgi_id", "gene_name"])
+            ids = pairs["cgi_id"].astype(str).str.strip()
+            genes = pairs["gene_name"].astype(str).str.strip()
+            found = ids.isin(row_of_id.index).to_numpy()
+            matched_rows = row_of_id.reindex(ids[found]).to_numpy()
+            for gene, gene_rows in pd.Series(matched_rows).groupby(genes[found].to_numpy(), sort=False):
+                self.gene_rows[gene] = np.unique(gene_rows.to_numpy().astype(np.intp))
+        self.gene_keys = {gene.upper(): gene for gene in self.gene_rows}
+
+    @staticmethod
+    def _positions(labels):
+        positions = {}
+        for i, label in enumerate(labels):
+            if label is not None:
+                positions.setdefault(label, []).append(i)
+        return {label: np.array(cols, dtype=np.intp) for label, cols in positions.items()}
+
+    def nbytes(self):
+        """Approximate resident size of the values and indexes."""
+        total = self.values.nbytes + sum(len(label) + 50 for label in self.labels)
+        total += sum(sum(a.nbytes for a in region[:3]) for region in self.regions.values())
+        total += sum(rows.nbytes + len(gene) + 100 for gene, rows in self.gene_rows.items())
+        return total
+
+    # === Selections ===
+
+    def gene(self, name):
+        rows = self.gene_rows.get(name)
+        if rows is None:
+            key = self.gene_keys.get(name.upper())
+            if key is None:
+                raise QueryError(f"unknown gene {name!r}")
+            rows = self.gene_rows[key]
+        return rows
+
+    def region(self, text):
+        """CGI rows overlapping ``chr:start-end`` (or a whole chromosome), in coordinate order."""
+        chrom, _, span = text.partition(":")
+        if chrom not in self.regions:
+            raise QueryError(f"unknown chromosome {chrom!r} in region {text!r}")
+        starts, ends, rows, max_length = self.regions[chrom]
+        if not span:
+            return rows
+        try:
+            lo, hi = (int(v.replace(",", "")) for v in span.split("-", 1))
+        except ValueError:
+            raise QueryError(f"region {text!r} is not chr:start-end") from None
+        first = np.searchsorted(starts, lo - max_length, side="left")
+        last = np.searchsorted(starts, hi, side="right")
+        hit = ends[first:last] >= lo
+        return rows[first:last][hit]
+
+    def columns(self, patients=(), timepoints=()):
+        keep = np.ones(len(self.samples), dtype=bool)
+        for labels, index, kind in ((patients, self.patient_columns, "patient"), (timepoints, self.timepoint_columns, "timepoint")):
+            if not labels:
+                continue
+            chosen = np.zeros(len(self.samples), dtype=bool)
+            for label in labels:
+                if label not in index:
+                    raise QueryError(f"unknown {kind} {label!r}")
+                chosen[index[label]] = True
+            keep &= chosen
+        return np.flatnonzero(keep)
+
+    def groups(self, genes=(), regions=()):
+        """``[(name, rows), ...]`` of the requested genes and regions (all CGIs when neither is given)."""
+        groups = [(gene, self.gene(gene)) for gene in genes] + [(region, self.region(region)) for region in regions]
+        return groups or [("all", np.arange(len(self.labels)))]
+
+
+# === Cache ===
+
+class LRUCache:
+    """Thread-safe LRU cache of computed results, bounded by their size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, size):
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "mb": round(self.bytes / 2 ** 20, 3),
+                    "max_mb": round(self.max_bytes / 2 ** 20, 3), "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+# === Queries ===
+
+def _list(params, name):
+    """Comma-separated values of every ``name`` parameter."""
+    return [v.strip() for value in params.get(name, []) for v in value.split(",") if v.strip()]
+
+
+def _json_matrix(values):
+    """Nested lists with ``None`` for missing and infinite values (strict JSON has neither)."""
+    return [[v if math.isfinite(v) else None for v in row] for row in np.asarray(values, dtype=float).tolist()]
+
+
+class QueryService:
+    """Answers parsed requests from a ``QueryIndex`` with an ``LRUCache`` of aggregates."""
+
+    def __init__(self, index, memory_mb=DEFAULT_MEMORY_MB, cache_mb=DEFAULT_CACHE_MB):
+        self.index = index
+        self.resident = index.nbytes()
+        cap = memory_mb * 2 ** 20
+        if self.resident > cap:
+            raise MemoryError(f"the matrix and indexes need {self.resident / 2 ** 20:.0f} MB, more than the "
+                              f"{memory_mb} MB cap (raise --memory-mb or use --dtypes compact)")
+        self.memory_mb = memory_mb
+        self.cache = LRUCache(min(cache_mb * 2 ** 20, cap - self.resident))
+        self.started = time.time()
+        self.requests = 0
+
+    def route(self, path):
+        """The handler of ``path``, or ``None`` for an unknown endpoint."""
+        routes = {"/slice": self.slice, "/samples": self.sample_table, "/genes": self.gene_list,
+                  "/stats": self.stats, "/health": lambda params: {"ok": True}}
+        return routes.get(path)
+
+    def _sample_fields(self, columns):
+        return {
+            "samples": self.index.samples[columns].tolist(),
+            "patients": [self.index.sample_patients[i] for i in columns],
+            "timepoints": [self.index.sample_timepoints[i] for i in columns],
+        }
+
+    def slice(self, params):
+        genes, regions = _list(params, "gene"), _list(params, "region")
+        patients, timepoints = _list(params, "patient"), _list(params, "timepoint")
+        agg = (params.get("agg") or ["none"])[-1]
+        if agg != "none" and agg not in AGGREGATES:
+            raise QueryError(f"agg must be none or one of {', '.join(AGGREGATES)}")
+        columns = self.index.columns(patients, timepoints)
+
+        if agg == "none":
+            try:
+                limit = int((params.get("limit") or [DEFAULT_LIMIT])[-1])
+            except ValueError:
+                raise QueryError("limit must be an integer") from None
+            if limit < 1:
+                raise QueryError("limit must be at least 1")
+            groups = self.index.groups(genes, regions)
+            rows = np.unique(np.concatenate([group_rows for _, group_rows in groups]))
+            shown = rows[:limit]
+            return dict(self._sample_fields(columns), rows=self.index.labels[shown].tolist(),
+                        values=_json_matrix(self.index.values[np.ix_(shown, columns)]),
+                        total_rows=int(len(rows)), truncated=bool(len(rows) > limit))
+
+        key = (tuple(genes), tuple(regions), tuple(patients), tuple(timepoints), agg)
+        result = self.cache.get(key)
+        if result is None:
+            groups = self.index.groups(genes, regions)
+            reduce = AGGREGATES[agg]
+            values = np.full((len(groups), len(columns)), np.nan)
+            counts = []
+            for i, (_, group_rows) in enumerate(groups):
+                block = np.asarray(self.index.values[np.ix_(group_rows, columns)], dtype=float)
+                counts.append(int(len(group_rows)))
+                if len(group_rows):
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns stay missing
+                        values[i] = reduce(block, axis=0)
+            result = dict(self._sample_fields(columns), groups=[name for name, _ in groups], cgis=counts,
+                          agg=agg, values=_json_matrix(values))
+            self.cache.put(key, result, values.nbytes + 64 * (len(columns) + len(groups)) + 200)
+        return result
+
+    def sample_table(self, params):
+        columns = self.index.columns(_list(params, "patient"), _list(params, "timepoint"))
+        return self._sample_fields(columns)
+
+    def gene_list(self, params):
+        prefix = (params.get("prefix") or [""])[-1].upper()
+        genes = sorted(gene for gene in self.index.gene_rows if gene.upper().startswith(prefix))
+        return {"genes": genes, "cgis": [int(len(self.index.gene_rows[gene])) for gene in genes]}
+
+    def stats(self, params):
+        return {
+            "cgis": int(len(self.index.labels)),
+            "samples": int(len(self.index.samples)),
+            "genes": len(self.index.gene_rows),
+            "resident_mb": round(self.resident / 2 ** 20, 3),
+            "memory_cap_mb": self.memory_mb,
+            "cache": self.cache.stats(),
+            "requests": self.requests,
+            "uptime_s": round(time.time() - self.started, 1),
+        }
+
+
+# === HTTP ===
+
+class QueryHandler(BaseHTTPRequestHandler):
+    server_version = "methpipe-query/1"
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        service = self.server.service
+        handler = service.route(url.path.rstrip("/") or "/")
+        if handler is None:
+            payload, status = {"error": f"unknown endpoint {url.path!r}; use /slice, /samples, /genes, /stats or /health"}, 404
+        else:
+            service.requests += 1
+            try:
+                payload, status = dict(handler(parse_qs(url.query))), 200  # a copy: cached results stay unchanged
+            except QueryError as exc:
+                payload, status = {"error": str(exc)}, 400
+            except Exception as exc:
+                sys.stderr.write(f"[serve] {self.path}: {traceback.format_exc()}")
+                payload, status = {"error": f"internal error: {type(exc).__name__}: {exc}"}, 500
+        payload["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        body = json.dumps(payload, allow_nan=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write(f"[serve] {self.address_string()} {format % args}\n")
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, listen=DEFAULT_LISTEN, verbose=False):
+    """An HTTP server for ``service`` on a ``tcp:HOST:PORT`` or ``unix:PATH`` address."""
+    family, address = parse_address(listen) or (None, None)
+    if family is None:
+        raise ValueError(f"{listen!r} is not a unix: or tcp: address")
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = ThreadingUnixHTTPServer(address, QueryHandler)
+    else:
+        server = ThreadingHTTPServer(address, QueryHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def load_index(matrix_path, patient_ids, gene_map_path=None):
+    """``QueryIndex`` of a scaled ratio matrix file (dataset cache / matrix store aware) and gene map."""
+    from methpipe.dataset import load_analysis_dataset
+
+    dataset = load_analysis_dataset(matrix_path, patient_ids)
+    gene_map = pd.read_csv(gene_map_path) if gene_map_path else None
+    if gene_map is not None:
+        gene_map.columns = gene_map.columns.str.strip()
+    return QueryIndex(dataset, gene_map)
+
+
+def serve(service, listen=DEFAULT_LISTEN, verbose=False, echo=print):
+    """Answer queries on ``listen`` until interrupted (Ctrl-C or SIGTERM)."""
+    server = make_server(service, listen, verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    echo(f"Serving {len(service.index.labels)} CGIs × {len(service.index.samples)} samples, "
+         f"{len(service.index.gene_rows)} genes ({service.resident / 2 ** 20:.1f} MB resident) on {listen}")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        family, address = parse_address(listen)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
@@ -0,0 +1,141 @@
+"""Chromosome-sharded execution of the locus analyses over shared memory.
+
+``ChromosomeShards`` holds one or more row-aligned arrays (a collapsed CGI ×
+(Patient, Timepoint) matrix, the CGI midpoints) with their rows grouped by
+chromosome. With ``shared=True`` every array is copied once into a
+``multiprocessing.shared_memory`` block; the small picklable ``handle``
+(block names, shapes, dtypes and each chromosome's row slice) is all a task
+carries, and a worker maps the blocks on first use with ``shard_block``, so
+the matrix itself is never pickled. Without sharing the arrays stay in the
+process and the same task functions run serially, which is how the scripts
+check that both modes give the same tables and figures.
+
+``map_shards(func, shards, tasks, pool)`` runs ``func(block, chrom, *args)``
+for every task ``(chrom, *args)`` and returns the results in task order, so
+a merge over them sees the chromosomes in the same order as a serial run.
+The worker count of the sharded scripts defaults to ``METHPIPE_WORKERS``
+(``--workers`` on ``python -m methpipe run``), else 1.
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from methpipe.chromosomes import chromosome_partitions
+
+WORKERS_ENV = "METHPIPE_WORKERS"
+
+SharedArray = namedtuple("SharedArray", ["name", "shape", "dtype"])
+SharedArray.__doc__ = """Name, shape and dtype string of an array in a shared memory block."""
+
+ShardHandle = namedtuple("ShardHandle", ["arrays", "rows"])
+ShardHandle.__doc__ = """Picklable view of a ``ChromosomeShards``.
+
+``arrays`` maps each array's key to its ``SharedArray`` and ``rows`` maps a
+chromosome to its ``slice`` of the (chromosome-grouped) rows.
+"""
+
+
+def default_workers(fallback=1):
+    """Worker processes from ``METHPIPE_WORKERS``, else ``fallback``."""
+    try:
+        return max(1, int(os.environ.get(WORKERS_ENV) or fallback))
+    except ValueError:
+        return fallback
+
+
+# Arrays this process has mapped (or, for unshared shards, owns): name -> (block or None, array)
+_attached = {}
+
+
+def attach(shared):
+    """The array of a ``SharedArray``, mapped once per process."""
+    if shared.name not in _attached:
+        block = shared_memory.SharedMemory(name=shared.name)
+        _attached[shared.name] = (block, np.ndarray(shared.shape, dtype=np.dtype(shared.dtype), buffer=block.buf))
+    return _attached[shared.name][1]
+
+
+def shard_block(handle, chrom):
+    """``{key: rows of chrom}`` of every array of a shard handle (views, no copies)."""
+    rows = handle.rows[chrom]
+    return {key: attach(shared)[rows] for key, shared in handle.arrays.items()}
+
+
+class ChromosomeShards:
+    """Row-aligned arrays grouped by chromosome, optionally in shared memory.
+
+    ``arrays`` maps a key to an array whose rows are already grouped so that
+    ``rows[chrom]`` is a slice (``chromosome_shards`` does the grouping).
+    Close it (or use it as a context manager) once the workers are done;
+    that releases the shared memory blocks.
+    """
+
+    def __init__(self, arrays, rows, order=None, shared=True):
+        self.rows = dict(rows)
+        self.order = order
+        self._blocks = []
+        self._names = []
+        handles = {}
+        for key, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            if shared:
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+                self._blocks.append(block)
+                name = block.name
+            else:
+                name = f"local-{os.getpid()}-{id(self)}-{key}"
+                _attached[name] = (None, values)
+            self._names.append(name)
+            handles[key] = SharedArray(name, values.shape, values.dtype.str)
+        self.handle = ShardHandle(handles, self.rows)
+
+    def close(self):
+        for name in self._names:
+            _attached.pop(name, None)
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+        self._names = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def chromosome_shards(arrays, chroms, shared=True):
+    """``ChromosomeShards`` of row-aligned ``arrays`` with the rows grouped by ``chroms``.
+
+    The rows of every chromosome keep their order (see
+    ``chromosome_partitions``); ``shards.order`` maps the grouped rows back
+    to the original row positions.
+    """
+    order, rows = chromosome_partitions(chroms)
+    identity = np.array_equal(order, np.arange(len(order)))
+    grouped = {key: values if identity else np.asarray(values)[order] for key, values in arrays.items()}
+    return ChromosomeShards(grouped, rows, order=order, shared=shared)
+
+
+def shard_pool(workers):
+    """A ``ProcessPoolExecutor`` with ``workers`` processes, or ``None`` to run in this process."""
+    return ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+
+def run_shard(job):
+    func, handle, task = job
+    return func(shard_block(handle, task[0]), *task)
+
+
+def map_shards(func, shards, tasks, pool=None):
+    """``[func(block, chrom, *args) for (chrom, *args) in tasks]``, in a pool when one is given.
+
+    ``func`` must be importable by the workers (a module-level function).
+    """
+    jobs = [(func, shards.handle, tuple(task)) for task in tasks]
+    return list(pool.map(run_shard, jobs) if pool else map(run_shard, jobs))
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+PatientPanel = namedtuple("PatientPanel", ["patient", "timepoints", "x", "ranks", "samples", "highlight"])
+PatientPanel.__doc__ = """Rank data for one patient's slope chart.
+
+``ranks`` is a wide gene × point DataFrame (one column per sample, or per
+timepoint when replicates are averaged), ``x`` the x position of every
+column, ``timepoints`` the ordered tick labels, ``samples`` the sample name
+behind each column (None when averaged) and ``highlight`` the sorted list of
+genes that reach the per-sample top k.
+"""
+
+
+def sample_metadata(columns, timepoint_map, patient_map, sort_key):
+    """Patient/timepoint table for the rank matrix columns, ordered by timepoint."""
+    meta = pd.DataFrame({
+        "Sample": list(columns),
+        "Timepoint": [timepoint_map.get(c) for c in columns],
+        "Patient": [patient_map.get(c) for c in columns],
+    }).dropna(subset=["Patient", "Timepoint"])
+    meta["Order"] = meta["Timepoint"].map(sort_key)
+    return meta.sort_values("Order", kind="stable").drop(columns="Order")
+
+
+def build_patient_panels(ranks, timepoint_map, patient_map, sort_key, top_by_sample=None,
+                         average_replicates=False, min_timepoints=2):
+    """Yield a ``PatientPanel`` per patient straight from the wide rank matrix.
+
+    Highlight genes are the union of ``top_by_sample[sample]`` over the
+    patient's samples, so nothing has to be melted to find them.
+    """
+    meta = sample_metadata(ranks.columns, timepoint_map, patient_map, sort_key)
+    for patient, pmeta in meta.groupby("Patient", sort=True):
+        timepoints = list(dict.fromkeys(pmeta["Timepoint"]))
+        if len(timepoints) < min_timepoints:
+            continue
+        position = {tp: i for i, tp in enumerate(timepoints)}
+
+        if average_replicates:
+            panel = ranks[pmeta["Sample"]].T.groupby(pmeta["Timepoint"].to_numpy(), sort=False).mean().T
+            panel = panel[timepoints]
+            samples = None
+            x = np.arange(len(timepoints))
+        else:
+            panel = ranks[pmeta["Sample"]]
+            samples = pmeta["Sample"].tolist()
+            x = pmeta["Timepoint"].map(position).to_numpy()
+
+        highlight = set()
+        if top_by_sample is not None:
+            for sample in pmeta["Sample"]:
+                highlight.update(top_by_sample[sample].tolist())
+        yield PatientPanel(patient, timepoints, x, panel, samples, sorted(highlight))
+
+
+def export_melted(ranks, timepoint_map, patient_map, path, sort_key=None, average_replicates=False,
+                  chunk_samples=50, chunk_genes=1000):
+    """Write the full long-format rank table to ``path`` in chunks.
+
+    Label columns are built as categoricals per chunk so peak memory stays
+    at one chunk. Without ``average_replicates`` rows follow ``melt`` order
+    (Gene, Sample, Rank, Timepoint, Patient) and are written
+    ``chunk_samples`` samples at a time; with it, rows are replicate-averaged
+    (Gene, Patient, Timepoint, Rank) in sorted order and are written
+    ``chunk_genes`` genes at a time.
+    """
+    meta = pd.DataFrame({
+        "Sample": list(ranks.columns),
+        "Timepoint": [timepoint_map.get(c) for c in ranks.columns],
+        "Patient": [patient_map.get(c) for c in ranks.columns],
+    }).dropna(subset=["Patient", "Timepoint"])
+    genes = pd.Categorical(ranks.index)
+    tp_categories = sorted(meta["Timepoint"].unique(), key=sort_key)
+    patient_categories = sorted(meta["Patient"].unique())
+    columns = ["Gene", "Patient", "Timepoint", "Rank"] if average_replicates else ["Gene", "Sample", "Rank", "Timepoint", "Patient"]
+    pd.DataFrame(columns=columns).to_csv(path, index=False)
+
+    if not average_replicates:
+        for start in range(0, len(meta), chunk_samples):
+            chunk_meta = meta.iloc[start:start + chunk_samples]
+            block = ranks[chunk_meta["Sample"]]
+            n_genes, n_samples = block.shape
+            chunk = pd.DataFrame({
+                "Gene": genes[np.tile(np.arange(n_genes), n_samples)],
+                "Sample": pd.Categorical(np.repeat(chunk_meta["Sample"].to_numpy(), n_genes)),
+                "Rank": block.to_numpy().ravel(order="F"),
+                "Timepoint": pd.Categorical(np.repeat(chunk_meta["Timepoint"].to_numpy(), n_genes), categories=tp_categories),
+                "Patient": pd.Categorical(np.repeat(chunk_meta["Patient"].to_numpy(), n_genes), categories=patient_categories),
+            })
+            chunk.to_csv(path, index=False, mode="a", header=False)
+        return
+
+    keys = [meta["Patient"].to_numpy(), meta["Timepoint"].to_numpy()]
+    sorted_genes = ranks.index.sort_values()
+    for start in range(0, len(sorted_genes), chunk_genes):
+        block = ranks.loc[sorted_genes[start:start + chunk_genes], meta["Sample"]]
+        averaged = block.T.groupby(keys).mean()  # sorted (Patient, Timepoint) × genes
+        n_keys, n_genes = averaged.shape
+        chunk = pd.DataFrame({
+            "Gene": pd.Categorical(np.repeat(averaged.columns.to_numpy(), n_keys)),
+            "Patient": pd.Categorical(np.tile(averaged.index.get_level_values(0), n_genes), categories=patient_categories),
+            "Timepoint": pd.Categorical(np.tile(averaged.index.get_level_values(1), n_genes), categories=tp_categories),
+            "Rank": averaged.to_numpy().ravel(order="F"),
+        })
+        chunk.to_csv(path, index=False, mode="a", header=False)
+
+
+def draw_slope_chart(ax, panel, highlight_colors=None, background_style=None, highlight_style=None):
+    """Draw a patient's rank trajectories with two LineCollections.
+
+    All background genes go into one collection and the highlighted genes
+    into a second one with per-line colors, so the number of artists does
+    not grow with the number of genes. Returns legend handles (one proxy
+    ``Line2D`` per highlighted gene, in ``panel.highlight`` order).
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
+    highlight_colors = highlight_colors or {}
+    background_style = dict({"color": "black", "linewidth": 0.8, "alpha": 0.6}, **(background_style or {}))
+    highlight_style = dict({"linewidth": 0.8, "alpha": 0.6}, **(highlight_style or {}))
+
+    values = panel.ranks.to_numpy(dtype=float)
+    is_highlight = panel.ranks.index.isin(list(highlight_colors))
+    x = np.broadcast_to(np.asarray(panel.x, dtype=float), values.shape)
+    segments = np.stack([x, values], axis=-1)  # genes × points × (x, y)
+
+    if (~is_highlight).any():
+        ax.add_collection(LineCollection(segments[~is_highlight], **background_style))
+
+    handles = []
+    if is_highlight.any():
+        genes = panel.ranks.index[is_highlight]
+        colors = [highlight_colors[g] for g in genes]
+        ax.add_collection(LineCollection(segments[is_highlight], colors=colors, **highlight_style))
+        handle_style = {k: v for k, v in highlight_style.items() if k in ("linewidth", "linestyle", "alpha")}
+        handles = [Line2D([], [], color=highlight_colors[g], label=g, **handle_style) for g in highlight_colors]
+
+    ax.autoscale_view()
+    ax.set_xticks(range(len(panel.timepoints)))
+    ax.set_xticklabels(panel.timepoints)
+    return handles
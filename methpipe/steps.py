@@ -0,0 +1,285 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from methpipe import dtypes, matrixstore, metrics
+from methpipe.dataset import read_matrix_values
+from methpipe.geneindex import gene_index
+from methpipe.progress import progress as track
+
+DATA_DIR = "data"
+OUTPUT_DIR = "output"
+TOTAL_ROW_LABEL = "Total CpG island fragments counts for this particular spreadsheet"
+FILTERED_SUFFIX = "_samples-of-interest.xlsx"
+MERGED_FILES = {"glob20": "merged_output_glob20.xlsx", "globmin80": "merged_output_globmin80.xlsx"}
+RATIO_MATRIX_FILE = "scaled_fragment_ratios_matrix.xlsx"
+ANNOTATION_FILE = "structured_gene_annotation.csv"
+GENE_MAP_FILE = "gene_cgi_map.csv"
+GENE_MATRIX_FILE = "gene_methylation_matrix.csv"
+
+
+# === Step 1: filter by patient ===
+
+def read_patient_ids(path):
+    return pd.read_excel(path).iloc[:, 0].dropna().astype(str).tolist()
+
+
+def load_raw_runs(input_dir=DATA_DIR):
+    """``({file name: frame}, patient_ids)`` for the Excel files in ``input_dir``.
+
+    The file whose name contains "patient" is the patient ID list; every
+    other ``.xlsx``/``.xls`` file is a methylation run. Files are taken in
+    name order, so merged sample columns come out in a stable order.
+    """
+    runs = {}
+    patient_ids = []
+    for fname in sorted(os.listdir(input_dir)):
+        if fname.endswith(".xlsx") or fname.endswith(".xls"):
+            fpath = os.path.join(input_dir, fname)
+            if "patient" in fname.lower():
+                patient_ids = read_patient_ids(fpath)
+            else:
+                runs[fname] = dtypes.as_labels(pd.read_excel(fpath))
+    return runs, patient_ids
+
+
+def filter_patient_columns(df, patient_ids):
+    """Keep the label column plus every sample column that names one of ``patient_ids``."""
+    return df[
+        [df.columns[0]] +
+        [col for col in df.columns[1:] if any(pid in str(col) for pid in patient_ids)]
+    ]
+
+
+# === Step 2: merge runs ===
+
+def run_group(fname):
+    """``"glob20"``/``"globmin80"`` for a run file name, else ``None``."""
+    if "Glob20" in fname:
+        return "glob20"
+    if "GlobMin80" in fname:
+        return "globmin80"
+    return None
+
+
+def load_filtered_runs(output_dir=OUTPUT_DIR):
+    """The step 1 workbooks in ``output_dir`` that belong to a merge group."""
+    runs = {}
+    for fname in sorted(os.listdir(output_dir)):
+        if fname.endswith(".xlsx") and run_group(fname) is not None:
+            runs[fname] = dtypes.as_labels(pd.read_excel(os.path.join(output_dir, fname), sheet_name="Sheet1"))
+    return runs
+
+
+def merge_runs(frames):
+    """Merge run frames sample-wise on their ``Header`` labels (outer join)."""
+    return pd.concat([df.set_index("Header").T for df in frames], axis=0).T.reset_index()
+
+
+def merge_run_groups(runs):
+    """``{group: merged frame}`` for the Glob20 and GlobMin80 runs in ``runs``."""
+    groups = {}
+    for fname, df in runs.items():
+        group = run_group(fname)
+        if group is not None:
+            groups.setdefault(group, []).append(df)
+    return {group: dtypes.as_labels(merge_runs(frames)) for group, frames in groups.items()}
+
+
+# === Step 3: scaled fragment ratios ===
+
+def find_merged_files(output_dir=OUTPUT_DIR):
+    """Paths of the merged Glob20 and GlobMin80 workbooks in ``output_dir``."""
+    files_in_dir = os.listdir(output_dir)
+    glob20_file = next((os.path.join(output_dir, f) for f in files_in_dir if "output_glob20" in f and f.endswith(".xlsx")), None)
+    globmin80_file = next((os.path.join(output_dir, f) for f in files_in_dir if "output_globmin80" in f and f.endswith(".xlsx")), None)
+    if not glob20_file or not globmin80_file:
+        raise FileNotFoundError("One or both input files ('output_glob20_*.xlsx', 'output_globmin80_*.xlsx') not found in the 'output' directory.")
+    return glob20_file, globmin80_file
+
+
+def read_merged_runs(output_dir=OUTPUT_DIR):
+    """``{"glob20": frame, "globmin80": frame}`` read from the merged workbooks."""
+    glob20_file, globmin80_file = find_merged_files(output_dir)
+    return {"glob20": dtypes.as_labels(pd.read_excel(glob20_file)), "globmin80": dtypes.as_labels(pd.read_excel(globmin80_file))}
+
+
+def scaled_ratio_matrix(glob20_df, globmin80_df, scale=1000):
+    """Glob20 / GlobMin80 × ``scale`` for the CGI rows and the total-count row.
+
+    The row mask is taken from the Glob20 labels and applied to both
+    frames, as in ``step_3_convert_to_aberrant_signals.py``.
+    """
+    filter_condition = glob20_df.iloc[:, 0].str.contains("CGI_chr") | (glob20_df.iloc[:, 0] == TOTAL_ROW_LABEL)
+    glob20_filtered = glob20_df[filter_condition]
+    globmin80_filtered = globmin80_df[filter_condition]
+    assert glob20_filtered.shape == globmin80_filtered.shape, "Filtered DataFrames do not have the same shape."
+
+    ratio_df = dtypes.as_values((glob20_filtered.iloc[:, 1:].astype(float) / globmin80_filtered.iloc[:, 1:].astype(float)) * scale)
+    return pd.concat([glob20_filtered.iloc[:, 0].reset_index(drop=True), ratio_df.reset_index(drop=True)], axis=1)
+
+
+def save_ratio_store(path):
+    """Write the matrix store of the ratio workbook ``path`` (just written) when ``METHPIPE_MATRIX_STORE`` is set.
+
+    The values are read back from the workbook rather than taken from the
+    frame that was written: the Excel round trip changes the last digits of
+    some ratios, and the store must hold what the file readers see.
+    """
+    if matrixstore.enabled():
+        matrixstore.save_store(read_matrix_values(path), path)
+
+
+def save_matrix_store(values, path):
+    """Write the matrix store of the file ``path`` (just written) when ``METHPIPE_MATRIX_STORE`` is set."""
+    if matrixstore.enabled():
+        matrixstore.save_store(values, path)
+
+
+# === Step 4: gene annotation ===
+
+def find_excel_file(directory, keyword):
+    for file_name in os.listdir(directory):
+        if keyword in file_name and file_name.endswith(".xlsx"):
+            return os.path.join(directory, file_name)
+    raise FileNotFoundError(f"No Excel file with keyword '{keyword}' found in directory '{directory}'")
+
+
+def read_matrix_labels(input_excel):
+    """Row labels (first column below the header) of a matrix workbook."""
+    return pd.read_excel(input_excel, sheet_name=0, header=None).iloc[1:, 0]
+
+
+def gene_annotation(labels):
+    """Split ``CGI_chr_start_end_GENE..._probe`` labels into an annotation table.
+
+    Columns: ``chr``, start/end coordinates, ``Gene1..GeneN`` (blank when a
+    CGI has fewer genes) and the probe ID.
+    """
+    cgi_names_clean = pd.Series(labels).dropna().astype(str)
+    cgi_names_clean = cgi_names_clean[cgi_names_clean.str.startswith("CGI_")]
+
+    processed_rows = []
+    for parts in cgi_names_clean.str.split("_").tolist():
+        if parts[0] == "CGI":
+            parts = parts[1:]
+
+        if parts and parts[-1].isdigit():
+            probe_id = parts.pop()
+        else:
+            probe_id = ""
+
+        chr_part = parts[0] if len(parts) > 0 else ""
+        start = parts[1] if len(parts) > 1 else ""
+        end = parts[2] if len(parts) > 2 else ""
+        genes = parts[3:] if len(parts) > 3 else []
+        processed_rows.append([chr_part, start, end] + genes + [probe_id])
+
+    max_genes = max(len(row) - 4 for row in processed_rows)
+    column_names = ["chr", "start genomic coordinate", "end genomic coordinate"]
+    gene_columns = [f"Gene{i+1}" for i in range(max_genes)]
+    final_columns = column_names + gene_columns + ["CGI index or probe ID"]
+
+    normalized_rows = [
+        row[:3] + row[3:-1] + [""] * (max_genes - len(row[3:-1])) + [row[-1]]
+        for row in processed_rows
+    ]
+    return pd.DataFrame(normalized_rows, columns=final_columns)
+
+
+# === Step 5: gene → CGI map ===
+
+def find_annotation_file(output_dir=OUTPUT_DIR):
+    candidate_files = glob.glob(os.path.join(output_dir, "*gene_annotation*.xlsx")) + \
+                      glob.glob(os.path.join(output_dir, "*gene_annotation*.csv"))
+    if not candidate_files:
+        raise FileNotFoundError("No Excel or CSV file with 'gene_annotation' in filename was found in the 'output/' folder.")
+    return candidate_files[0]
+
+
+def read_table(path):
+    if path.endswith(".xlsx"):
+        return pd.read_excel(path)
+    elif path.endswith(".csv"):
+        return pd.read_csv(path)
+    raise ValueError("Unsupported file format. Only .xlsx or .csv are supported.")
+
+
+def gene_cgi_map(gene_annot):
+    """Unique (``cgi_id``, ``gene_name``) pairs, with ``cgi_id`` as ``chr:start-end``.
+
+    Blank gene cells count as missing, so an annotation passed in memory
+    gives the same map as one read back from CSV.
+    """
+    gene_cols = [col for col in gene_annot.columns if col.startswith("Gene")]
+    if not gene_cols:
+        raise ValueError("No columns starting with 'Gene' found in the annotation file.")
+
+    gene_annot_long = gene_annot.melt(
+        id_vars=["chr", "start genomic coordinate", "end genomic coordinate"],
+        value_vars=gene_cols,
+        var_name="gene_col",
+        value_name="gene_name"
+    )
+    gene_annot_long["gene_name"] = gene_annot_long["gene_name"].replace("", np.nan)
+    gene_annot_long = gene_annot_long.dropna(subset=["gene_name"])
+    gene_annot_long["cgi_id"] = gene_annot_long.apply(
+        lambda row: f"{row['chr']}:{int(row['start genomic coordinate'])}-{int(row['end genomic coordinate'])}",
+        axis=1
+    )
+    return gene_annot_long[["cgi_id", "gene_name"]].drop_duplicates()
+
+
+# === Step 6: gene methylation matrix ===
+
+def find_file(directory, keyword):
+    files = glob.glob(os.path.join(directory, f"*{keyword}*"))
+    if not files:
+        raise FileNotFoundError(f"No file containing '{keyword}' found in '{directory}'")
+    return files[0]
+
+
+def read_gene_matrix(path):
+    """Gene × sample matrix written by step 6, mapped from its store when one is up to date."""
+    store = matrixstore.fresh_store(path)
+    if store is not None:
+        return matrixstore.as_frame(matrixstore.open_matrix(store, mmap_mode="c"))
+    gene_matrix = pd.read_excel(path, index_col=0) if path.endswith(".xlsx") else pd.read_csv(path, index_col=0)
+    gene_matrix.columns.name = "Sample"
+    return gene_matrix
+
+
+def read_cpg_matrix(path):
+    return pd.read_excel(path, index_col=0) if path.endswith('.xlsx') else pd.read_csv(path, sep="\t", index_col=0)
+
+
+def gene_methylation_matrix(cpg_matrix, gene_annot_raw, progress=True, matrix_path=None):
+    """Gene × sample matrix: per gene, the sum of every CpG row whose label contains the gene name.
+
+    The matches come from a ``GeneIndex`` (see ``methpipe.geneindex``),
+    saved next to ``matrix_path`` (the file ``cpg_matrix`` was read from)
+    when it is given.
+    """
+    metrics.begin("match")
+    index = gene_index(cpg_matrix.index, gene_annot_raw['gene_name'], matrix_path)
+    rows_of = index.rows
+    if dtypes.compact():
+        # Only the matched CGI rows are summed: keep those as uint32 counts
+        kept = np.unique(index.indices)
+        cpg_matrix = dtypes.as_counts(cpg_matrix.iloc[kept])
+        rows_of = lambda gene: np.searchsorted(kept, index.rows(gene))
+
+    metrics.begin("aggregate")
+    gene_rows = []
+    for gene in track(index.genes, desc="Building gene methylation matrix", disable=not progress):
+        summed_row = cpg_matrix.iloc[rows_of(gene)].sum(axis=0)
+        summed_row.name = gene
+        gene_rows.append(summed_row)
+
+    gene_methylation_matrix = dtypes.as_counts(pd.DataFrame(gene_rows))
+    gene_methylation_matrix.index.name = "Gene"
+    gene_methylation_matrix.columns.name = "Sample"
+    metrics.end()
+    return gene_methylation_matrix
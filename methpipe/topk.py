@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+TopK = namedtuple("TopK", ["indices", "values"])
+
+
+def topk(values, k, largest=True):
+    """Select the k best entries of every column of a 1-D or 2-D array.
+
+    Uses ``np.argpartition`` so only the k winners per column are sorted.
+    Ties are broken by row position (earlier rows first) and NaNs are ranked
+    last, which matches ``sort_values(kind="stable").head(k)`` and
+    ``nsmallest(k)`` / ``nlargest(k)`` with ``keep="first"``.
+
+    Returns ``TopK(indices, values)``; both have shape ``(k, n_columns)``
+    (or ``(k,)`` for 1-D input) and are ordered best first.
+    """
+    arr = np.asarray(values, dtype=float)
+    squeeze = arr.ndim == 1
+    if squeeze:
+        arr = arr[:, None]
+    n_rows, n_cols = arr.shape
+    k = min(int(k), n_rows)
+    if k <= 0:
+        empty = np.empty((0, n_cols), dtype=np.intp)
+        return TopK(empty[:, 0] if squeeze else empty, arr[:0, 0] if squeeze else arr[:0])
+
+    # Smaller key = better; NaNs share +inf with real infinities and are
+    # pushed behind them when the boundary tie is resolved below.
+    nan = np.isnan(arr)
+    key = -arr if largest else arr.copy()
+    key[nan] = np.inf
+
+    if k < n_rows:
+        threshold = np.partition(key, k - 1, axis=0)[k - 1]
+        chosen = key < threshold
+        need = k - chosen.sum(axis=0)
+        tie = key == threshold
+        tie_real = tie & ~nan
+        take_real = tie_real & (np.cumsum(tie_real, axis=0) <= need)
+        need = need - take_real.sum(axis=0)
+        tie_nan = tie & nan
+        take_nan = tie_nan & (np.cumsum(tie_nan, axis=0) <= need)
+        chosen |= take_real | take_nan
+        # nonzero on the transpose walks column by column in row order
+        rows = np.nonzero(chosen.T)[1].reshape(n_cols, k).T
+    else:
+        rows = np.broadcast_to(np.arange(n_rows)[:, None], (n_rows, n_cols))
+
+    cols = np.arange(n_cols)
+    sel_key = key[rows, cols]
+    sel_nan = nan[rows, cols]
+    order = np.lexsort((rows, sel_key, sel_nan), axis=0)
+    rows = np.take_along_axis(rows, order, axis=0)
+    picked = arr[rows, cols]
+    if squeeze:
+        return TopK(rows[:, 0], picked[:, 0])
+    return TopK(rows, picked)
+
+
+def topk_labels(frame, k, largest=True):
+    """Row labels of the top-k entries for every column of ``frame``.
+
+    Returns a DataFrame with one column per input column and k rows,
+    best first.
+    """
+    result = topk(frame.to_numpy(dtype=float), k, largest=largest)
+    labels = np.asarray(frame.index)[result.indices]
+    return pd.DataFrame(labels, columns=frame.columns)
+
+
+def topk_series(series, k, largest=True):
+    """Drop-in for ``series.sort_values(ascending=not largest).head(k)``."""
+    result = topk(series.to_numpy(dtype=float), k, largest=largest)
+    return series.iloc[result.indices]
+
+
+def topk_rows(frame, column, k, largest=True):
+    """Drop-in for ``frame.sort_values(column, ascending=not largest).head(k)``."""
+    result = topk(frame[column].to_numpy(dtype=float), k, largest=largest)
+    return frame.iloc[result.indices]
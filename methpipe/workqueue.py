@@ -0,0 +1,336 @@
+"""File-based work queue for splitting plot and analysis jobs across hosts.
+
+Hosts that share a volume (e.g. NFS) but no message broker coordinate
+through a queue folder on it:
+
+- ``queue.json``: the script, the task ids in order and the context every
+  task needs (patient IDs, the matched CGIs of each gene, ...); written
+  last, so workers only start on a complete queue;
+- ``pending/<id>.json``: a task nobody has claimed yet;
+- ``claimed/<id>@<host>-<pid>.json``: a task a worker is running;
+- ``done/<id>.json`` and ``results/<id>/``: a finished task and its output
+  files (``outputs.json`` lists their names plus any metadata);
+- ``failed/<id>.json``: a task that raised, with the traceback.
+
+A worker claims a task by renaming its file from ``pending/`` to
+``claimed/``. The rename is atomic, so exactly one worker gets each task
+and no lock server is needed. Outputs are written to a temporary folder
+and renamed into ``results/<id>/`` before the task is marked done. The
+reducer waits until every task is done and reads the outputs in task
+order, so the archives and tables it assembles are the same as a serial
+run's. Claims of a worker that died are put back with ``requeue``.
+
+The bubble plots (one task per patient × chromosome) and the gene deltas
+of ``heatmap-lineplot-barplot_v3.py`` (one task per comparison × gene
+block) have a distributed mode; run every role from the project folder:
+
+    python scripts/locus/bubbleplot_generator_v9_gridsoff.py --queue /nfs/q/bubbles --submit
+    python scripts/locus/bubbleplot_generator_v9_gridsoff.py --queue /nfs/q/bubbles --work     # on every host
+    python scripts/locus/bubbleplot_generator_v9_gridsoff.py --queue /nfs/q/bubbles --reduce
+
+``python -m methpipe queue local SCRIPT --hosts N`` runs the three roles
+with ``N`` local worker processes standing in for the hosts.
+"""
+import json
+import os
+import shutil
+import socket
+import time
+import traceback
+from collections import namedtuple
+
+QUEUE_FORMAT = "methpipe-queue"
+QUEUE_VERSION = 1
+QUEUE_DIRNAME = ".methpipe-queue"
+MANIFEST_NAME = "queue.json"
+OUTPUTS_NAME = "outputs.json"
+STATES = ("pending", "claimed", "done", "failed")
+
+ClaimedTask = namedtuple("ClaimedTask", ["id", "spec", "path"])
+ClaimedTask.__doc__ = """A task claimed by this worker: its id, the task dict and its file in ``claimed/``."""
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.{worker_name()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(payload, fh)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def _task_id(name):
+    """Task id of a file name in one of the state folders (``<id>.json`` or ``<id>@<worker>.json``)."""
+    return name[:-len(".json")].split("@", 1)[0]
+
+
+class TaskQueue:
+    """A queue folder (see the module docstring)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._manifest = None
+
+    def folder(self, state):
+        return os.path.join(self.path, state)
+
+    def _names(self, state):
+        try:
+            return sorted(name for name in os.listdir(self.folder(state)) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    # === Submitting ===
+
+    def submit(self, tasks, context=None, script=None, replace=False):
+        """Write ``tasks`` (JSON-serializable dicts) as pending task files; returns their ids.
+
+        An existing queue in the folder is an error unless ``replace``.
+        """
+        if os.path.exists(os.path.join(self.path, MANIFEST_NAME)) or any(self._names(state) for state in STATES):
+            if not replace:
+                raise FileExistsError(f"{self.path} already holds a queue; remove it or submit with replace=True")
+            self.clear()
+        for state in STATES + ("results",):
+            os.makedirs(self.folder(state), exist_ok=True)
+        width = max(6, len(str(len(tasks))))
+        ids = [f"{i:0{width}d}" for i in range(len(tasks))]
+        for task_id, spec in zip(ids, tasks):
+            _write_json(os.path.join(self.folder("pending"), f"{task_id}.json"), spec)
+        _write_json(os.path.join(self.path, MANIFEST_NAME), {
+            "format": QUEUE_FORMAT,
+            "version": QUEUE_VERSION,
+            "script": script,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "tasks": ids,
+            "context": context or {},
+        })
+        self._manifest = None
+        return ids
+
+    def clear(self):
+        if os.path.exists(os.path.join(self.path, MANIFEST_NAME)):
+            os.remove(os.path.join(self.path, MANIFEST_NAME))
+        for state in STATES + ("results",):
+            shutil.rmtree(self.folder(state), ignore_errors=True)
+        self._manifest = None
+
+    def manifest(self, wait=None, interval=1.0):
+        """The parsed ``queue.json``; with ``wait`` seconds, waits for a queue still being submitted."""
+        if self._manifest is None:
+            deadline = None if wait is None else time.monotonic() + wait
+            path = os.path.join(self.path, MANIFEST_NAME)
+            while not os.path.exists(path):
+                if deadline is None or time.monotonic() >= deadline:
+                    raise FileNotFoundError(f"No queue in {self.path} (missing {MANIFEST_NAME})")
+                time.sleep(interval)
+            manifest = _read_json(path)
+            if manifest.get("format") != QUEUE_FORMAT or manifest.get("version") != QUEUE_VERSION:
+                raise ValueError(f"{self.path} is not a version {QUEUE_VERSION} {QUEUE_FORMAT} folder")
+            self._manifest = manifest
+        return self._manifest
+
+    def context(self):
+        return self.manifest()["context"]
+
+    # === Working ===
+
+    def claim(self):
+        """Claim the next pending task, or return ``None`` when there is none left."""
+        worker = worker_name()
+        while True:
+            names = self._names("pending")
+            if not names:
+                return None
+            for name in names:
+                task_id = _task_id(name)
+                claim_path = os.path.join(self.folder("claimed"), f"{task_id}@{worker}.json")
+                try:
+                    os.rename(os.path.join(self.folder("pending"), name), claim_path)
+                except FileNotFoundError:
+                    continue  # another worker was faster
+                try:
+                    os.utime(claim_path)  # the claim time, for requeue(stale)
+                    return ClaimedTask(task_id, _read_json(claim_path), claim_path)
+                except FileNotFoundError:
+                    continue  # requeued right away
+
+    def complete(self, task, files=(), meta=None):
+        """Store ``files`` (``[(name, bytes), ...]``) and ``meta`` as the task's outputs and mark it done."""
+        result_path = os.path.join(self.folder("results"), task.id)
+        tmp_path = f"{result_path}.{worker_name()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        names = []
+        for i, (name, data) in enumerate(files):
+            with open(os.path.join(tmp_path, f"{i:05d}.bin"), "wb") as fh:
+                fh.write(data)
+            names.append(name)
+        _write_json(os.path.join(tmp_path, OUTPUTS_NAME), {"files": names, "meta": meta})
+        try:
+            os.rename(tmp_path, result_path)
+        except OSError:
+            # A requeued copy of the task finished first; its outputs are the same
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self._finish(task, "done")
+
+    def fail(self, task, error):
+        _write_json(os.path.join(self.folder("failed"), f"{task.id}.json"),
+                    {"task": task.spec, "worker": worker_name(), "error": error})
+        try:
+            os.remove(task.path)
+        except FileNotFoundError:
+            pass
+
+    def _finish(self, task, state):
+        try:
+            os.rename(task.path, os.path.join(self.folder(state), f"{task.id}.json"))
+        except FileNotFoundError:
+            # Requeued meanwhile: drop the pending copy so the task is not run again
+            try:
+                os.remove(os.path.join(self.folder("pending"), f"{task.id}.json"))
+            except FileNotFoundError:
+                pass
+            _write_json(os.path.join(self.folder(state), f"{task.id}.json"), task.spec)
+
+    def requeue(self, stale=None, failed=False):
+        """Put claimed tasks (only those claimed more than ``stale`` seconds ago, if given) back to pending.
+
+        With ``failed``, failed tasks are retried too. Returns the requeued ids.
+        """
+        now = time.time()
+        ids = []
+        for name in self._names("claimed"):
+            path = os.path.join(self.folder("claimed"), name)
+            try:
+                if stale is not None and now - os.path.getmtime(path) < stale:
+                    continue
+                os.rename(path, os.path.join(self.folder("pending"), f"{_task_id(name)}.json"))
+            except FileNotFoundError:
+                continue  # finished meanwhile
+            ids.append(_task_id(name))
+        if failed:
+            for name in self._names("failed"):
+                path = os.path.join(self.folder("failed"), name)
+                _write_json(os.path.join(self.folder("pending"), name), _read_json(path)["task"])
+                os.remove(path)
+                ids.append(_task_id(name))
+        return ids
+
+    # === Reducing ===
+
+    def status(self):
+        """``{state: number of tasks}`` plus ``"workers"``: claimed tasks per worker."""
+        counts = {state: len(self._names(state)) for state in STATES}
+        workers = {}
+        for name in self._names("claimed"):
+            worker = name[:-len(".json")].split("@", 1)[1]
+            workers[worker] = workers.get(worker, 0) + 1
+        counts["workers"] = workers
+        return counts
+
+    def failures(self):
+        return {_task_id(name): _read_json(os.path.join(self.folder("failed"), name)) for name in self._names("failed")}
+
+    def wait(self, timeout=None, interval=2.0, echo=print):
+        """Block until every task is done; raises ``RuntimeError`` on failed tasks or after ``timeout`` seconds."""
+        total = len(self.manifest()["tasks"])
+        deadline = None if timeout is None else time.monotonic() + timeout
+        reported = None
+        while True:
+            status = self.status()
+            if status["failed"]:
+                first_id, first = next(iter(self.failures().items()))
+                raise RuntimeError(f"{status['failed']} task(s) in {self.path} failed; task {first_id}:\n{first['error']}")
+            if status["done"] >= total:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                raise RuntimeError(f"Timed out: {status['done']}/{total} task(s) done in {self.path}")
+            if (status["done"], status["claimed"]) != reported:
+                reported = (status["done"], status["claimed"])
+                echo(f"Waiting for tasks: {status['done']}/{total} done, {status['claimed']} running, {status['pending']} pending")
+            time.sleep(interval)
+
+    def outputs(self, task_id):
+        """``(files, meta)`` of a finished task; ``files`` is ``[(name, bytes), ...]`` in the order they were stored."""
+        result_path = os.path.join(self.folder("results"), task_id)
+        outputs = _read_json(os.path.join(result_path, OUTPUTS_NAME))
+        files = []
+        for i, name in enumerate(outputs["files"]):
+            with open(os.path.join(result_path, f"{i:05d}.bin"), "rb") as fh:
+                files.append((name, fh.read()))
+        return files, outputs["meta"]
+
+    def results(self):
+        """``(task_id, files, meta)`` of every task, in submission order."""
+        for task_id in self.manifest()["tasks"]:
+            files, meta = self.outputs(task_id)
+            yield task_id, files, meta
+
+
+def work(queue, run, max_tasks=None, echo=print):
+    """Claim and run tasks until none are pending; returns the number of tasks run.
+
+    ``run(spec)`` returns ``(files, meta)`` for ``TaskQueue.complete``. A task
+    that raises is recorded in ``failed/`` and the worker moves on.
+    """
+    queue.manifest(wait=60)
+    count = 0
+    while max_tasks is None or count < max_tasks:
+        task = queue.claim()
+        if task is None:
+            break
+        try:
+            files, meta = run(task.spec)
+        except Exception:
+            echo(f"Task {task.id} failed")
+            queue.fail(task, traceback.format_exc())
+        else:
+            queue.complete(task, files, meta)
+        count += 1
+    echo(f"Worker {worker_name()}: {count} task(s) run")
+    return count
+
+
+# === Script arguments ===
+
+def add_queue_arguments(parser):
+    """``--queue DIR`` with one of ``--submit``, ``--work`` or ``--reduce`` (the distributed mode)."""
+    group = parser.add_argument_group("distributed mode (see methpipe/workqueue.py)")
+    group.add_argument("--queue", metavar="DIR", help="Queue folder on storage shared by all hosts")
+    roles = group.add_mutually_exclusive_group()
+    roles.add_argument("--submit", action="store_true", help="Write the tasks to the queue and exit")
+    roles.add_argument("--work", action="store_true", help="Run queued tasks until none are left")
+    roles.add_argument("--reduce", action="store_true", help="Wait for all tasks and assemble their outputs")
+    group.add_argument("--wait", type=float, default=None, metavar="SECONDS", help="With --reduce: give up after this long (default: wait until done)")
+    return group
+
+
+def queue_role(parser, args):
+    """``(TaskQueue, role)`` for the distributed mode, or ``(None, None)`` for a normal run."""
+    role = "submit" if args.submit else "work" if args.work else "reduce" if args.reduce else None
+    if args.queue is None:
+        if role:
+            parser.error(f"--{role} needs --queue DIR")
+        return None, None
+    if role is None:
+        parser.error("--queue needs one of --submit, --work or --reduce")
+    return TaskQueue(args.queue), role
+
+
+def print_status(queue, echo=print):
+    manifest = queue.manifest()
+    status = queue.status()
+    echo(f"{queue.path}: {manifest.get('script') or '?'}, {len(manifest['tasks'])} task(s) submitted {manifest['created']}")
+    echo("  " + ", ".join(f"{status[state]} {state}" for state in STATES))
+    for worker, n in sorted(status["workers"].items()):
+        echo(f"  {worker}: {n} running")
+    for task_id, failure in queue.failures().items():
+        last_line = failure["error"].strip().splitlines()[-1] if failure["error"].strip() else ""
+        echo(f"  ❌ {task_id} on {failure['worker']}: {last_line}")
@@ -1,7 +1,10 @@
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
 import glob
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt
+from methpipe import metrics
 
 # === Setup ===
 input_dir = "output"
@@ -43,6 +46,7 @@ else:
         print(f"\n🔍 Processing: {filename}")
 
         # === Load and reformat the scaled matrix ===
+        metrics.begin("load", file=filename)
         raw_df = pd.read_excel(filepath, header=None)
 
         samples = raw_df.iloc[0, 1:]  # skip "Header" column
@@ -54,10 +58,12 @@ else:
         })
 
         # === Annotate and prepare for plotting ===
+        metrics.begin("match")
         df["Condition"] = df["Sample"].apply(classify_condition)
         x_labels = [f"{cond}\n(n={len(df[df['Condition'] == cond])})" for cond in order]
 
         # === Export Summary Stats ===
+        metrics.begin("stats")
         stats = []
         for cond in order:
             group = df[df["Condition"] == cond]["Scaled_Ratio"]
@@ -73,6 +79,7 @@ else:
         stats_df.to_csv(stats_path, index=False)
 
         # === Plot 1: Median Scatter Plot ===
+        metrics.begin("render")
         plt.figure(figsize=(8, 6))
         for i, cond in enumerate(order):
             group = df[df['Condition'] == cond]['Scaled_Ratio']
@@ -2,10 +2,14 @@
 # Instead, it plots individual treatment cycle stages on the x-axis.
 
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
 import re
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.archive import figure_bytes
+from methpipe.figcache import FigureCache, script_salt
 
 # === Directory Setup ===
 input_dir = "output"
@@ -14,6 +18,7 @@ per_patient_dir = os.path.join(plot_dir, "per_patient")
 replicate_table_dir = os.path.join("output", "per_patient_tables")
 os.makedirs(per_patient_dir, exist_ok=True)
 os.makedirs(replicate_table_dir, exist_ok=True)
+figure_cache = FigureCache(salt=script_salt(__file__))
 
 metadata_path = os.path.join("output", "sample_metadata.csv")
 summary_stats_path = os.path.join("output", "summary_statistics.csv")
@@ -74,28 +79,39 @@ def make_main_plot_with_box(df, save_path):
     fig.savefig(save_path, dpi=300, bbox_inches='tight')
     plt.close(fig)
 
+def draw_patient_plot(pid, group, y_max):
+    fig, ax = plt.subplots(figsize=(7, 4))
+    group = group.sort_values("Timepoint")
+    ax.plot(
+        group["Timepoint"],
+        group["Scaled_Ratio"],
+        marker='o',
+        linestyle='-',
+        linewidth=2,
+        markersize=8,
+        color='navy',
+        label=pid
+    )
+    ax.set_title(f"Patient: {pid}")
+    ax.set_ylabel("Scaled Methylation Fragment Count Ratio")
+    ax.set_xlabel("Treatment Timepoint")
+    ax.set_ylim(0, y_max)
+    ax.legend()
+    fig.tight_layout()
+    png_bytes = figure_bytes(fig, "png", dpi=300)
+    plt.close(fig)
+    return png_bytes
+
 def make_per_patient_plots(df, save_dir):
+    y_max = df["Scaled_Ratio"].max() * 1.2
     for pid, group in df.groupby("Patient_ID"):
-        fig, ax = plt.subplots(figsize=(7, 4))
-        group = group.sort_values("Timepoint")
-        ax.plot(
-            group["Timepoint"],
-            group["Scaled_Ratio"],
-            marker='o',
-            linestyle='-',
-            linewidth=2,
-            markersize=8,
-            color='navy',
-            label=pid
+        # Patients whose trajectory and shared y-range are unchanged are copied from the figure cache
+        figure_cache.fetch_file(
+            figure_cache.key("patient_lineplot", pid, group, y_max),
+            os.path.join(save_dir, f"{pid}.png"),
+            lambda: draw_patient_plot(pid, group, y_max),
         )
-        ax.set_title(f"Patient: {pid}")
-        ax.set_ylabel("Scaled Methylation Fragment Count Ratio")
-        ax.set_xlabel("Treatment Timepoint")
-        ax.set_ylim(0, df["Scaled_Ratio"].max() * 1.2)
-        ax.legend()
-        fig.tight_layout()
-        fig.savefig(os.path.join(save_dir, f"{pid}.png"), dpi=300)
-        plt.close(fig)
+    figure_cache.save()
 
 def make_average_trajectory_plot(df, save_path, time_order):
     agg = df.groupby("Timepoint")["Scaled_Ratio"].agg(["mean", "std"]).reindex(time_order)
@@ -146,6 +162,7 @@ def export_boxplot_summary(df, save_path, time_order):
     summary.to_csv(save_path)
 
 # === Load Excel File ===
+metrics.begin("load")
 file_to_use = next(
     (os.path.join(input_dir, f) for f in os.listdir(input_dir)
      if "scaled_fragment_ratios_matrix" in f.lower() and f.endswith((".xlsx", ".xls"))),
@@ -159,6 +176,7 @@ sample_names = df_raw.iloc[0, 1:].tolist()
 scaled_ratios = df_raw.iloc[1, 1:].tolist()
 
 # === Build Full Raw Table ===
+metrics.begin("match")
 df_full = pd.DataFrame({
     "Sample": sample_names,
     "Scaled_Ratio": scaled_ratios
@@ -173,6 +191,7 @@ time_order = ["Baseline"] + sorted([tp for tp in df_full["Timepoint"].unique() i
 df_full["Timepoint"] = pd.Categorical(df_full["Timepoint"], categories=time_order, ordered=True)
 
 # === Save sample metadata ===
+metrics.begin("archive")
 df_full[["Sample", "Patient_ID", "Timepoint", "Replicate_ID"]].to_csv(metadata_path, index=False)
 print(f"✅ Saved sample metadata to: {metadata_path}")
 
@@ -189,16 +208,19 @@ for pid, group in df_full.groupby("Patient_ID"):
 print(f"✅ Saved per-patient replicate tables to: {replicate_table_dir}")
 
 # === Average across replicates for plotting ===
+metrics.begin("aggregate")
 df_plot = df_full.groupby(["Patient_ID", "Timepoint"], as_index=False)["Scaled_Ratio"].mean()
 valid = df_plot["Patient_ID"].value_counts()
 df_plot = df_plot[df_plot["Patient_ID"].isin(valid[valid > 1].index)]
 
 # === Summary stats ===
+metrics.begin("stats")
 summary_stats = df_plot.groupby("Timepoint")["Scaled_Ratio"].agg(["count", "mean", "median", "std"]).reindex(time_order)
 summary_stats.to_csv(summary_stats_path)
 print(f"✅ Saved summary stats to: {summary_stats_path}")
 
 # === Plot Generation ===
+metrics.begin("render")
 make_main_plot_with_box(df_plot, os.path.join(plot_dir, "methylation_longitudinal_plot.png"))
 make_per_patient_plots(df_plot, per_patient_dir)
 make_average_trajectory_plot(df_plot, os.path.join(plot_dir, "average_trajectory.png"), time_order)
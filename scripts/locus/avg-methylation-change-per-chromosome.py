@@ -1,9 +1,23 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import re
+import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt
+from methpipe import metrics
+from methpipe.chromosomes import CHR_ORDER, chromosome_codes, chromosome_summary, shard_delta_sums
+from methpipe.dataset import load_analysis_dataset
+from methpipe.replicates import collapse_replicates, paired_columns
+from methpipe.shards import chromosome_shards, default_workers, map_shards, shard_pool
+
+parser = argparse.ArgumentParser(description='Plot the average methylation change per chromosome.')
+parser.add_argument('--bootstrap', type=int, default=0, help='Number of patient-level bootstrap replicates for per-chromosome confidence intervals (0 = off)')
+parser.add_argument('--ci', type=float, default=0.95, help='Confidence level for the bootstrap intervals')
+parser.add_argument('--seed', type=int, default=0, help='Random seed for the bootstrap')
+parser.add_argument('--workers', type=int, default=default_workers(), help='Worker processes; the CGI rows are split by chromosome and shared with the workers (default: $METHPIPE_WORKERS or 1)')
+args = parser.parse_args()
 
 # Auto-detect files
 data_dir = "data"
@@ -18,73 +32,50 @@ print(f"Using patient file: {patient_file}")
 print(f"Using methylation file: {methylation_file}")
 
 # Load files
+metrics.begin("load")
 patient_df = pd.read_excel(os.path.join(data_dir, patient_file))
 patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
 
-df = pd.read_excel(os.path.join(output_dir, methylation_file))
 base_fname = os.path.splitext(methylation_file)[0]
 
-# Prepare data
-start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-cpg_island_df = df.iloc[start_idx:].reset_index(drop=True)
-cpg_island_df.rename(columns={cpg_island_df.columns[0]: "CpG_Island"}, inplace=True)
-cpg_island_df.dropna(how="all", subset=cpg_island_df.columns[1:], inplace=True)
-
-def get_patient(sample):
-    for pid in patient_ids:
-        if pid in sample:
-            return pid
-    return None
-
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
-samples = cpg_island_df.columns[1:]
-sample_meta = pd.DataFrame({
-    "Sample": samples,
-    "Patient": [get_patient(s) for s in samples],
-    "Timepoint": [normalize_timepoint(s) for s in samples]
-})
-valid_samples = sample_meta.dropna()
-valid_samples = valid_samples[valid_samples["Timepoint"] != "Healthy"]
-
-matrix = cpg_island_df.set_index("CpG_Island")[valid_samples["Sample"].tolist()]
-matrix.columns = pd.MultiIndex.from_frame(valid_samples[["Patient", "Timepoint"]])
-matrix = matrix.apply(pd.to_numeric, errors='coerce').fillna(0)
-collapsed = matrix.T.groupby(level=[0, 1]).mean().T
-
-chromosome_lookup = pd.Series(
-    collapsed.index.to_series().str.extract(r"chr([^_]+)")[0],
-    index=collapsed.index
-)
-
-chr_order = [str(i) for i in range(1, 23)] + ["X", "Y"]
+# Prepare data (parsed once per input file + patient list, then served from the dataset cache)
+dataset = load_analysis_dataset(os.path.join(output_dir, methylation_file), patient_ids)
+metrics.begin("align")
+matrix = dataset.matrix.fillna(0)
+collapsed = collapse_replicates(matrix)
+
+# Integer chromosome code per CGI row (-1 for anything outside chr1-22/X/Y)
+chromosome_code = chromosome_codes(collapsed.index)
+
+chr_order = CHR_ORDER
 all_comparisons = [
     ("Baseline", "On-Treatment", "Baseline → On-Tx"),
     ("On-Treatment", "Post-Treatment", "On-Tx → Post-Tx"),
     ("Baseline", "Post-Treatment", "Baseline → Post-Tx"),
 ]
 
+metrics.begin("aggregate")
+# One task per chromosome sums the CGI × patient deltas of all comparisons over its rows; the
+# collapsed matrix is grouped by chromosome and shared with the workers, never pickled
+pairs = [paired_columns(collapsed.columns, t0, t1) for t0, t1, _ in all_comparisons]
+shard_tasks = [(code, [(before, after) for _, before, after in pairs]) for code in range(len(chr_order))]
+sums = [np.zeros((len(chr_order), len(patients))) for patients, _, _ in pairs]
+counts = [np.zeros((len(chr_order), len(patients))) for patients, _, _ in pairs]
+workers = min(args.workers, len(shard_tasks))
+with chromosome_shards({"values": collapsed.to_numpy(dtype=float)}, chromosome_code, shared=workers > 1) as shards:
+    shard_tasks = [task for task in shard_tasks if task[0] in shards.rows]
+    pool = shard_pool(workers)
+    for (code, _), results in zip(shard_tasks, map_shards(shard_delta_sums, shards, shard_tasks, pool)):
+        for i, (chrom_sums, chrom_counts) in enumerate(results):
+            sums[i][code] = chrom_sums
+            counts[i][code] = chrom_counts
+    if pool:
+        pool.shutdown()
+
 summaries = []
-for t0, t1, label in all_comparisons:
-    deltas = []
-    for patient in collapsed.columns.levels[0]:
-        if (patient, t0) in collapsed.columns and (patient, t1) in collapsed.columns:
-            delta = collapsed[(patient, t1)] - collapsed[(patient, t0)]
-            for cpg, val in delta.items():
-                chrom = chromosome_lookup.at[cpg]
-                if pd.notna(val) and pd.notna(chrom):
-                    deltas.append((chrom, val))
-    df_delta = pd.DataFrame(deltas, columns=["Chromosome", "Delta"])
-    summary = df_delta.groupby("Chromosome").agg(Mean_Delta=("Delta", "mean"))
-    summary = summary.reindex(chr_order).fillna(0).reset_index()
+for i, (t0, t1, label) in enumerate(all_comparisons):
+    summary = chromosome_summary(sums[i], counts[i], chr_order, n_boot=args.bootstrap, ci=args.ci, seed=args.seed)
+    summary["Mean_Delta"] = summary["Mean_Delta"].fillna(0)
     summary["Comparison"] = label
     summaries.append(summary)
 
@@ -106,12 +97,24 @@ width = 0.35
 bar_pivot = bar_data.pivot(index="Chromosome", columns="Comparison", values="Mean_Delta").reindex(chr_order).fillna(0)
 line_vals = line_data.set_index("Chromosome").reindex(chr_order).fillna(0)["Mean_Delta"].values
 
+# Bootstrap intervals as asymmetric error bars (only when --bootstrap is used)
+def ci_errors(comparison):
+    if "CI_Lower" not in merged.columns:
+        return None
+    rows = merged[merged["Comparison"] == comparison].set_index("Chromosome").reindex(chr_order)
+    return np.vstack([rows["Mean_Delta"] - rows["CI_Lower"], rows["CI_Upper"] - rows["Mean_Delta"]])
+
+metrics.begin("render")
 os.makedirs("plots/avg-methylation-change-per-chromosome", exist_ok=True)
 
 fig, ax = plt.subplots(figsize=(16, 6))
-ax.bar(x, bar_pivot["Baseline → On-Tx"], width, label="Baseline → On-Tx", color=colors["Baseline → On-Tx"], alpha=0.8)
-ax.bar(x, bar_pivot["On-Tx → Post-Tx"], width, label="On-Tx → Post-Tx", color=colors["On-Tx → Post-Tx"], alpha=0.6)
+ax.bar(x, bar_pivot["Baseline → On-Tx"], width, label="Baseline → On-Tx", color=colors["Baseline → On-Tx"], alpha=0.8,
+       yerr=ci_errors("Baseline → On-Tx"), ecolor=colors["Baseline → On-Tx"], capsize=3)
+ax.bar(x, bar_pivot["On-Tx → Post-Tx"], width, label="On-Tx → Post-Tx", color=colors["On-Tx → Post-Tx"], alpha=0.6,
+       yerr=ci_errors("On-Tx → Post-Tx"), ecolor=colors["On-Tx → Post-Tx"], capsize=3)
 ax.plot(x, line_vals, marker="o", color=colors["Baseline → Post-Tx"], label="Baseline → Post-Tx", linewidth=2)
+if "CI_Lower" in merged.columns:
+    ax.errorbar(x, line_vals, yerr=ci_errors("Baseline → Post-Tx"), fmt="none", ecolor=colors["Baseline → Post-Tx"], capsize=3)
 
 ax.set_xticks(x)
 ax.set_xticklabels(chr_order)
@@ -126,8 +129,9 @@ plt.tight_layout()
 plot_path = f"plots/avg-methylation-change-per-chromosome/chr_avg_overlay_{base_fname}_aligned.png"
 excel_path = f"plots/avg-methylation-change-per-chromosome/chr_avg_summary_{base_fname}.xlsx"
 plt.savefig(plot_path, bbox_inches="tight")
-plt.show()
+plt.close()
 
+metrics.begin("archive")
 merged.to_excel(excel_path, index=False)
 
 print(f"Saved plot to {plot_path}")
@@ -1,54 +1,33 @@
 # -*- coding: utf-8 -*-
 
-import io, os, zipfile, glob
+import io, os, glob
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import re
-from matplotlib.gridspec import GridSpec
-from tqdm import tqdm  # Import tqdm for progress bars
+import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics, workqueue
+from methpipe.progress import progress
+from methpipe.dataset import load_analysis_dataset
+from methpipe.bubbleplot import BubbleFigureTemplate, BubbleLOD, LOD_AGGREGATES, bubble_source, padded_xlim
+from methpipe.archive import FigureArchive
+from methpipe.figcache import FigureCache, script_salt
+from methpipe.shards import ChromosomeShards, default_workers, shard_block, shard_pool
+
+parser = argparse.ArgumentParser(description="Generate CpG island bubble plots per patient and per chromosome.")
+parser.add_argument("--lod", choices=("off",) + LOD_AGGREGATES, default="off", help="Density-binned level of detail: draw dense chromosomes as one bubble per pixel-width genomic bin, aggregated with max, mean or sum (default: off, every CGI is drawn)")
+parser.add_argument("--lod-threshold", type=int, default=2000, help="Only bin chromosomes with at least this many CGIs in a timepoint row; smaller ones keep full detail")
+parser.add_argument("--lod-bin-px", type=float, default=1.0, help="Bin width in pixels of the plot area")
+parser.add_argument("--workers", type=int, default=default_workers(os.cpu_count() or 1), help="Worker processes shared by all matrix files (default: $METHPIPE_WORKERS or the number of CPUs; 1 = render in this process)")
+workqueue.add_queue_arguments(parser)
+args = parser.parse_args()
+queue, role = workqueue.queue_role(parser, args)
+lod = BubbleLOD(args.lod, args.lod_threshold, args.lod_bin_px) if args.lod != "off" else None
 
-sns.set(style="whitegrid")
 os.makedirs("plots", exist_ok=True)
 
-# === Load Files ===
-methylation_dfs = {}
-patient_ids = []
-
-# Automatically detect files
-output_dir = "output/"
-data_dir = "data/"
-
-# Find files with "ratios_matrix" in their name from the output directory
-ratio_files = glob.glob(os.path.join(output_dir, "*ratios_matrix*.xlsx")) + glob.glob(os.path.join(output_dir, "*ratios_matrix*.csv"))
-
-# Find files with "patient" in their name from the data directory
-patient_files = glob.glob(os.path.join(data_dir, "*patient*.xlsx")) + glob.glob(os.path.join(data_dir, "*patient*.csv"))
-
-# Process patient files
-for file_path in tqdm(patient_files, desc="Processing patient files"):
-    df = pd.read_excel(file_path, header=None) if file_path.endswith('.xlsx') else pd.read_csv(file_path, header=None)
-    values = df[0].dropna().astype(str).tolist()
-    patient_ids.extend([v for v in values if not v.lower().startswith("unnamed")])
-    
-# Process ratio files
-for file_path in tqdm(ratio_files, desc="Processing ratio files"):
-    file_name = os.path.basename(file_path)
-    df = pd.read_excel(file_path) if file_path.endswith('.xlsx') else pd.read_csv(file_path)
-    methylation_dfs[file_name] = df
-
-# === Normalize sample names ===
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
 # Define timepoints
 timepoints_patient = ["Baseline", "On-Treatment", "Post-Treatment"]  # Per-patient plots
 timepoints_chromosome = ["Baseline", "On-Treatment", "Post-Treatment"]  # Per-chromosome plots (removed "Healthy")
@@ -66,238 +45,62 @@ timepoint_positions_chromosome = {
     "Post-Treatment": 1.4
 }
 
-# === Process Files ===
-for fname, df in tqdm(methylation_dfs.items(), desc="Processing methylation files"):
-    print(f"\n=== Processing file: {fname} ===")
-    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-    cpg_df = df.iloc[start_idx:].reset_index(drop=True)
-    cpg_df.rename(columns={cpg_df.columns[0]: "CpG_Island"}, inplace=True)
-    cpg_df.dropna(how="all", subset=cpg_df.columns[1:], inplace=True)
-
-    samples = cpg_df.columns[1:]
-    def get_patient(s): return next((pid for pid in patient_ids if pid in s), None)
-    sample_meta = pd.DataFrame({
-        "Sample": samples,
-        "Patient": [get_patient(s) for s in samples],
-        "Timepoint": [normalize_timepoint(s) for s in samples]
-    }).dropna()
-
-    # Remove Healthy samples from matrix
-    non_healthy = sample_meta[sample_meta["Timepoint"] != "Healthy"]
-    matrix = cpg_df.set_index("CpG_Island")[non_healthy["Sample"]]
-    matrix.columns = pd.MultiIndex.from_frame(non_healthy[["Patient", "Timepoint"]])
-    matrix = matrix.apply(pd.to_numeric, errors='coerce')
-    collapsed = matrix.groupby(axis=1, level=[0, 1]).mean()
-
-    # === Extract CpG Coordinates ===
-    cpg_coords = cpg_df["CpG_Island"].str.extract(r"CGI_(chr\w+)_(\d+)_(\d+)", expand=True)
-    cpg_coords.columns = ["Chr", "Start", "End"]
-    cpg_coords = cpg_coords.dropna()
-    cpg_coords["Start"] = cpg_coords["Start"].astype(int)
-    cpg_coords["End"] = cpg_coords["End"].astype(int)
-    cpg_coords["Midpoint"] = (cpg_coords["Start"] + cpg_coords["End"]) // 2
-    cpg_coords["CpG_Island"] = cpg_df["CpG_Island"]
-    coords_df = cpg_coords.set_index("CpG_Island")
-
-    # === Merge data with coordinates ===
-    collapsed_flat = collapsed.copy()
-    collapsed_flat.columns = ['{}_{}'.format(p, tp) for p, tp in collapsed.columns]
-    collapsed_flat = collapsed_flat.reset_index()
-
-    bubble_data = pd.merge(collapsed_flat, coords_df.reset_index(), on="CpG_Island").set_index("CpG_Island")
-
-# === Bubble plots per patient per chromosome ===
-for patient in tqdm(collapsed.columns.levels[0], desc="Generating bubble plots per patient"):
-    for chrom in coords_df["Chr"].unique():
-        # Build a subset for each timepoint, merging them
-        chr_data = bubble_data[bubble_data["Chr"] == chrom]
-
-        # Collect rows for all timepoints in a single DataFrame
-        all_rows = []
-        for tp in timepoints_patient:
-            col = f"{patient}_{tp}"
-            if col not in chr_data.columns:
-                print(f"[WARNING] Column {col} not found for {patient}, {chrom}, skipping.")
-                continue
-            sub = chr_data[[col, "Midpoint"]].dropna().rename(columns={col: "value"})
-            if sub.empty:
-                continue
-            sub["Timepoint"] = tp
-            all_rows.append(sub)
-
-        if not all_rows:
-            # No data for any timepoint
-            continue
+# === Bubble plot figure template ===
+# The layout (axes, colorbar, bubble-size legend) is identical for every plot, so it is built once
+# and each plot only swaps the bubbles, title and x-limits (per-patient and per-chromosome plots
+# share the same timepoint positions).
+def build_bubble_template():
+    from matplotlib.gridspec import GridSpec
 
-        subset_df = pd.concat(all_rows, ignore_index=True)
-
-        # Create figure with 2 columns:
-        # - Left col = main bubble plot
-        # - Right col = sub-gridspec for colorbar (top) + bubble legend (bottom)
-        fig = plt.figure(figsize=(21, 10))  # Increased figure size to prevent cropping
-        gs = GridSpec(nrows=1, ncols=2, width_ratios=[6.5, 0.5], figure=fig)
-
-        # Main axis on the left
-        ax_main = fig.add_subplot(gs[0, 0])
-        ax_main.grid(False)  # Hide grid
-
-        # Sub-gridspec on the right: 2 rows (colorbar top, legend bottom)
-        gs_right = gs[0, 1].subgridspec(nrows=2, ncols=1, height_ratios=[0.5, 0.5])
-        ax_cbar = fig.add_subplot(gs_right[0, 0])
-        ax_cbar.grid(False)  # Hide grid
-        ax_legend = fig.add_subplot(gs_right[1, 0])
-
-        # Plot each row in subset_df
-        sc = None
-        for _, row in subset_df.iterrows():
-            tp = row["Timepoint"]
-            y = timepoint_positions_patient[tp]
-            # Increase bubble scale factor for bigger bubbles
-            bubble_size = row["value"]**0.5 * 5    # bubble size inside the plot area
-            sc = ax_main.scatter(
-                row["Midpoint"],
-                y,
-                s=bubble_size,
-                c=row["value"],
-                cmap="viridis",
-                alpha=0.6,
-                vmin=0,  # lower bound of color scale
-                vmax=1000000    # increased upper bound of color scale
-            )
-
-        # Format main axis
-        ax_main.set_yticks(list(timepoint_positions_patient.values()))  # Ensure the number of ticks matches the number of labels
-        ax_main.set_yticklabels(timepoints_patient, fontsize=14)
-        ax_main.set_ylim(0.3, 1.7)  # set y-limits so large bubbles have padding above & below
-        # Add x-axis padding to avoid bubble clipping
-        x_min, x_max = subset_df['Midpoint'].min(), subset_df['Midpoint'].max()
-        x_range = x_max - x_min
-        ax_main.set_xlim(x_min - 0.1 * x_range, x_max + 0.1 * x_range)  # Increase x-axis padding
-
-        ax_main.set_xlabel("CpG Island Genomic Coordinate Midpoint (bp)", fontsize=16)
-        ax_main.set_ylabel("Timepoint", fontsize=16)
-        ax_main.set_title(f"DNA Hypermethylation Profiles Throughout Treatment\nPatient: {patient}, Chromosome: {chrom}", fontsize=18)
-        ax_main.tick_params(axis='x', labelsize=14)  # Enlarge x-axis tick markers
-
-        # If we got at least one scatter point, make the colorbar in ax_cbar
-        if sc is not None:
-            cb = fig.colorbar(sc, cax=ax_cbar, label="Scaled Fragment Count Ratio", pad=0.2)  # Adjust the pad value as needed
-            cb.set_label("Scaled Fragment Count Ratio", fontsize=14)
-
-        # Define the x-coordinate for the legend title and legend scatter plot positions
-        legend_x_coord = 0.85
-
-        # Create bubble-size legend in ax_legend
-        ax_legend.axis("off")  # hide ticks and background
-
-        # Define the sizes and calculate bubble sizes
-        sizes = [1, 100, 10000, 1000000]
-        bubble_sizes = [size**0.5 * 5 for size in sizes]    # size of bubbles within legend area
-
-        # Calculate proportional vertical positions based on bubble radii
-        cumulative_height = np.cumsum([size**0.5 *0.1 for size in sizes])    # legend bubble heights combined
-        total_height = cumulative_height[-1]
-        positions = np.array([0.1, 0.7, 1.4, 2.8]) * 9/ 1000 * total_height / len(sizes)    # vertical spacing between gray bubble markers
-
-        # Set the x-axis limits explicitly for the legend axis
-        ax_legend.set_xlim(-1, 3.5)
-
-        # Print the axis limits to check if legend_x_coord is within range
-        x_min, x_max = ax_legend.get_xlim()
-        print(f"Legend x-axis limits: min={x_min}, max={x_max}")
-        print(f"legend_x_coord: {legend_x_coord}")
-
-        if legend_x_coord < x_min or legend_x_coord > x_max:
-            print(f"Warning: legend_x_coord ({legend_x_coord}) is out of bounds!")
-
-        # Manually draw the legend using scatter and text
-        for size, pos in zip(sizes, positions):
-            ax_legend.scatter(legend_x_coord, pos, s=size**0.5 * 5, color="gray", alpha=0.5)    # Use legend_x_coord for gray bubble x-coordinate adjustment (This determines the gray bubble sizes that actually get plotted in the legend)
-            ax_legend.text(legend_x_coord + 2, pos, str(size), verticalalignment='center', horizontalalignment='left', fontsize=14)    # Adjust fragment count text position relative to the gray bubbles based on legend_x_coord
-
-        # Legend title slightly above top bubble, adjust the position as needed
-        ax_legend.text(1.1, positions[-1] + 0.5, "Bubble Size\n(Scaled Fragment Count Ratio)",    # title is 0.5 above the top bubble
-                    horizontalalignment='center', verticalalignment='center', fontweight='bold', fontsize=14)
-
-        # Adjust y-limits to ensure no clipping
-        ax_legend.set_ylim(0, positions[-1] + 0.5)    # legend y-axis limit should be larger than the distance between top bubble and title
-
-        fig.subplots_adjust(left=0.1, right=0.96, top=0.9, bottom=0.1, wspace=0.15, hspace=0.65)  # left=0.1 reserves 10% of the figure width as a margin on the left side, wspace between the plot area and legend area, hspace controls the vertical spacing between colorbar and legend
-
-        filename_base = os.path.join("plots", f"bubbleplot_{patient}_{chrom}")
-        plt.savefig(f"{filename_base}.png")
-        plt.savefig(f"{filename_base}.svg")
-        plt.close()
-
-# === Bubble plots per chromosome (averaged across patients) ===
-for chrom in tqdm(coords_df["Chr"].unique(), desc="Generating bubble plots per chromosome"):
-    chr_data = bubble_data[bubble_data["Chr"] == chrom]
-
-    all_rows = []
-    for tp in timepoints_chromosome:
-        # Find columns that end with e.g. "_Baseline"
-        cols = [c for c in chr_data.columns if c.endswith(f"_{tp}")]
-        if not cols:
-            continue
-        avg = chr_data[cols].mean(axis=1)
-        sub = chr_data.loc[avg.notna(), ["Midpoint"]].copy()
-        sub["value"] = avg[avg.notna()]
-        sub["Timepoint"] = tp
-        all_rows.append(sub)
-
-    if not all_rows:
-        continue
-
-    subset_df = pd.concat(all_rows, ignore_index=True)
+    sns.set(style="whitegrid")
 
+    # Create figure with 2 columns:
+    # - Left col = main bubble plot
+    # - Right col = sub-gridspec for colorbar (top) + bubble legend (bottom)
     fig = plt.figure(figsize=(21, 10))  # Increased figure size to prevent cropping
     gs = GridSpec(nrows=1, ncols=2, width_ratios=[6.5, 0.5], figure=fig)
 
+    # Main axis on the left
     ax_main = fig.add_subplot(gs[0, 0])
     ax_main.grid(False)  # Hide grid
+
+    # Sub-gridspec on the right: 2 rows (colorbar top, legend bottom)
     gs_right = gs[0, 1].subgridspec(nrows=2, ncols=1, height_ratios=[0.5, 0.5])
     ax_cbar = fig.add_subplot(gs_right[0, 0])
     ax_cbar.grid(False)  # Hide grid
     ax_legend = fig.add_subplot(gs_right[1, 0])
 
-    sc = None
-    for _, row in subset_df.iterrows():
-        tp = row["Timepoint"]
-        y = timepoint_positions_chromosome[tp]
-        bubble_size = row["value"]**0.5 * 5    # bubble size inside the plot area
-        sc = ax_main.scatter(
-            row["Midpoint"],
-            y,
-            s=bubble_size,
-            c=row["value"],
-            cmap="viridis",
-            alpha=0.6,
-            vmin=0,  # lower bound of color scale
-            vmax=1000000    # increased upper bound of color scale
-        )
-
-    ax_main.set_yticks(list(timepoint_positions_chromosome.values()))  # Ensure the number of ticks matches the number of labels
-    ax_main.set_yticklabels(timepoints_chromosome, fontsize=14)
+    # Single scatter whose offsets/sizes/colors are replaced for every plot
+    sc = ax_main.scatter(
+        [], [], s=[], c=[],
+        cmap="viridis",
+        alpha=0.6,
+        vmin=0,  # lower bound of color scale
+        vmax=1000000    # increased upper bound of color scale
+    )
+
+    # Format main axis
+    ax_main.set_yticks(list(timepoint_positions_patient.values()))  # Ensure the number of ticks matches the number of labels
+    ax_main.set_yticklabels(timepoints_patient, fontsize=14)
     ax_main.set_ylim(0.3, 1.7)  # set y-limits so large bubbles have padding above & below
-    # Add x-axis padding to avoid bubble clipping
-    x_min, x_max = subset_df['Midpoint'].min(), subset_df['Midpoint'].max()
-    x_range = x_max - x_min
-    ax_main.set_xlim(x_min - 0.1 * x_range, x_max + 0.1 * x_range)  # Increase x-axis padding
 
     ax_main.set_xlabel("CpG Island Genomic Coordinate Midpoint (bp)", fontsize=16)
     ax_main.set_ylabel("Timepoint", fontsize=16)
-    ax_main.set_title(f"DNA Hypermethylation Profiles Throughout Treatment (Averaged Across Patients)\nChromosome: {chrom}", fontsize=18)
+    ax_main.set_title("", fontsize=18)
     ax_main.tick_params(axis='x', labelsize=14)  # Enlarge x-axis tick markers
 
-    if sc is not None:
-        cbar = fig.colorbar(sc, cax=ax_cbar, label="Scaled Fragment Count Ratio", pad=0.2)  # Adjust the pad value as needed
-        cbar.set_label("Scaled Fragment Count Ratio", fontsize=14)
+    cb = fig.colorbar(sc, cax=ax_cbar, label="Scaled Fragment Count Ratio", pad=0.2)  # Adjust the pad value as needed
+    cb.set_label("Scaled Fragment Count Ratio", fontsize=14)
 
-    ax_legend.axis("off")
+    # Define the x-coordinate for the legend title and legend scatter plot positions
+    legend_x_coord = 0.85
 
-    # Use the same logic as the per-patient plots for legend spacing
+    # Create bubble-size legend in ax_legend
+    ax_legend.axis("off")  # hide ticks and background
+
+    # Define the sizes and calculate bubble sizes
     sizes = [1, 100, 10000, 1000000]
-    bubble_sizes = [size**0.5 * 5 for size in sizes]    # bubble size inside the legend area
+    bubble_sizes = [size**0.5 * 5 for size in sizes]    # size of bubbles within legend area
 
     # Calculate proportional vertical positions based on bubble radii
     cumulative_height = np.cumsum([size**0.5 *0.1 for size in sizes])    # legend bubble heights combined
@@ -316,8 +119,8 @@ for chrom in tqdm(coords_df["Chr"].unique(), desc="Generating bubble plots per c
         print(f"Warning: legend_x_coord ({legend_x_coord}) is out of bounds!")
 
     # Manually draw the legend using scatter and text
-    for size, pos in zip(sizes, positions):
-        ax_legend.scatter(legend_x_coord, pos, s=size**0.5 * 5, color="gray", alpha=0.5)    # Use legend_x_coord for gray bubble x-coordinate adjustment (This determines the gray bubble sizes that actually get plotted in the legend)
+    for size, bubble_size, pos in zip(sizes, bubble_sizes, positions):
+        ax_legend.scatter(legend_x_coord, pos, s=bubble_size, color="gray", alpha=0.5)    # Use legend_x_coord for gray bubble x-coordinate adjustment (This determines the gray bubble sizes that actually get plotted in the legend)
         ax_legend.text(legend_x_coord + 2, pos, str(size), verticalalignment='center', horizontalalignment='left', fontsize=14)    # Adjust fragment count text position relative to the gray bubbles based on legend_x_coord
 
     # Legend title slightly above top bubble, adjust the position as needed
@@ -328,29 +131,223 @@ for chrom in tqdm(coords_df["Chr"].unique(), desc="Generating bubble plots per c
     ax_legend.set_ylim(0, positions[-1] + 0.5)    # legend y-axis limit should be larger than the distance between top bubble and title
 
     fig.subplots_adjust(left=0.1, right=0.96, top=0.9, bottom=0.1, wspace=0.15, hspace=0.65)  # left=0.1 reserves 10% of the figure width as a margin on the left side, wspace between the plot area and legend area, hspace controls the vertical spacing between colorbar and legend
-    filename_base = os.path.join("plots", f"bubbleplot_{chrom}")
-    plt.savefig(f"{filename_base}.png")
-    plt.savefig(f"{filename_base}.svg")
-    plt.close()
-
-# === Create ZIP of all plots ===
-zip_path = os.path.join("plots", "bubbleplots.zip")
-with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-    for root, _, files in os.walk("plots"):
-        for file in files:
-            if file.startswith("bubbleplot_") and (file.endswith(".png") or file.endswith(".svg")):
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, start="plots")
-                zipf.write(file_path, arcname=arcname)
-
-print(f"All bubble plot files zipped and saved to: {zip_path}")
-
-# === Remove individual plot files after zipping ===
-for root, _, files in os.walk("plots"):
-    for file in files:
-        if file.startswith("bubbleplot_") and (file.endswith(".png") or file.endswith(".svg")):
-            file_path = os.path.join(root, file)
-            if file_path != zip_path:
-                os.remove(file_path)
-
-print(f"Individual bubble plot files have been removed after zipping.")
+
+    return BubbleFigureTemplate(fig, ax_main, sc, size_scale=5)    # bubble size inside the plot area = value**0.5 * 5
+
+# === Bubble plot tasks ===
+# A task renders the plot of one patient (or the per-patient average) on one chromosome of one matrix
+# file and returns the encoded files. The bubble data of every file is grouped by chromosome and shared
+# with the workers through shared memory (``methpipe.shards``), so a task only carries the chromosome,
+# the patient's columns and the names of the shared blocks. Each worker builds the figure template once,
+# and all matrix files share one pool of workers. Figures whose exact data slice and render settings
+# were produced before are copied from the figure cache.
+_template = None
+_cache = None
+
+def worker_state():
+    global _template, _cache
+    if _template is None:
+        _template = build_bubble_template()
+        _cache = FigureCache(salt=script_salt(__file__))
+    return _template, _cache
+
+# === Bubble plot of one patient and chromosome ===
+def plot_patient(template, cache, block, chrom, patient, columns, prefix):
+    chr_midpoints = block["midpoints"]
+
+    # Collect the non-missing CGIs of every timepoint
+    xs, ys, vs = [], [], []
+    for tp in timepoints_patient:
+        col = f"{patient}_{tp}"
+        if tp not in columns:
+            print(f"[WARNING] Column {col} not found for {patient}, {chrom}, skipping.")
+            continue
+        tp_values = block["values"][:, columns[tp]]
+        keep = ~np.isnan(tp_values)
+        if not keep.any():
+            continue
+        xs.append(chr_midpoints[keep])
+        ys.append(np.full(keep.sum(), timepoint_positions_patient[tp]))
+        vs.append(tp_values[keep])
+
+    if not xs:
+        # No data for any timepoint
+        return []
+
+    x, y, v = np.concatenate(xs), np.concatenate(ys), np.concatenate(vs)
+
+    # Swap the bubbles into the template (x-axis padding avoids bubble clipping), or reuse the cached figure
+    return template.render_cached(
+        cache, f"{prefix}bubbleplot_{patient}_{chrom}",
+        x, y, v,
+        f"DNA Hypermethylation Profiles Throughout Treatment\nPatient: {patient}, Chromosome: {chrom}",
+        padded_xlim(x),
+        lod=lod,
+    )
+
+# === Bubble plot of one chromosome (averaged across patients) ===
+def plot_chromosome_average(template, cache, block, chrom, columns, prefix):
+    chr_midpoints = block["midpoints"]
+
+    xs, ys, vs = [], [], []
+    for tp in timepoints_chromosome:
+        cols = columns.get(tp, [])
+        if not len(cols):
+            continue
+        # NaN-aware mean across the patients' columns for this timepoint
+        values = block["values"][:, cols]
+        counts = (~np.isnan(values)).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg = np.nansum(values, axis=1) / counts
+        keep = counts > 0
+        xs.append(chr_midpoints[keep])
+        ys.append(np.full(keep.sum(), timepoint_positions_chromosome[tp]))
+        vs.append(avg[keep])
+
+    if not xs:
+        return []
+
+    x, y, v = np.concatenate(xs), np.concatenate(ys), np.concatenate(vs)
+
+    return template.render_cached(
+        cache, f"{prefix}bubbleplot_{chrom}",
+        x, y, v,
+        f"DNA Hypermethylation Profiles Throughout Treatment (Averaged Across Patients)\nChromosome: {chrom}",
+        padded_xlim(x),
+        lod=lod,
+    )
+
+def task_columns(source, patient):
+    """Columns a task reads: the patient's column per timepoint, or every patient's columns for the averages."""
+    if patient is None:
+        return {tp: source.timepoint_cols.get(tp, []) for tp in timepoints_chromosome}
+    return {tp: source.column_pos[(patient, tp)] for tp in timepoints_patient if (patient, tp) in source.column_pos}
+
+def render_block(block, chrom, prefix, patient, columns):
+    template, cache = worker_state()
+    with metrics.stage("render", patient=patient or "averages", chromosome=chrom):
+        if patient is None:
+            entries = plot_chromosome_average(template, cache, block, chrom, columns, prefix)
+        else:
+            entries = plot_patient(template, cache, block, chrom, patient, columns, prefix)
+    return entries, cache.take_added()
+
+def render_task(task):
+    handle, chrom, prefix, patient, columns = task
+    with metrics.stage("load"):
+        block = shard_block(handle, chrom)
+    return render_block(block, chrom, prefix, patient, columns)
+
+# === Distributed mode (methpipe.workqueue) ===
+# Every worker process loads the bubble data of each file once (from the dataset cache or matrix
+# store on the shared volume) and runs one queued patient × chromosome task at a time. The reducer
+# streams the task outputs into the zip in submission order, as a serial run would write them.
+_sources = {}
+
+def run_queued_task(spec):
+    path = spec["file"]
+    with metrics.stage("load"):
+        if path not in _sources:
+            _sources[path] = bubble_source(load_analysis_dataset(path, queue.context()["patient_ids"]).collapsed)
+        source = _sources[path]
+        rows = source.chrom_rows[spec["chrom"]]
+        block = {"values": source.values[rows], "midpoints": source.midpoints[rows]}
+    return render_block(block, spec["chrom"], spec["prefix"], spec["patient"], task_columns(source, spec["patient"]))
+
+def reduce_queue(zip_path):
+    metrics.begin("archive")
+    queue.wait(timeout=args.wait)
+    archive = FigureArchive(zip_path, compresslevel=6, background=True)
+    cache = FigureCache(salt=script_salt(__file__))
+    for _, entries, added in progress(queue.results(), total=len(queue.manifest()["tasks"]), desc="Collecting bubble plots"):
+        for name, data in entries:
+            archive.write(name, data)
+        cache.merge(added)
+    archive.close()
+    cache.save()
+    print(f"All bubble plot files zipped and saved to: {zip_path}")
+
+def main():
+    zip_path = os.path.join("plots", "bubbleplots.zip")
+    if role == "work":
+        workqueue.work(queue, run_queued_task)
+        return
+    if role == "reduce":
+        reduce_queue(zip_path)
+        return
+
+    # === Load Files ===
+    metrics.begin("load")
+    patient_ids = []
+
+    # Automatically detect files
+    output_dir = "output/"
+    data_dir = "data/"
+
+    # Find files with "ratios_matrix" in their name from the output directory
+    ratio_files = glob.glob(os.path.join(output_dir, "*ratios_matrix*.xlsx")) + glob.glob(os.path.join(output_dir, "*ratios_matrix*.csv"))
+
+    # Find files with "patient" in their name from the data directory
+    patient_files = glob.glob(os.path.join(data_dir, "*patient*.xlsx")) + glob.glob(os.path.join(data_dir, "*patient*.csv"))
+
+    # Process patient files
+    for file_path in progress(patient_files, desc="Processing patient files"):
+        df = pd.read_excel(file_path, header=None) if file_path.endswith('.xlsx') else pd.read_csv(file_path, header=None)
+        values = df[0].dropna().astype(str).tolist()
+        patient_ids.extend([v for v in values if not v.lower().startswith("unnamed")])
+
+    # Parse every matrix (or load it from the dataset cache) here and build its bubble data
+    file_sources = {}
+    for file_path in progress(ratio_files, desc="Processing ratio files"):
+        print(f"\n=== Processing file: {os.path.basename(file_path)} ===")
+        collapsed = load_analysis_dataset(file_path, patient_ids).collapsed
+        file_sources[file_path] = (collapsed.columns.levels[0], bubble_source(collapsed))
+
+    # One task per patient and chromosome plus one per chromosome for the averages, for every file, in
+    # the order of a serial run; when several files are plotted in one run, each file's plots go into
+    # a folder named after the file
+    plan = []
+    for file_path, (patients, source) in file_sources.items():
+        prefix = f"{os.path.splitext(os.path.basename(file_path))[0]}/" if len(file_sources) > 1 else ""
+        for patient in list(patients) + [None]:
+            plan += [(file_path, prefix, patient, chrom) for chrom in source.chrom_rows]
+
+    if role == "submit":
+        ids = queue.submit([{"file": file_path, "prefix": prefix, "patient": patient, "chrom": chrom}
+                            for file_path, prefix, patient, chrom in plan],
+                           context={"patient_ids": patient_ids}, script=os.path.basename(__file__))
+        print(f"Submitted {len(ids)} bubble plot task(s) to {args.queue}")
+        return
+
+    # The bubble data of every file is grouped by chromosome and shared with the workers
+    file_shards = {file_path: ChromosomeShards({"values": source.values, "midpoints": source.midpoints},
+                                               source.chrom_rows, shared=args.workers > 1)
+                   for file_path, (_, source) in file_sources.items()}
+    tasks = [(file_shards[file_path].handle, chrom, prefix, patient, task_columns(file_sources[file_path][1], patient))
+             for file_path, prefix, patient, chrom in plan]
+
+    # Figures are rendered in memory and streamed straight into the zip (PNG stored, SVG deflated)
+    archive = FigureArchive(zip_path, compresslevel=6, background=True)
+    cache = FigureCache(salt=script_salt(__file__))
+
+    workers = min(args.workers, len(tasks))
+    pool = shard_pool(workers)
+    metrics.end()
+    results = pool.map(render_task, tasks) if pool else map(render_task, tasks)
+    for entries, cached in progress(results, total=len(tasks), desc="Generating bubble plots"):
+        for name, data in entries:
+            archive.write(name, data)
+        cache.merge(cached)
+    if pool:
+        pool.shutdown()
+    for shards in file_shards.values():
+        shards.close()
+
+    # === Finish ZIP of all plots ===
+    metrics.begin("archive")
+    archive.close()
+    cache.save()
+    print(f"All bubble plot files zipped and saved to: {zip_path}")
+
+if __name__ == "__main__":
+    main()
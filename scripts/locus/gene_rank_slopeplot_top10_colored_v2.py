@@ -3,15 +3,29 @@
 import os
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import re
+import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.topk import topk_labels
+from methpipe.ranking import CappedRanks
+from methpipe.slopeplot import build_patient_panels, draw_slope_chart, export_melted
+from methpipe.archive import figure_bytes
+from methpipe.figcache import FigureCache, script_salt
 
 # === Settings ===
+parser = argparse.ArgumentParser(description='Plot per-patient gene rank slope charts (replicates averaged) with the top 10 genes per sample highlighted.')
+parser.add_argument('--export-melted', action='store_true', help='Also write the full long-format rank table (slow for large cohorts)')
+args = parser.parse_args()
+
 input_path = os.path.join("output", "gene_methylation_matrix.csv")
 patient_list_path = os.path.join("data", "Patient ID list fot EMseq16-18-20.xlsx")
 output_dir = os.path.join("plots", "rank-slopeplot")
+rank_cap = 501  # every gene ranked 501 or lower shares rank 501
 os.makedirs(output_dir, exist_ok=True)
+figure_cache = FigureCache(salt=script_salt(__file__))
 
 # === Helper Functions ===
 def classify_detailed_timepoint(sample_name):
@@ -37,95 +51,93 @@ def get_patient(sample_name, patient_ids):
     return next((pid for pid in patient_ids if pid in sample_name), None)
 
 # === Load Data ===
+metrics.begin("load")
 matrix = pd.read_csv(input_path, index_col=0)
 patients = pd.read_excel(patient_list_path).iloc[:, 0].dropna().astype(str).tolist()
 
 # === Create Rankings Per Sample ===
-ranks = matrix.rank(axis=0, method='min', ascending=False)
-ranks[ranks >= 501] = 501
+metrics.begin("stats")
+ranks = CappedRanks(matrix, caps=[rank_cap]).get(rank_cap)
 ranks.to_csv(os.path.join(output_dir, "gene_methylation_ranks.csv"))
 
+# === Top 10 Genes Per Sample (all samples in one pass) ===
+top10_by_sample = topk_labels(ranks, 10, largest=False)
+
 # === Metadata Mapping ===
+metrics.begin("match")
 timepoint_map = {col: classify_detailed_timepoint(col) for col in ranks.columns}
 patient_map = {col: get_patient(col, patients) for col in ranks.columns}
 
-# === Melt and Annotate ===
-melted = ranks.reset_index().melt(id_vars='Gene', var_name='Sample', value_name='Rank')
-melted['Timepoint'] = melted['Sample'].map(timepoint_map)
-melted['Patient'] = melted['Sample'].map(patient_map)
-melted.dropna(subset=['Patient', 'Timepoint'], inplace=True)
-all_timepoints_ordered = sorted(set(melted['Timepoint']), key=sort_timepoints)
-
-# === Average over replicates ===
-grouped_avg = melted.groupby(['Gene', 'Patient', 'Timepoint'], as_index=False).agg({'Rank': 'mean'})
-
 # === Store top genes summary ===
 top_genes_summary = []
 
-# === Plot Per-Patient Slope Charts ===
-for patient_id, subdf in grouped_avg.groupby("Patient"):
-    if subdf['Timepoint'].nunique() < 2:
-        continue
-
-    # Determine highlight genes from all raw (non-averaged) ranks
-    patient_samples = melted[melted['Patient'] == patient_id]['Sample'].unique()
-    highlight_genes = set()
-    for sample in patient_samples:
-        top10_genes = ranks[sample].nsmallest(10).index.tolist()
-        highlight_genes.update(top10_genes)
-
-    top_genes_summary.append({
-        "Patient": patient_id,
-        "Top_Genes": ", ".join(sorted(highlight_genes))
-    })
+# === Per-Patient Slope Chart ===
+def draw_patient_slope_chart(panel):
+    patient_id = panel.patient
+    highlight_genes = panel.highlight
 
     # Assign colors
-    highlight_genes = sorted(highlight_genes)
     color_palette = sns.color_palette("husl", len(highlight_genes))
     gene_color_dict = dict(zip(highlight_genes, color_palette))
 
-    plt.figure(figsize=(14, 8))
-    subdf = subdf.copy()
-    subdf['Timepoint'] = pd.Categorical(subdf['Timepoint'], categories=all_timepoints_ordered, ordered=True)
-
-    for gene, gene_df in subdf.groupby("Gene"):
-        gene_df = gene_df.sort_values('Timepoint')
-        is_highlighted = gene in gene_color_dict
-        plt.plot(
-            gene_df['Timepoint'], gene_df['Rank'],
-            alpha=0.6,
-            linewidth=2 if is_highlighted else 0.5,
-            color=gene_color_dict[gene] if is_highlighted else 'black',
-            linestyle='-' if is_highlighted else ':',
-            label=gene if is_highlighted else None
-        )
+    # All genes are drawn as two LineCollections (dotted black background + colored highlights)
+    fig, ax = plt.subplots(figsize=(14, 8))
+    handles = draw_slope_chart(
+        ax, panel, gene_color_dict,
+        background_style={"linewidth": 0.5, "linestyle": ":"},
+        highlight_style={"linewidth": 2, "linestyle": "-"}
+    )
 
     plt.yscale("log")
     plt.gca().invert_yaxis()
-    collapsed_count = (subdf['Rank'] == 501).sum()
-    plt.text(0.99, 0.02, f"{collapsed_count} gene-timepoints at rank 501", ha='right', va='bottom',
+    collapsed_count = int((panel.ranks.to_numpy() == rank_cap).sum())
+    plt.text(0.99, 0.02, f"{collapsed_count} gene-timepoints at rank {rank_cap}", ha='right', va='bottom',
              transform=plt.gca().transAxes, fontsize=10, color='gray')
     plt.title(f"Gene Ranking Trajectories for Patient {patient_id}")
     plt.ylabel("Gene Rank (smaller = more methylated, log scale)")
     plt.xlabel("Timepoint")
 
-    handles, labels = plt.gca().get_legend_handles_labels()
     if handles:
-        unique = dict(zip(labels, handles))
         plt.legend(
-            unique.values(), unique.keys(),
+            handles=handles,
             title="Top 10 Genes (per sample)",
             fontsize=8, title_fontsize=9,
             bbox_to_anchor=(1.01, 1), loc='upper left', borderaxespad=0.
         )
 
     plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, f"rank_slopeplot_patient_{patient_id}.png"), bbox_inches='tight')
+    png_bytes = figure_bytes(plt.gcf(), "png", bbox_inches='tight')
     plt.close()
+    return png_bytes
 
-# Save full melted table and top gene list
-grouped_avg.to_csv(os.path.join(output_dir, "melted_gene_methylation_ranks_avg.csv"), index=False)
+# === Plot Per-Patient Slope Charts ===
+metrics.begin("render")
+# Highlight genes are picked per patient straight from the wide rank matrix (replicates averaged per timepoint).
+for panel in build_patient_panels(ranks, timepoint_map, patient_map, sort_timepoints, top_by_sample=top10_by_sample, average_replicates=True):
+    patient_id = panel.patient
+    highlight_genes = panel.highlight
+
+    # Log top genes
+    top_genes_summary.append({
+        "Patient": patient_id,
+        "Top_Genes": ", ".join(highlight_genes)
+    })
+
+    # Panels whose ranks, highlight genes and drawing code are unchanged are copied from the figure cache
+    figure_cache.fetch_file(
+        figure_cache.key("rank_slope", panel, rank_cap),
+        os.path.join(output_dir, f"rank_slopeplot_patient_{patient_id}.png"),
+        lambda: draw_patient_slope_chart(panel),
+    )
+
+metrics.begin("archive")
+figure_cache.save()
+print(figure_cache.summary())
+
+# Save replicate-averaged melted table (only on request; written in chunks) and top gene list
+if args.export_melted:
+    export_melted(ranks, timepoint_map, patient_map, os.path.join(output_dir, "melted_gene_methylation_ranks_avg.csv"),
+                  sort_key=sort_timepoints, average_replicates=True)
 pd.DataFrame(top_genes_summary).to_csv(os.path.join(output_dir, "top_genes_per_patient.csv"), index=False)
 
 print(f"Finished! Slope plots and summaries saved in: {output_dir}")
-
@@ -1,15 +1,28 @@
 import os
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import re
+import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.ranking import CappedRanks
+from methpipe.slopeplot import build_patient_panels, draw_slope_chart, export_melted
+from methpipe.archive import figure_bytes
+from methpipe.figcache import FigureCache, script_salt
 
 # === Settings ===
+parser = argparse.ArgumentParser(description='Plot per-patient gene rank slope charts with ranks capped at 21.')
+parser.add_argument('--export-melted', action='store_true', help='Also write the full long-format melted_gene_methylation_ranks.csv (slow for large cohorts)')
+args = parser.parse_args()
+
 input_path = os.path.join("output", "gene_methylation_matrix.csv")
 patient_list_path = os.path.join("data", "Patient ID list fot EMseq16-18-20.xlsx")
 output_dir = os.path.join("plots", "rank-slopeplot")
+rank_cap = 21  # every gene ranked 21 or lower shares rank 21
 os.makedirs(output_dir, exist_ok=True)
+figure_cache = FigureCache(salt=script_salt(__file__))
 
 # === Helper Functions ===
 def classify_detailed_timepoint(sample_name):
@@ -37,48 +50,44 @@ def get_patient(sample_name, patient_ids):
     return next((pid for pid in patient_ids if pid in sample_name), None)
 
 # === Load Data ===
+metrics.begin("load")
 matrix = pd.read_csv(input_path, index_col=0)
 patients = pd.read_excel(patient_list_path).iloc[:, 0].dropna().astype(str).tolist()
 
 # === Create Rankings Per Sample ===
-ranks = matrix.rank(axis=0, method='min', ascending=False)
-ranks[ranks >= 21] = 21  # Cap low methylation ranks at 21
+metrics.begin("stats")
+ranks = CappedRanks(matrix, caps=[rank_cap]).get(rank_cap)
 ranks.to_csv(os.path.join(output_dir, "gene_methylation_ranks.csv"))
 
 # === Metadata Mapping ===
+metrics.begin("match")
 timepoint_map = {col: classify_detailed_timepoint(col) for col in ranks.columns}
 patient_map = {col: get_patient(col, patients) for col in ranks.columns}
 
-# === Melt and Annotate ===
-melted = ranks.reset_index().melt(id_vars='Gene', var_name='Sample', value_name='Rank')
-melted['Timepoint'] = melted['Sample'].map(timepoint_map)
-melted['Patient'] = melted['Sample'].map(patient_map)
-melted.dropna(subset=['Patient', 'Timepoint'], inplace=True)
-all_timepoints_ordered = sorted(set(melted['Timepoint']), key=sort_timepoints)
-melted.to_csv(os.path.join(output_dir, "melted_gene_methylation_ranks.csv"), index=False)
+# === Full Melted Table (only on request; written in chunks) ===
+metrics.begin("archive")
+if args.export_melted:
+    export_melted(ranks, timepoint_map, patient_map, os.path.join(output_dir, "melted_gene_methylation_ranks.csv"),
+                  sort_key=sort_timepoints)
 
-# === Plot Per-Patient Slope Charts ===
-for patient_id, subdf in melted.groupby("Patient"):
-    if subdf['Timepoint'].nunique() < 2:
-        continue  # skip patients with < 2 timepoints
-    subdf = subdf.copy()
-    subdf['Timepoint'] = pd.Categorical(subdf['Timepoint'], categories=all_timepoints_ordered, ordered=True)
-    
-    plt.figure(figsize=(14, 8))
-    unique_genes = sorted(subdf['Gene'].unique())
+# === Per-Patient Slope Chart ===
+def draw_patient_slope_chart(panel):
+    patient_id = panel.patient
+
+    fig, ax = plt.subplots(figsize=(14, 8))
+    unique_genes = sorted(panel.ranks.index)
     color_palette = sns.color_palette("hls", len(unique_genes))
     gene_colors = dict(zip(unique_genes, color_palette))
 
-    for gene, gene_df in subdf.groupby("Gene"):
-        plt.plot(gene_df['Timepoint'], gene_df['Rank'], label=gene, color=gene_colors[gene], linewidth=2)
-
+    # Every gene is colored here, so everything lands in the single highlight LineCollection
+    handles = draw_slope_chart(ax, panel, gene_colors, highlight_style={"linewidth": 2, "alpha": 1.0})
     plt.yscale("log")
     plt.gca().invert_yaxis()
 
-    collapsed_count = (subdf['Rank'] == 21).sum()
+    collapsed_count = int((panel.ranks.to_numpy() == rank_cap).sum())
     plt.text(
         0.99, 0.02,
-        f"{collapsed_count} gene-timepoints at rank 21",
+        f"{collapsed_count} gene-timepoints at rank {rank_cap}",
         ha='right', va='bottom',
         transform=plt.gca().transAxes,
         fontsize=10, color='gray'
@@ -88,9 +97,26 @@ for patient_id, subdf in melted.groupby("Patient"):
     plt.ylabel("Gene Rank (smaller = more methylated, log scale)")
     plt.xlabel("Timepoint")
 
-    plt.legend(title="Gene", bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0.)
+    plt.legend(handles=handles, title="Gene", bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0.)
     plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, f"rank_slopeplot_patient_{patient_id}.png"))
+    png_bytes = figure_bytes(plt.gcf(), "png")
     plt.close()
+    return png_bytes
+
+# === Plot Per-Patient Slope Charts ===
+metrics.begin("render")
+for panel in build_patient_panels(ranks, timepoint_map, patient_map, sort_timepoints):
+    patient_id = panel.patient
+
+    # Panels whose ranks, highlight genes and drawing code are unchanged are copied from the figure cache
+    figure_cache.fetch_file(
+        figure_cache.key("rank_slope", panel, rank_cap),
+        os.path.join(output_dir, f"rank_slopeplot_patient_{patient_id}.png"),
+        lambda: draw_patient_slope_chart(panel),
+    )
+
+metrics.begin("archive")
+figure_cache.save()
+print(figure_cache.summary())
 
 print(f"All per-patient rank slope plots saved to: {output_dir}")
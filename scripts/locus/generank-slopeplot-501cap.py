@@ -4,15 +4,29 @@
 import os
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import re
+import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.topk import topk_labels
+from methpipe.ranking import CappedRanks
+from methpipe.slopeplot import build_patient_panels, draw_slope_chart, export_melted
+from methpipe.archive import figure_bytes
+from methpipe.figcache import FigureCache, script_salt
 
 # === Settings ===
+parser = argparse.ArgumentParser(description='Plot per-patient gene rank slope charts with ranks capped at 501.')
+parser.add_argument('--export-melted', action='store_true', help='Also write the full long-format melted_gene_methylation_ranks.csv (slow for large cohorts)')
+args = parser.parse_args()
+
 input_path = os.path.join("output", "gene_methylation_matrix.csv")
 patient_list_path = os.path.join("data", "Patient ID list fot EMseq16-18-20.xlsx")
 output_dir = os.path.join("plots", "rank-slopeplot")
+rank_cap = 501  # every gene ranked 501 or lower shares rank 501
 os.makedirs(output_dir, exist_ok=True)
+figure_cache = FigureCache(salt=script_salt(__file__))
 
 # === Helper Functions ===
 def classify_detailed_timepoint(sample_name):
@@ -38,71 +52,74 @@ def get_patient(sample_name, patient_ids):
     return next((pid for pid in patient_ids if pid in sample_name), None)
 
 # === Load Data ===
+metrics.begin("load")
 matrix = pd.read_csv(input_path, index_col=0)
 patients = pd.read_excel(patient_list_path).iloc[:, 0].dropna().astype(str).tolist()
 
 # === Create Rankings Per Sample ===
-ranks = matrix.rank(axis=0, method='min', ascending=False)
-ranks[ranks >= 501] = 501
+metrics.begin("stats")
+ranks = CappedRanks(matrix, caps=[rank_cap]).get(rank_cap)
 ranks.to_csv(os.path.join(output_dir, "gene_methylation_ranks.csv"))
 
+# === Top 10 Genes Per Sample (all samples in one pass) ===
+top10_by_sample = topk_labels(ranks, 10, largest=False)
+
 # === Metadata Mapping ===
+metrics.begin("match")
 timepoint_map = {col: classify_detailed_timepoint(col) for col in ranks.columns}
 patient_map = {col: get_patient(col, patients) for col in ranks.columns}
 
-# === Melt and Annotate ===
-melted = ranks.reset_index().melt(id_vars='Gene', var_name='Sample', value_name='Rank')
-melted['Timepoint'] = melted['Sample'].map(timepoint_map)
-melted['Patient'] = melted['Sample'].map(patient_map)
-melted.dropna(subset=['Patient', 'Timepoint'], inplace=True)
-all_timepoints_ordered = sorted(set(melted['Timepoint']), key=sort_timepoints)
-
-# === Plot Per-Patient Slope Charts ===
-for patient_id, subdf in melted.groupby("Patient"):
-    if subdf['Timepoint'].nunique() < 2:
-        continue
-
-    # Determine highlight genes per patient by checking all their samples
-    patient_samples = subdf['Sample'].unique()
-    highlight_genes = set()
-    for sample in patient_samples:
-        top10_genes = ranks[sample].nsmallest(10).index.tolist()
-        highlight_genes.update(top10_genes)
+# === Per-Patient Slope Chart ===
+def draw_patient_slope_chart(panel):
+    patient_id = panel.patient
 
     # Assign colors
-    highlight_genes = sorted(highlight_genes)
+    highlight_genes = panel.highlight
     color_palette = sns.color_palette("husl", len(highlight_genes))
     gene_color_dict = dict(zip(highlight_genes, color_palette))
 
-    plt.figure(figsize=(14, 8))
-    subdf = subdf.copy()
-    subdf['Timepoint'] = pd.Categorical(subdf['Timepoint'], categories=all_timepoints_ordered, ordered=True)
-
-    for gene, gene_df in subdf.groupby("Gene"):
-        gene_df = gene_df.sort_values('Timepoint')
-        color = gene_color_dict.get(gene, 'black')
-        plt.plot(gene_df['Timepoint'], gene_df['Rank'], alpha=0.6, linewidth=0.8, color=color, label=gene if gene in gene_color_dict else None)
+    # All genes are drawn as two LineCollections (black background + colored highlights)
+    fig, ax = plt.subplots(figsize=(14, 8))
+    handles = draw_slope_chart(ax, panel, gene_color_dict)
 
     plt.yscale("log")
     plt.gca().invert_yaxis()
-    collapsed_count = (subdf['Rank'] == 501).sum()
-    plt.text(0.99, 0.02, f"{collapsed_count} gene-timepoints at rank 501", ha='right', va='bottom',
+    collapsed_count = int((panel.ranks.to_numpy() == rank_cap).sum())
+    plt.text(0.99, 0.02, f"{collapsed_count} gene-timepoints at rank {rank_cap}", ha='right', va='bottom',
              transform=plt.gca().transAxes, fontsize=10, color='gray')
     plt.title(f"Gene Ranking Trajectories for Patient {patient_id}")
     plt.ylabel("Gene Rank (smaller = more methylated, log scale)")
     plt.xlabel("Timepoint")
 
     # Add legend for highlight genes only
-    handles, labels = plt.gca().get_legend_handles_labels()
     if handles:
-        unique = dict(zip(labels, handles))
-        plt.legend(unique.values(), unique.keys(), title="Top 10 Genes (per sample)", fontsize=8, title_fontsize=9)
+        plt.legend(handles=handles, title="Top 10 Genes (per sample)", fontsize=8, title_fontsize=9)
 
     plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, f"rank_slopeplot_patient_{patient_id}.png"))
+    png_bytes = figure_bytes(plt.gcf(), "png")
     plt.close()
+    return png_bytes
 
-# Save full melted table
-melted.to_csv(os.path.join(output_dir, "melted_gene_methylation_ranks.csv"), index=False)
+# === Plot Per-Patient Slope Charts ===
+metrics.begin("render")
+# Highlight genes are picked per patient straight from the wide rank matrix.
+for panel in build_patient_panels(ranks, timepoint_map, patient_map, sort_timepoints, top_by_sample=top10_by_sample):
+    patient_id = panel.patient
+
+    # Panels whose ranks, highlight genes and drawing code are unchanged are copied from the figure cache
+    figure_cache.fetch_file(
+        figure_cache.key("rank_slope", panel, rank_cap),
+        os.path.join(output_dir, f"rank_slopeplot_patient_{patient_id}.png"),
+        lambda: draw_patient_slope_chart(panel),
+    )
+
+metrics.begin("archive")
+figure_cache.save()
+print(figure_cache.summary())
+
+# Save full melted table (only on request; written in chunks)
+if args.export_melted:
+    export_melted(ranks, timepoint_map, patient_map, os.path.join(output_dir, "melted_gene_methylation_ranks.csv"),
+                  sort_key=sort_timepoints)
 
 print(f"Finished! Slope plots saved in: {output_dir}")
@@ -1,9 +1,11 @@
 import os
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import re
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt
+from methpipe import metrics
 
 # === Settings ===
 input_path = os.path.join("plots", "heatmaps-lineplots", "gene_methylation_matrix.csv")
@@ -35,16 +37,19 @@ def get_patient(sample_name, patient_ids):
     return next((pid for pid in patient_ids if pid in sample_name), None)
 
 # === Load Data ===
+metrics.begin("load")
 matrix = pd.read_csv(input_path, index_col=0)
 patients = pd.read_excel(patient_list_path).iloc[:, 0].dropna().astype(str).tolist()
 
 # === Create Rankings Per Sample ===
+metrics.begin("stats")
 ranks = matrix.rank(axis=0, method='min', ascending=False)
 ranks.to_csv(os.path.join(output_dir, "gene_methylation_ranks.csv"))
 timepoint_map = {col: classify_detailed_timepoint(col) for col in ranks.columns}
 patient_map = {col: get_patient(col, patients) for col in ranks.columns}
 
 # === Melt and Annotate ===
+metrics.begin("align")
 melted = ranks.reset_index().melt(id_vars='Gene', var_name='Sample', value_name='Rank')
 melted['Timepoint'] = melted['Sample'].map(timepoint_map)
 melted['Patient'] = melted['Sample'].map(patient_map)
@@ -53,6 +58,7 @@ melted['Timepoint'] = pd.Categorical(melted['Timepoint'], categories=sorted(set(
 melted.to_csv(os.path.join(output_dir, "melted_gene_methylation_ranks.csv"))
 
 # === Plot Per-Patient Slope Charts ===
+metrics.begin("render")
 for patient_id, subdf in melted.groupby("Patient"):
     if subdf['Timepoint'].nunique() < 2:
         continue  # skip patients with < 2 timepoints
@@ -2,13 +2,14 @@ import os
 import glob
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import argparse
-from scipy.stats import ttest_rel
-from tqdm import tqdm
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns, ttest_rel
+from methpipe import metrics
+from methpipe.progress import progress
+from methpipe.topk import topk_series
+from methpipe.dataset import load_analysis_dataset
 
 parser = argparse.ArgumentParser(description='Generate gene-level methylation heatmaps and line plots based on delta values.')
 parser.add_argument('--output_dir', type=str, default='plots/heatmaps-lineplots', help='Directory to save plots')
@@ -37,22 +38,29 @@ def get_patient(sample):
     return next((pid for pid in patient_ids if pid in sample), None)
 
 # Load data
+metrics.begin("load")
 output_folder = 'output'
 data_folder = 'data'
 cpg_matrix_file = find_file(output_folder, "matrix")
 patient_list_file = find_file(data_folder, "patient")
 gene_annotation_file = find_file(output_folder, "cgi_map")
 
-cpg_matrix = pd.read_excel(cpg_matrix_file, index_col=0) if cpg_matrix_file.endswith('.xlsx') else pd.read_csv(cpg_matrix_file, sep="\t", index_col=0)
 patient_df = pd.read_excel(patient_list_file)
+patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
+if cpg_matrix_file.endswith('.xlsx'):
+    # CGI rows of the scaled matrix, parsed once and then loaded from the dataset cache
+    cpg_matrix = load_analysis_dataset(cpg_matrix_file, patient_ids).cgi_matrix
+else:
+    cpg_matrix = pd.read_csv(cpg_matrix_file, sep="\t", index_col=0)
 gene_annot_raw = pd.read_excel(gene_annotation_file) if gene_annotation_file.endswith('.xlsx') else pd.read_csv(gene_annotation_file)
 
+metrics.begin("match")
 gene_annot = gene_annot_raw[gene_annot_raw['gene_name'].notna()].copy()
 gene_annot['gene_name'] = gene_annot['gene_name'].astype(str)
 cpg_headers = cpg_matrix.index.astype(str).tolist()
 
 matched = []
-for _, row in tqdm(gene_annot.iterrows(), total=gene_annot.shape[0], desc="Matching CpGs"):
+for _, row in progress(gene_annot.iterrows(), total=gene_annot.shape[0], desc="Matching CpGs"):
     gene = row['gene_name']
     matched_cpgs = [h for h in cpg_headers if gene in h]
     for cpg in matched_cpgs:
@@ -62,12 +70,10 @@ gene_annot = pd.DataFrame(matched)
 cpg_gene_counts = gene_annot['gene_name'].value_counts()
 multicpg_genes = cpg_gene_counts[cpg_gene_counts > 1].index.tolist()
 
-patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
-
 # Delta calculations
 def calculate_deltas(tp1, tp2):
     deltas, stats = {}, []
-    for gene in tqdm(multicpg_genes, desc=f"Calculating deltas for {tp1} vs {tp2}"):
+    for gene in progress(multicpg_genes, desc=f"Calculating deltas for {tp1} vs {tp2}"):
         cpgs = gene_annot[gene_annot['gene_name'] == gene]['cgi_id']
         gene_data = cpg_matrix.loc[cpg_matrix.index.intersection(cpgs)]
         if gene_data.empty:
@@ -88,11 +94,13 @@ def calculate_deltas(tp1, tp2):
                 stats.append({'Gene': gene, 'Delta': avg_delta, 'T-stat': t_stat, 'P-value': p_val})
     return deltas, pd.DataFrame(stats)
 
+metrics.begin("stats")
 baseline_post, stats_bp = calculate_deltas("Baseline", "Post-Treatment")
 baseline_on, stats_bo = calculate_deltas("Baseline", "On-Treatment")
 on_post, stats_op = calculate_deltas("On-Treatment", "Post-Treatment")
 
 # Save stats
+metrics.begin("archive")
 pd.DataFrame({
     'Baseline → Post-Treatment': pd.Series(baseline_post),
     'Baseline → On-Treatment': pd.Series(baseline_on),
@@ -103,7 +111,8 @@ stats_bo.to_csv(os.path.join(args.output_dir, "baseline_vs_on_ttest.csv"), index
 stats_op.to_csv(os.path.join(args.output_dir, "on_vs_post_ttest.csv"), index=False)
 
 # Filter top 10 genes by delta
-top_genes = pd.Series(baseline_post).abs().sort_values(ascending=False).head(10).index.tolist()
+metrics.begin("render")
+top_genes = topk_series(pd.Series(baseline_post).abs(), 10).index.tolist()
 
 # Barplot for delta values of top 10 genes
 comparisons = {
@@ -2,17 +2,22 @@ import os
 import glob
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import argparse
-from scipy.stats import ttest_rel
-from tqdm import tqdm
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns, ttest_rel
+from methpipe import metrics, workqueue
+from methpipe.geneindex import gene_index
+from methpipe.progress import progress
+from methpipe.topk import topk_series
+from methpipe.dataset import load_analysis_dataset
 
 parser = argparse.ArgumentParser(description='Generate gene-level methylation heatmaps and line plots based on delta values.')
 parser.add_argument('--output_dir', type=str, default='plots/heatmaps-lineplots', help='Directory to save plots')
+parser.add_argument('--block-size', type=int, default=200, help='Genes per task in the distributed mode')
+workqueue.add_queue_arguments(parser)
 args = parser.parse_args()
+queue, role = workqueue.queue_role(parser, args)
 
 os.makedirs(args.output_dir, exist_ok=True)
 
@@ -37,41 +42,33 @@ def get_patient(sample):
     return next((pid for pid in patient_ids if pid in sample), None)
 
 # Load data
+metrics.begin("load")
 output_folder = 'output'
 data_folder = 'data'
 cpg_matrix_file = find_file(output_folder, "matrix")
 patient_list_file = find_file(data_folder, "patient")
 gene_annotation_file = find_file(output_folder, "cgi_map")
 
-cpg_matrix = pd.read_excel(cpg_matrix_file, index_col=0) if cpg_matrix_file.endswith('.xlsx') else pd.read_csv(cpg_matrix_file, sep="\t", index_col=0)
 patient_df = pd.read_excel(patient_list_file)
+patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
+if cpg_matrix_file.endswith('.xlsx'):
+    # CGI rows of the scaled matrix, parsed once and then loaded from the dataset cache
+    cpg_matrix = load_analysis_dataset(cpg_matrix_file, patient_ids).cgi_matrix
+else:
+    cpg_matrix = pd.read_csv(cpg_matrix_file, sep="\t", index_col=0)
 gene_annot_raw = pd.read_excel(gene_annotation_file) if gene_annotation_file.endswith('.xlsx') else pd.read_csv(gene_annotation_file)
 
-gene_annot = gene_annot_raw[gene_annot_raw['gene_name'].notna()].copy()
-gene_annot['gene_name'] = gene_annot['gene_name'].astype(str)
-cpg_headers = cpg_matrix.index.astype(str).tolist()
-
-matched = []
-for _, row in tqdm(gene_annot.iterrows(), total=gene_annot.shape[0], desc="Matching CpGs"):
-    gene = row['gene_name']
-    matched_cpgs = [h for h in cpg_headers if gene in h]
-    for cpg in matched_cpgs:
-        matched.append({'cgi_id': cpg, 'gene_name': gene})
-
-gene_annot = pd.DataFrame(matched)
-cpg_gene_counts = gene_annot['gene_name'].value_counts()
+metrics.begin("match")
+# CGI rows of every gene, from the gene index saved next to the matrix (built by the first run)
+index = gene_index(cpg_matrix.index, gene_annot_raw['gene_name'], cpg_matrix_file)
+cpg_gene_counts = index.match_counts()
 multicpg_genes = cpg_gene_counts[cpg_gene_counts > 1].index.tolist()
 
-patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
-
 # Delta calculations
-def calculate_deltas(tp1, tp2):
-    deltas, stats = {}, []
-    for gene in tqdm(multicpg_genes, desc=f"Calculating deltas for {tp1} vs {tp2}"):
-        cpgs = gene_annot[gene_annot['gene_name'] == gene]['cgi_id']
-        gene_data = cpg_matrix.loc[cpg_matrix.index.intersection(cpgs)]
-        if gene_data.empty:
-            continue
+def gene_delta_stats(genes, tp1, tp2):
+    stats = []
+    for gene in progress(genes, desc=f"Calculating deltas for {tp1} vs {tp2}"):
+        gene_data = cpg_matrix.iloc[index.rows(gene)]
         avg_gene_methylation = gene_data.mean(axis=0)
         df = avg_gene_methylation.reset_index()
         df.columns = ['Sample', 'Methylation']
@@ -83,16 +80,41 @@ def calculate_deltas(tp1, tp2):
             grouped = grouped.dropna(subset=[tp1, tp2])
             if len(grouped) >= 2:
                 avg_delta = (grouped[tp2] - grouped[tp1]).mean()
-                deltas[gene] = avg_delta
                 t_stat, p_val = ttest_rel(grouped[tp2], grouped[tp1])
-                stats.append({'Gene': gene, 'Delta': avg_delta, 'T-stat': t_stat, 'P-value': p_val})
-    return deltas, pd.DataFrame(stats)
-
-baseline_post, stats_bp = calculate_deltas("Baseline", "Post-Treatment")
-baseline_on, stats_bo = calculate_deltas("Baseline", "On-Treatment")
-on_post, stats_op = calculate_deltas("On-Treatment", "Post-Treatment")
+                stats.append({'Gene': gene, 'Delta': float(avg_delta), 'T-stat': float(t_stat), 'P-value': float(p_val)})
+    return stats
+
+def calculate_deltas(stats):
+    return {row['Gene']: row['Delta'] for row in stats}, pd.DataFrame(stats)
+
+delta_comparisons = [("Baseline", "Post-Treatment"), ("Baseline", "On-Treatment"), ("On-Treatment", "Post-Treatment")]
+
+metrics.begin("stats")
+if role == "submit":
+    # One task per comparison and block of genes; --work runs them on any host, --reduce assembles the tables
+    blocks = [multicpg_genes[i:i + args.block_size] for i in range(0, len(multicpg_genes), args.block_size)]
+    ids = queue.submit([{"tp1": tp1, "tp2": tp2, "genes": genes} for tp1, tp2 in delta_comparisons for genes in blocks],
+                       script=os.path.basename(__file__))
+    print(f"Submitted {len(ids)} gene delta task(s) to {args.queue}")
+    sys.exit(0)
+if role == "work":
+    workqueue.work(queue, lambda task: ([], {"tp1": task["tp1"], "tp2": task["tp2"],
+                                             "stats": gene_delta_stats(task["genes"], task["tp1"], task["tp2"])}))
+    sys.exit(0)
+if role == "reduce":
+    # Task outputs in submission order, so every comparison's rows come back in gene order
+    queue.wait(timeout=args.wait)
+    comparison_stats = {comparison: [] for comparison in delta_comparisons}
+    for _, _, result in queue.results():
+        comparison_stats[(result["tp1"], result["tp2"])] += result["stats"]
+else:
+    comparison_stats = {(tp1, tp2): gene_delta_stats(multicpg_genes, tp1, tp2) for tp1, tp2 in delta_comparisons}
+baseline_post, stats_bp = calculate_deltas(comparison_stats[("Baseline", "Post-Treatment")])
+baseline_on, stats_bo = calculate_deltas(comparison_stats[("Baseline", "On-Treatment")])
+on_post, stats_op = calculate_deltas(comparison_stats[("On-Treatment", "Post-Treatment")])
 
 # Save stats
+metrics.begin("archive")
 pd.DataFrame({
     'Baseline → Post-Treatment': pd.Series(baseline_post),
     'Baseline → On-Treatment': pd.Series(baseline_on),
@@ -103,13 +125,11 @@ stats_bo.to_csv(os.path.join(args.output_dir, "baseline_vs_on_ttest.csv"), index
 stats_op.to_csv(os.path.join(args.output_dir, "on_vs_post_ttest.csv"), index=False)
 
 # Generate gene methylation matrix with fragment counts
+metrics.begin("aggregate")
 gene_methylation_matrix = pd.DataFrame()
 
 for gene in multicpg_genes:
-    cpgs = gene_annot[gene_annot['gene_name'] == gene]['cgi_id']
-    gene_data = cpg_matrix.loc[cpg_matrix.index.intersection(cpgs)]
-    if gene_data.empty:
-        continue
+    gene_data = cpg_matrix.iloc[index.rows(gene)]
     # Sum the fragment counts for all CpGs associated with the gene
     gene_methylation_matrix[gene] = gene_data.sum(axis=0)
 
@@ -119,11 +139,13 @@ gene_methylation_matrix.index.name = "Gene"
 gene_methylation_matrix.columns.name = "Sample"
 
 # Save the matrix to a CSV file
+metrics.begin("archive")
 gene_methylation_matrix.to_csv(os.path.join(args.output_dir, "gene_methylation_matrix.csv"))
 print(f"Gene methylation matrix saved to {os.path.join(args.output_dir, 'gene_methylation_matrix.csv')}")
 
 # Filter top 10 genes by delta
-top_genes = pd.Series(baseline_post).abs().sort_values(ascending=False).head(10).index.tolist()
+metrics.begin("render")
+top_genes = topk_series(pd.Series(baseline_post).abs(), 10).index.tolist()
 
 # Barplot for delta values of top 10 genes
 comparisons = {
@@ -1,57 +1,31 @@
 # -*- coding: utf-8 -*-
 
-import io, os, zipfile, glob
+import io, os, glob
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import re
-from matplotlib.gridspec import GridSpec
-from tqdm import tqdm  # Import tqdm for progress bars
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.progress import progress
+from methpipe.dataset import load_analysis_dataset
+from methpipe.bubbleplot import BubbleFigureTemplate, BubbleLOD, LOD_AGGREGATES, bubble_source, padded_xlim
+from methpipe.archive import FigureArchive
+from methpipe.figcache import FigureCache, script_salt
+
+parser = argparse.ArgumentParser(description="Generate CpG island bubble plots per patient and per chromosome.")
+parser.add_argument("--lod", choices=("off",) + LOD_AGGREGATES, default="off", help="Density-binned level of detail: draw dense chromosomes as one bubble per pixel-width genomic bin, aggregated with max, mean or sum (default: off, every CGI is drawn)")
+parser.add_argument("--lod-threshold", type=int, default=2000, help="Only bin chromosomes with at least this many CGIs in a timepoint row; smaller ones keep full detail")
+parser.add_argument("--lod-bin-px", type=float, default=1.0, help="Bin width in pixels of the plot area")
+parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes shared by all matrix files (1 = render in this process)")
+args = parser.parse_args()
+lod = BubbleLOD(args.lod, args.lod_threshold, args.lod_bin_px) if args.lod != "off" else None
 
-sns.set(style="whitegrid")
 os.makedirs("plots", exist_ok=True)
 
-# === Load Files ===
-methylation_dfs = {}
-patient_ids = []
-
-# Define directories
-output_dir = "output/"
-data_dir = "data/"
-
-# Use a specific .xlsx file named "merged_output_glob20.xlsx" located in the output directory
-merged_file_path = os.path.join(output_dir, "merged_output_glob20.xlsx")
-
-# Check if the file exists
-if not os.path.exists(merged_file_path):
-    raise FileNotFoundError(f"The file '{merged_file_path}' does not exist in the 'output/' directory.")
-
-# Process the specified .xlsx file
-print(f"Processing file: {merged_file_path}")
-df = pd.read_excel(merged_file_path)
-methylation_dfs["merged_output_glob20.xlsx"] = df
-
-# Find files with "patient" in their name from the data directory
-patient_files = glob.glob(os.path.join(data_dir, "*patient*.xlsx")) + glob.glob(os.path.join(data_dir, "*patient*.csv"))
-
-# Process patient files
-for file_path in tqdm(patient_files, desc="Processing patient files"):
-    df = pd.read_excel(file_path, header=None) if file_path.endswith('.xlsx') else pd.read_csv(file_path, header=None)
-    values = df[0].dropna().astype(str).tolist()
-    patient_ids.extend([v for v in values if not v.lower().startswith("unnamed")])
-
-# === Normalize sample names ===
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
 # Define timepoints
 timepoints_patient = ["Baseline", "On-Treatment", "Post-Treatment"]  # Per-patient plots
 timepoints_chromosome = ["Baseline", "On-Treatment", "Post-Treatment"]  # Per-chromosome plots (removed "Healthy")
@@ -69,242 +43,63 @@ timepoint_positions_chromosome = {
     "Post-Treatment": 1.4
 }
 
-# === Process Files ===
-for fname, df in tqdm(methylation_dfs.items(), desc="Processing methylation files"):
-    print(f"\n=== Processing file: {fname} ===")
-    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-    cpg_df = df.iloc[start_idx:].reset_index(drop=True)
-    cpg_df.rename(columns={cpg_df.columns[0]: "CpG_Island"}, inplace=True)
-    cpg_df.dropna(how="all", subset=cpg_df.columns[1:], inplace=True)
-
-    samples = cpg_df.columns[1:]
-    def get_patient(s): return next((pid for pid in patient_ids if pid in s), None)
-    sample_meta = pd.DataFrame({
-        "Sample": samples,
-        "Patient": [get_patient(s) for s in samples],
-        "Timepoint": [normalize_timepoint(s) for s in samples]
-    }).dropna()
-
-    # Remove Healthy samples from matrix
-    non_healthy = sample_meta[sample_meta["Timepoint"] != "Healthy"]
-    matrix = cpg_df.set_index("CpG_Island")[non_healthy["Sample"]]
-    matrix.columns = pd.MultiIndex.from_frame(non_healthy[["Patient", "Timepoint"]])
-    matrix = matrix.apply(pd.to_numeric, errors='coerce')
-    collapsed = matrix.groupby(axis=1, level=[0, 1]).mean()
-
-    # === Extract CpG Coordinates ===
-    cpg_coords = cpg_df["CpG_Island"].str.extract(r"CGI_(chr\w+)_(\d+)_(\d+)", expand=True)
-    cpg_coords.columns = ["Chr", "Start", "End"]
-    cpg_coords = cpg_coords.dropna()
-    cpg_coords["Start"] = cpg_coords["Start"].astype(int)
-    cpg_coords["End"] = cpg_coords["End"].astype(int)
-    cpg_coords["Midpoint"] = (cpg_coords["Start"] + cpg_coords["End"]) // 2
-    cpg_coords["CpG_Island"] = cpg_df["CpG_Island"]
-    coords_df = cpg_coords.set_index("CpG_Island")
-
-    # === Merge data with coordinates ===
-    collapsed_flat = collapsed.copy()
-    collapsed_flat.columns = ['{}_{}'.format(p, tp) for p, tp in collapsed.columns]
-    collapsed_flat = collapsed_flat.reset_index()
-
-    bubble_data = pd.merge(collapsed_flat, coords_df.reset_index(), on="CpG_Island").set_index("CpG_Island")
-
-# === Bubble plots per patient per chromosome ===
-for patient in tqdm(collapsed.columns.levels[0], desc="Generating bubble plots per patient"):
-    for chrom in coords_df["Chr"].unique():
-        # Build a subset for each timepoint, merging them
-        chr_data = bubble_data[bubble_data["Chr"] == chrom]
-
-        # Collect rows for all timepoints in a single DataFrame
-        all_rows = []
-        for tp in timepoints_patient:
-            col = f"{patient}_{tp}"
-            if col not in chr_data.columns:
-                print(f"[WARNING] Column {col} not found for {patient}, {chrom}, skipping.")
-                continue
-            sub = chr_data[[col, "Midpoint"]].dropna().rename(columns={col: "value"})
-            if sub.empty:
-                continue
-            sub["Timepoint"] = tp
-            all_rows.append(sub)
-
-        if not all_rows:
-            # No data for any timepoint
-            continue
-
-        subset_df = pd.concat(all_rows, ignore_index=True)
-
-        # Create figure with 2 columns:
-        # - Left col = main bubble plot
-        # - Right col = sub-gridspec for colorbar (top) + bubble legend (bottom)
-        fig = plt.figure(figsize=(21, 10))  # Increased figure size to prevent cropping
-        gs = GridSpec(nrows=1, ncols=2, width_ratios=[6.5, 0.5], figure=fig)
-
-        # Main axis on the left
-        ax_main = fig.add_subplot(gs[0, 0])
-        ax_main.grid(False)  # Hide grid
-
-        # Sub-gridspec on the right: 2 rows (colorbar top, legend bottom)
-        gs_right = gs[0, 1].subgridspec(nrows=2, ncols=1, height_ratios=[0.5, 0.5])
-        ax_cbar = fig.add_subplot(gs_right[0, 0])
-        ax_cbar.grid(False)  # Hide grid
-        ax_legend = fig.add_subplot(gs_right[1, 0])
-
-        # Plot each row in subset_df
-        sc = None
-        for _, row in subset_df.iterrows():
-            tp = row["Timepoint"]
-            y = timepoint_positions_patient[tp]
-            # Increase bubble scale factor for bigger bubbles
-            bubble_size = row["value"]**0.5 * 800    # bubble size inside the plot area
-            sc = ax_main.scatter(
-                row["Midpoint"],
-                y,
-                s=bubble_size,
-                c=row["value"],
-                cmap="viridis",
-                alpha=0.6,
-                vmin=0,  # lower bound of color scale
-                vmax=50    # increased upper bound of color scale
-            )
-
-        # Format main axis
-        ax_main.set_yticks(list(timepoint_positions_patient.values()))  # Ensure the number of ticks matches the number of labels
-        ax_main.set_yticklabels(timepoints_patient, fontsize=14)
-        ax_main.set_ylim(0.3, 1.7)  # set y-limits so large bubbles have padding above & below
-        # Add x-axis padding to avoid bubble clipping
-        x_min, x_max = subset_df['Midpoint'].min(), subset_df['Midpoint'].max()
-        x_range = x_max - x_min
-        ax_main.set_xlim(x_min - 0.1 * x_range, x_max + 0.1 * x_range)  # Increase x-axis padding
-
-        ax_main.set_xlabel("CpG Island Genomic Coordinate Midpoint (bp)", fontsize=16)
-        ax_main.set_ylabel("Timepoint", fontsize=16)
-        ax_main.set_title(f"DNA Hypermethylation Profiles Throughout Treatment\nPatient: {patient}, Chromosome: {chrom}", fontsize=18)
-        ax_main.tick_params(axis='x', labelsize=14)  # Enlarge x-axis tick markers
-
-        # If we got at least one scatter point, make the colorbar in ax_cbar
-        if sc is not None:
-            cb = fig.colorbar(sc, cax=ax_cbar, label="Scaled Fragment Count Ratio", pad=0.2)  # Adjust the pad value as needed
-            cb.set_label("Scaled Fragment Count Ratio", fontsize=14)
-
-        # Define the x-coordinate for the legend title and legend scatter plot positions
-        legend_x_coord = 0.85
-
-        # Create bubble-size legend in ax_legend
-        ax_legend.axis("off")  # hide ticks and background
-
-        # Define the sizes and calculate bubble sizes
-        sizes = [1, 5, 50]
-        bubble_sizes = [size**0.5 * 800 for size in sizes]    # size of bubbles within legend area
-        print("Legend bubble sizes:", bubble_sizes)
-        print("Main plot bubble size range:", subset_df["value"].apply(lambda v: v**0.5 * 800).describe())
-
-        # Calculate proportional vertical positions based on bubble radii
-        cumulative_height = np.cumsum([size**0.5 for size in sizes])    # legend bubble heights combined
-        total_height = cumulative_height[-1]
-        positions = np.array([2, 8, 17]) * 10/ 1000 * total_height / len(sizes)    # vertical spacing between gray bubble markers
-
-        # Set the x-axis limits explicitly for the legend axis
-        ax_legend.set_xlim(-7, 10)
-
-        # Print the axis limits to check if legend_x_coord is within range
-        x_min, x_max = ax_legend.get_xlim()
-        print(f"Legend x-axis limits: min={x_min}, max={x_max}")
-        print(f"legend_x_coord: {legend_x_coord}")
-
-        if legend_x_coord < x_min or legend_x_coord > x_max:
-            print(f"Warning: legend_x_coord ({legend_x_coord}) is out of bounds!")
-
-        # Manually draw the legend using scatter and text
-        for size, pos in zip(sizes, positions):
-            ax_legend.scatter(legend_x_coord, pos, s=size**0.5 * 800, color="gray", alpha=0.5)    # Use legend_x_coord for gray bubble x-coordinate adjustment (This scaling factor decides the actual legend bubble size)
-            ax_legend.text(legend_x_coord + 10, pos, str(size), verticalalignment='center', horizontalalignment='left', fontsize=14)    # Adjust fragment count text position relative to the gray bubbles based on legend_x_coord
-
-        # Legend title slightly above top bubble, adjust the position as needed
-        ax_legend.text(1.1, positions[-1] + 0.3, "Bubble Size\n(Scaled Fragment Count Ratio)",    # title is 0.2 above the top bubble
-                    horizontalalignment='center', verticalalignment='center', fontweight='bold', fontsize=14)
-
-        # Adjust y-limits to ensure no clipping
-        ax_legend.set_ylim(0, positions[-1] + 0.5)    # legend y-axis limit should be larger than the distance between top bubble and title
-
-        fig.subplots_adjust(left=0.1, right=0.96, top=0.9, bottom=0.1, wspace=0.15, hspace=0.65)  # left=0.1 reserves 10% of the figure width as a margin on the left side, wspace between the plot area and legend area, hspace controls the vertical spacing between colorbar and legend
-
-        filename_base = os.path.join("plots", f"bubbleplot_{patient}_{chrom}")
-        plt.savefig(f"{filename_base}.png")
-        plt.savefig(f"{filename_base}.svg")
-        plt.close()
-
-# === Bubble plots per chromosome (averaged across patients) ===
-for chrom in tqdm(coords_df["Chr"].unique(), desc="Generating bubble plots per chromosome"):
-    chr_data = bubble_data[bubble_data["Chr"] == chrom]
-
-    all_rows = []
-    for tp in timepoints_chromosome:
-        # Find columns that end with e.g. "_Baseline"
-        cols = [c for c in chr_data.columns if c.endswith(f"_{tp}")]
-        if not cols:
-            continue
-        avg = chr_data[cols].mean(axis=1)
-        sub = chr_data.loc[avg.notna(), ["Midpoint"]].copy()
-        sub["value"] = avg[avg.notna()]
-        sub["Timepoint"] = tp
-        all_rows.append(sub)
-
-    if not all_rows:
-        continue
+# === Bubble plot figure template ===
+# The layout (axes, colorbar, bubble-size legend) is identical for every plot, so it is built once
+# and each plot only swaps the bubbles, title and x-limits (per-patient and per-chromosome plots
+# share the same timepoint positions).
+def build_bubble_template():
+    from matplotlib.gridspec import GridSpec
 
-    subset_df = pd.concat(all_rows, ignore_index=True)
+    sns.set(style="whitegrid")
 
+    # Create figure with 2 columns:
+    # - Left col = main bubble plot
+    # - Right col = sub-gridspec for colorbar (top) + bubble legend (bottom)
     fig = plt.figure(figsize=(21, 10))  # Increased figure size to prevent cropping
     gs = GridSpec(nrows=1, ncols=2, width_ratios=[6.5, 0.5], figure=fig)
 
+    # Main axis on the left
     ax_main = fig.add_subplot(gs[0, 0])
     ax_main.grid(False)  # Hide grid
+
+    # Sub-gridspec on the right: 2 rows (colorbar top, legend bottom)
     gs_right = gs[0, 1].subgridspec(nrows=2, ncols=1, height_ratios=[0.5, 0.5])
     ax_cbar = fig.add_subplot(gs_right[0, 0])
     ax_cbar.grid(False)  # Hide grid
     ax_legend = fig.add_subplot(gs_right[1, 0])
 
-    sc = None
-    for _, row in subset_df.iterrows():
-        tp = row["Timepoint"]
-        y = timepoint_positions_chromosome[tp]
-        bubble_size = row["value"]**0.5 * 800    # bubble size inside the plot area
-        sc = ax_main.scatter(
-            row["Midpoint"],
-            y,
-            s=bubble_size,
-            c=row["value"],
-            cmap="viridis",
-            alpha=0.6,
-            vmin=0,  # lower bound of color scale
-            vmax=50    # increased upper bound of color scale
-        )
-
-    ax_main.set_yticks(list(timepoint_positions_chromosome.values()))  # Ensure the number of ticks matches the number of labels
-    ax_main.set_yticklabels(timepoints_chromosome, fontsize=14)
+    # Single scatter whose offsets/sizes/colors are replaced for every plot
+    sc = ax_main.scatter(
+        [], [], s=[], c=[],
+        cmap="viridis",
+        alpha=0.6,
+        vmin=0,  # lower bound of color scale
+        vmax=50    # increased upper bound of color scale
+    )
+
+    # Format main axis
+    ax_main.set_yticks(list(timepoint_positions_patient.values()))  # Ensure the number of ticks matches the number of labels
+    ax_main.set_yticklabels(timepoints_patient, fontsize=14)
     ax_main.set_ylim(0.3, 1.7)  # set y-limits so large bubbles have padding above & below
-    # Add x-axis padding to avoid bubble clipping
-    x_min, x_max = subset_df['Midpoint'].min(), subset_df['Midpoint'].max()
-    x_range = x_max - x_min
-    ax_main.set_xlim(x_min - 0.1 * x_range, x_max + 0.1 * x_range)  # Increase x-axis padding
 
     ax_main.set_xlabel("CpG Island Genomic Coordinate Midpoint (bp)", fontsize=16)
     ax_main.set_ylabel("Timepoint", fontsize=16)
-    ax_main.set_title(f"DNA Hypermethylation Profiles Throughout Treatment (Averaged Across Patients)\nChromosome: {chrom}", fontsize=18)
+    ax_main.set_title("", fontsize=18)
     ax_main.tick_params(axis='x', labelsize=14)  # Enlarge x-axis tick markers
 
-    if sc is not None:
-        cbar = fig.colorbar(sc, cax=ax_cbar, label="Scaled Fragment Count Ratio", pad=0.2)  # Adjust the pad value as needed
-        cbar.set_label("Scaled Fragment Count Ratio", fontsize=14)
+    cb = fig.colorbar(sc, cax=ax_cbar, label="Scaled Fragment Count Ratio", pad=0.2)  # Adjust the pad value as needed
+    cb.set_label("Scaled Fragment Count Ratio", fontsize=14)
 
-    ax_legend.axis("off")
+    # Define the x-coordinate for the legend title and legend scatter plot positions
+    legend_x_coord = 0.85
 
-    # Use the same logic as the per-patient plots for legend spacing
+    # Create bubble-size legend in ax_legend
+    ax_legend.axis("off")  # hide ticks and background
+
+    # Define the sizes and calculate bubble sizes
     sizes = [1, 5, 50]
-    bubble_sizes = [size**0.5 * 800 for size in sizes]    # bubble size inside the legend area
+    bubble_sizes = [size**0.5 * 800 for size in sizes]    # size of bubbles within legend area
     print("Legend bubble sizes:", bubble_sizes)
-    print("Main plot bubble size range:", subset_df["value"].apply(lambda v: v**0.5 * 800).describe())
 
     # Calculate proportional vertical positions based on bubble radii
     cumulative_height = np.cumsum([size**0.5 for size in sizes])    # legend bubble heights combined
@@ -332,32 +127,176 @@ for chrom in tqdm(coords_df["Chr"].unique(), desc="Generating bubble plots per c
                 horizontalalignment='center', verticalalignment='center', fontweight='bold', fontsize=14)
 
     # Adjust y-limits to ensure no clipping
-    ax_legend.set_ylim(0, positions[-1] + 0.5)    # legend y-axis limit should be larger than the distance between top bubble and legend title
+    ax_legend.set_ylim(0, positions[-1] + 0.5)    # legend y-axis limit should be larger than the distance between top bubble and title
 
     fig.subplots_adjust(left=0.1, right=0.96, top=0.9, bottom=0.1, wspace=0.15, hspace=0.65)  # left=0.1 reserves 10% of the figure width as a margin on the left side, wspace between the plot area and legend area, hspace controls the vertical spacing between colorbar and legend
-    filename_base = os.path.join("plots", f"bubbleplot_{chrom}")
-    plt.savefig(f"{filename_base}.png")
-    plt.savefig(f"{filename_base}.svg")
-    plt.close()
-
-# === Create ZIP of all plots ===
-zip_path = os.path.join("plots", "bubbleplots.zip")
-with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-    for root, _, files in os.walk("plots"):
-        for file in files:
-            if file.startswith("bubbleplot_") and (file.endswith(".png") or file.endswith(".svg")):
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, start="plots")
-                zipf.write(file_path, arcname=arcname)
-
-print(f"All bubble plot files zipped and saved to: {zip_path}")
-
-# === Remove individual plot files after zipping ===
-for root, _, files in os.walk("plots"):
-    for file in files:
-        if file.startswith("bubbleplot_") and (file.endswith(".png") or file.endswith(".svg")):
-            file_path = os.path.join(root, file)
-            if file_path != zip_path:
-                os.remove(file_path)
-
-print(f"Individual bubble plot files have been removed after zipping.")
+
+    return BubbleFigureTemplate(fig, ax_main, sc, size_scale=800)    # bubble size inside the plot area = value**0.5 * 800
+
+# === Bubble plot tasks ===
+# A task renders all plots of one patient (or the per-chromosome averages) of one matrix file and
+# returns the encoded files. Each worker process builds the figure template once and keeps the
+# bubble data of every file it has seen, so all matrix files share one pool of workers. Figures whose
+# exact data slice and render settings were produced before are copied from the figure cache.
+_template = None
+_cache = None
+_sources = {}
+
+def worker_state(path, patient_ids):
+    global _template, _cache
+    if _template is None:
+        _template = build_bubble_template()
+        _cache = FigureCache(salt=script_salt(__file__))
+    if path not in _sources:
+        _sources[path] = bubble_source(load_analysis_dataset(path, patient_ids).collapsed)
+    return _template, _cache, _sources[path]
+
+# === Bubble plots per patient per chromosome ===
+def plot_patient(template, cache, source, patient, prefix):
+    entries = []
+    for chrom, rows in source.chrom_rows.items():
+        chr_midpoints = source.midpoints[rows]
+
+        # Collect the non-missing CGIs of every timepoint
+        xs, ys, vs = [], [], []
+        for tp in timepoints_patient:
+            col = f"{patient}_{tp}"
+            if (patient, tp) not in source.column_pos:
+                print(f"[WARNING] Column {col} not found for {patient}, {chrom}, skipping.")
+                continue
+            tp_values = source.values[rows, source.column_pos[(patient, tp)]]
+            keep = ~np.isnan(tp_values)
+            if not keep.any():
+                continue
+            xs.append(chr_midpoints[keep])
+            ys.append(np.full(keep.sum(), timepoint_positions_patient[tp]))
+            vs.append(tp_values[keep])
+
+        if not xs:
+            # No data for any timepoint
+            continue
+
+        x, y, v = np.concatenate(xs), np.concatenate(ys), np.concatenate(vs)
+
+        print("Main plot bubble size range:", (pd.Series(v, name="value") ** 0.5 * 800).describe())
+        # Swap the bubbles into the template (x-axis padding avoids bubble clipping), or reuse the cached figure
+        entries += template.render_cached(
+            cache, f"{prefix}bubbleplot_{patient}_{chrom}",
+            x, y, v,
+            f"DNA Hypermethylation Profiles Throughout Treatment\nPatient: {patient}, Chromosome: {chrom}",
+            padded_xlim(x),
+            lod=lod,
+        )
+    return entries
+
+# === Bubble plots per chromosome (averaged across patients) ===
+def plot_chromosome_averages(template, cache, source, prefix):
+    entries = []
+    for chrom, rows in source.chrom_rows.items():
+        chr_midpoints = source.midpoints[rows]
+
+        xs, ys, vs = [], [], []
+        for tp in timepoints_chromosome:
+            cols = source.timepoint_cols.get(tp, [])
+            if not len(cols):
+                continue
+            # NaN-aware mean across the patients' columns for this timepoint
+            block = source.values[rows][:, cols]
+            counts = (~np.isnan(block)).sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                avg = np.nansum(block, axis=1) / counts
+            keep = counts > 0
+            xs.append(chr_midpoints[keep])
+            ys.append(np.full(keep.sum(), timepoint_positions_chromosome[tp]))
+            vs.append(avg[keep])
+
+        if not xs:
+            continue
+
+        x, y, v = np.concatenate(xs), np.concatenate(ys), np.concatenate(vs)
+
+        print("Main plot bubble size range:", (pd.Series(v, name="value") ** 0.5 * 800).describe())
+        entries += template.render_cached(
+            cache, f"{prefix}bubbleplot_{chrom}",
+            x, y, v,
+            f"DNA Hypermethylation Profiles Throughout Treatment (Averaged Across Patients)\nChromosome: {chrom}",
+            padded_xlim(x),
+            lod=lod,
+        )
+    return entries
+
+def render_task(task):
+    path, patient_ids, prefix, patient = task
+    with metrics.stage("load"):
+        template, cache, source = worker_state(path, patient_ids)
+    with metrics.stage("render", patient=patient or "averages"):
+        if patient is None:
+            entries = plot_chromosome_averages(template, cache, source, prefix)
+        else:
+            entries = plot_patient(template, cache, source, patient, prefix)
+    return entries, cache.take_added()
+
+def main():
+    # === Load Files ===
+    metrics.begin("load")
+    patient_ids = []
+
+    # Define directories
+    output_dir = "output/"
+    data_dir = "data/"
+
+    # Use a specific .xlsx file named "merged_output_glob20.xlsx" located in the output directory
+    merged_file_path = os.path.join(output_dir, "merged_output_glob20.xlsx")
+
+    # Check if the file exists
+    if not os.path.exists(merged_file_path):
+        raise FileNotFoundError(f"The file '{merged_file_path}' does not exist in the 'output/' directory.")
+    ratio_files = [merged_file_path]
+
+    # Find files with "patient" in their name from the data directory
+    patient_files = glob.glob(os.path.join(data_dir, "*patient*.xlsx")) + glob.glob(os.path.join(data_dir, "*patient*.csv"))
+
+    # Process patient files
+    for file_path in progress(patient_files, desc="Processing patient files"):
+        df = pd.read_excel(file_path, header=None) if file_path.endswith('.xlsx') else pd.read_csv(file_path, header=None)
+        values = df[0].dropna().astype(str).tolist()
+        patient_ids.extend([v for v in values if not v.lower().startswith("unnamed")])
+
+    # Parse every matrix (or load it from the dataset cache) here first, so the workers only read the cache
+    file_patients = {}
+    for file_path in progress(ratio_files, desc="Processing ratio files"):
+        print(f"\n=== Processing file: {os.path.basename(file_path)} ===")
+        file_patients[file_path] = load_analysis_dataset(file_path, patient_ids).collapsed.columns.levels[0]
+
+    # One task per patient plus one for the per-chromosome averages, for every file; when several
+    # files are plotted in one run, each file's plots go into a folder named after the file
+    tasks = []
+    for file_path, patients in file_patients.items():
+        prefix = f"{os.path.splitext(os.path.basename(file_path))[0]}/" if len(file_patients) > 1 else ""
+        tasks += [(file_path, patient_ids, prefix, patient) for patient in patients]
+        tasks.append((file_path, patient_ids, prefix, None))
+
+    # Figures are rendered in memory and streamed straight into the zip (PNG stored, SVG deflated)
+    zip_path = os.path.join("plots", "bubbleplots.zip")
+    archive = FigureArchive(zip_path, compresslevel=6, background=True)
+    cache = FigureCache(salt=script_salt(__file__))
+
+    workers = min(args.workers, len(tasks))
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    metrics.end()
+    results = pool.map(render_task, tasks) if pool else map(render_task, tasks)
+    for entries, cached in progress(results, total=len(tasks), desc="Generating bubble plots"):
+        for name, data in entries:
+            archive.write(name, data)
+        cache.merge(cached)
+    if pool:
+        pool.shutdown()
+
+    # === Finish ZIP of all plots ===
+    metrics.begin("archive")
+    archive.close()
+    cache.save()
+    print(f"All bubble plot files zipped and saved to: {zip_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import glob
-import zipfile
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.topk import topk_rows
+from methpipe.dataset import load_analysis_dataset
+from methpipe.archive import FigureArchive
 
 class Args:
     patients = ""
@@ -29,62 +33,32 @@ if matrix_files:
 else:
     raise FileNotFoundError("No matrix file found in the output folder.")
 
-methylation_dfs = {}
+methylation_files = {}
 patient_ids = []
 
 os.makedirs(args.outdir, exist_ok=True)
 
 # Read files
+metrics.begin("load")
 if "patient" in args.patients.lower():
     patient_df = pd.read_excel(args.patients)
     patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
 
-df = pd.read_excel(args.methylation)
-methylation_dfs[os.path.basename(args.methylation)] = df
-
-# Metadata functions
-def get_patient(sample):
-    for pid in patient_ids:
-        if pid in sample:
-            return pid
-    return None
-
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
-# Process the methylation data
-top10dmplot_filenames = []
-
-for fname, df in methylation_dfs.items():
+methylation_files[os.path.basename(args.methylation)] = args.methylation
+
+# Plots and tables are rendered in memory and written straight into the zip
+zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
+archive = FigureArchive(zip_filename)
+
+for fname, path in methylation_files.items():
     print(f"\n=== Processing file: {fname} ===")
     base_fname = os.path.splitext(fname)[0]  # For cleaner filenames
 
-    # Locate locus-level matrix
-    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-    cpg_island_df = df.iloc[start_idx:].reset_index(drop=True)
-    cpg_island_df.rename(columns={cpg_island_df.columns[0]: "CpG_Island"}, inplace=True)
-    cpg_island_df.dropna(how="all", subset=cpg_island_df.columns[1:], inplace=True)
-
-    samples = cpg_island_df.columns[1:]
-    sample_meta = pd.DataFrame({
-        "Sample": samples,
-        "Patient": [get_patient(s) for s in samples],
-        "Timepoint": [normalize_timepoint(s) for s in samples]
-    })
-    valid_samples = sample_meta.dropna()
-    valid_samples = valid_samples[valid_samples["Timepoint"] != "Healthy"]
-
-    matrix = cpg_island_df.set_index("CpG_Island")[valid_samples["Sample"].tolist()]
-    matrix.columns = pd.MultiIndex.from_frame(valid_samples[["Patient", "Timepoint"]])
-    matrix = matrix.apply(pd.to_numeric, errors='coerce')
-    collapsed = matrix.T.groupby(level=[0, 1]).mean().T
+    # Locus-level matrix and replicate-collapsed matrix (parsed once, then loaded from the dataset cache)
+    metrics.begin("load", file=fname)
+    dataset = load_analysis_dataset(path, patient_ids)
+    matrix = dataset.matrix
+    collapsed = dataset.collapsed
 
     def calculate_deltas(collapsed, timepoint1, timepoint2):
         changes = []
@@ -98,11 +72,11 @@ for fname, df in methylation_dfs.items():
                         deltas.append(t2 - t1)
             if len(deltas) >= 2:
                 changes.append((cpg, np.mean(deltas), len(deltas)))
-        return pd.DataFrame(changes, columns=["CpG_Island", "Avg_Delta", "n"]).sort_values("Avg_Delta")
+        return pd.DataFrame(changes, columns=["CpG_Island", "Avg_Delta", "n"])
 
     def plot_top10_diff_cgi_subregions(df, title, filename):
         fig, ax = plt.subplots(figsize=(10, 6))
-        sns.barplot(data=df.head(10), x="Avg_Delta", y="CpG_Island", color='darkblue', ax=ax)
+        sns.barplot(data=topk_rows(df, "Avg_Delta", 10, largest=False), x="Avg_Delta", y="CpG_Island", color='darkblue', ax=ax)
         ax.set_xlabel("Avg Change in Scaled Methylated Fragment Count Ratio")
         ax.axvline(0, color="gray", linestyle="--")
         # Remove the default title and use Figure.text to position it manually
@@ -110,10 +84,8 @@ for fname, df in methylation_dfs.items():
         fig.text(0.17, 0.98, title, ha='left', va='top', fontsize=12)
         # Adjust the layout to create more space above the plot
         fig.tight_layout(rect=[0, 0, 1, 0.96])  # Lower the plot by adjusting the rect parameter
-        plot_path = os.path.join(args.outdir, filename)
-        fig.savefig(plot_path)
+        archive.savefig(fig, filename)
         plt.close(fig)
-        top10dmplot_filenames.append(plot_path)
 
     def plot_multi_cpg_genes(df, title, filename):
         df["Gene"] = df["CpG_Island"].str.extract(r"chr\w+_\d+_\d+_(.+?)_")
@@ -126,34 +98,32 @@ for fname, df in methylation_dfs.items():
         plt.axvline(0, color="gray", linestyle="--")
         plt.title(title, loc='center')  # Move the title to the left
         plt.tight_layout()
-        plot_path = os.path.join(args.outdir, filename)
-        plt.savefig(plot_path)
+        archive.savefig(plt.gcf(), filename)
         plt.close()
-        top10dmplot_filenames.append(plot_path)
 
     # Generate and plot for baseline vs post-treatment
+    metrics.begin("stats", comparison="baseline_post")
     top_df_baseline_post = calculate_deltas(collapsed, "Baseline", "Post-Treatment")
+    metrics.begin("render", comparison="baseline_post")
     plot_top10_diff_cgi_subregions(top_df_baseline_post, "Top 10 Differentially Methylated Subregions of CpG Islands (Baseline vs Post-Treatment)", "top10_diff_CGIsubregions_baseline_post.png")
     plot_multi_cpg_genes(top_df_baseline_post, "Genes with More than One Affected CpG Island (Baseline vs Post-Treatment)", "multi_CpG_genes_baseline_post.png")
 
     # Generate and plot for baseline vs on-treatment
+    metrics.begin("stats", comparison="baseline_on")
     top_df_baseline_on = calculate_deltas(collapsed, "Baseline", "On-Treatment")
+    metrics.begin("render", comparison="baseline_on")
     plot_top10_diff_cgi_subregions(top_df_baseline_on, "Top 10 Differentially Methylated Subregions of CpG Islands (Baseline vs On-Treatment)", "top10_diff_CGIsubregions_baseline_on.png")
     plot_multi_cpg_genes(top_df_baseline_on, "Genes with More than One Affected CpG Island (Baseline vs On-Treatment)", "multi_CpG_genes_baseline_on.png")
 
     # Generate and plot for on-treatment vs post-treatment
+    metrics.begin("stats", comparison="on_post")
     top_df_on_post = calculate_deltas(collapsed, "On-Treatment", "Post-Treatment")
+    metrics.begin("render", comparison="on_post")
     plot_top10_diff_cgi_subregions(top_df_on_post, "Top 10 Differentially Methylated Subregions of CpG Islands (On-Treatment vs Post-Treatment)", "top10_diff_CGIsubregions_on_post.png")
     plot_multi_cpg_genes(top_df_on_post, "Genes with More than One Affected CpG Island (On-Treatment vs Post-Treatment)", "multi_CpG_genes_on_post.png")
 
-# Create a zip file containing all plot files
-zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
-with zipfile.ZipFile(zip_filename, 'w') as zipf:
-    for plot_filename in top10dmplot_filenames:
-        zipf.write(plot_filename, arcname=os.path.basename(plot_filename))
-
-# Delete the individual plot files after zipping
-for plot_filename in top10dmplot_filenames:
-    os.remove(plot_filename)
+# Finish the zip file
+metrics.begin("archive")
+archive.close()
 
 print(f'Saved plots and zipped them in {zip_filename}')
@@ -1,10 +1,14 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import glob
-import zipfile
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.topk import topk_rows
+from methpipe.dataset import load_analysis_dataset
+from methpipe.archive import FigureArchive
 
 class Args:
     patients = ""
@@ -30,6 +34,7 @@ else:
     raise FileNotFoundError("No matrix file found in the output folder.")
 
 # Load CpG → Gene mapping
+metrics.begin("load")
 map_file = os.path.join(output_folder, "gene_cgi_map.csv")
 if not os.path.exists(map_file):
     raise FileNotFoundError("The gene_cgi_map.csv file is missing from the 'output/' folder.")
@@ -38,7 +43,7 @@ gene_map_df.columns = gene_map_df.columns.str.strip()
 gene_map_df["cgi_id"] = gene_map_df["cgi_id"].astype(str).str.strip()
 cgi_to_gene = dict(zip(gene_map_df["cgi_id"], gene_map_df["gene_name"]))
 
-methylation_dfs = {}
+methylation_files = {}
 patient_ids = []
 os.makedirs(args.outdir, exist_ok=True)
 
@@ -48,53 +53,23 @@ if "patient" in args.patients.lower():
     patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
 
 # Read methylation matrix
-df = pd.read_excel(args.methylation)
-methylation_dfs[os.path.basename(args.methylation)] = df
-
-# Metadata helpers
-def get_patient(sample):
-    for pid in patient_ids:
-        if pid in sample:
-            return pid
-    return None
-
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
-# Track plot filenames
-top10dmplot_filenames = []
+methylation_files[os.path.basename(args.methylation)] = args.methylation
+
+# Plots and tables are rendered in memory and written straight into the zip
+zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
+archive = FigureArchive(zip_filename)
 
 # Process each file
-for fname, df in methylation_dfs.items():
+for fname, path in methylation_files.items():
     print(f"\n=== Processing file: {fname} ===")
     base_fname = os.path.splitext(fname)[0]
 
-    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-    cpg_island_df = df.iloc[start_idx:].reset_index(drop=True)
-    cpg_island_df.rename(columns={cpg_island_df.columns[0]: "CpG_Island"}, inplace=True)
-    cpg_island_df["CpG_Island"] = cpg_island_df["CpG_Island"].astype(str).str.strip()
-    cpg_island_df.dropna(how="all", subset=cpg_island_df.columns[1:], inplace=True)
-
-    samples = cpg_island_df.columns[1:]
-    sample_meta = pd.DataFrame({
-        "Sample": samples,
-        "Patient": [get_patient(s) for s in samples],
-        "Timepoint": [normalize_timepoint(s) for s in samples]
-    })
-    valid_samples = sample_meta.dropna()
-    valid_samples = valid_samples[valid_samples["Timepoint"] != "Healthy"]
-
-    matrix = cpg_island_df.set_index("CpG_Island")[valid_samples["Sample"].tolist()]
-    matrix.columns = pd.MultiIndex.from_frame(valid_samples[["Patient", "Timepoint"]])
-    matrix = matrix.apply(pd.to_numeric, errors='coerce')
-    collapsed = matrix.T.groupby(level=[0, 1]).mean().T
+    # Locus-level matrix and replicate-collapsed matrix (parsed once, then loaded from the dataset cache)
+    metrics.begin("load", file=fname)
+    dataset = load_analysis_dataset(path, patient_ids)
+    cgi_labels = dataset.cgi_matrix.index.astype(str).str.strip()
+    matrix = dataset.matrix.set_axis(cgi_labels, axis=0)
+    collapsed = dataset.collapsed.set_axis(cgi_labels, axis=0)
 
     def calculate_deltas(collapsed, timepoint1, timepoint2):
         changes = []
@@ -108,20 +83,18 @@ for fname, df in methylation_dfs.items():
                         deltas.append(t2 - t1)
             if len(deltas) >= 2:
                 changes.append((cpg, np.mean(deltas), len(deltas)))
-        return pd.DataFrame(changes, columns=["CpG_Island", "Avg_Delta", "n"]).sort_values("Avg_Delta")
+        return pd.DataFrame(changes, columns=["CpG_Island", "Avg_Delta", "n"])
 
     def plot_top10_diff_cgi_subregions(df, title, filename):
         fig, ax = plt.subplots(figsize=(10, 6))
-        sns.barplot(data=df.head(10), x="Avg_Delta", y="CpG_Island", color='darkblue', ax=ax)
+        sns.barplot(data=topk_rows(df, "Avg_Delta", 10, largest=False), x="Avg_Delta", y="CpG_Island", color='darkblue', ax=ax)
         ax.set_xlabel("Avg Change in Scaled Methylated Fragment Count Ratio")
         ax.axvline(0, color="gray", linestyle="--")
         ax.set_title("")
         fig.text(0.17, 0.98, title, ha='left', va='top', fontsize=12)
         fig.tight_layout(rect=[0, 0, 1, 0.96])
-        plot_path = os.path.join(args.outdir, filename)
-        fig.savefig(plot_path)
+        archive.savefig(fig, filename)
         plt.close(fig)
-        top10dmplot_filenames.append(plot_path)
 
     def plot_multi_cpg_genes(df, title, filename):
         df["CpG_Island"] = df["CpG_Island"].astype(str).str.strip()
@@ -144,7 +117,7 @@ for fname, df in methylation_dfs.items():
             used_fallback = True
             print("⚠️ No genes with >1 CpG island — plotting top 10 by absolute Avg_Delta.")
             gene_df["abs_delta"] = gene_df["avg_delta"].abs()
-            multi_cpg_genes = gene_df.sort_values("abs_delta", ascending=False).head(10)
+            multi_cpg_genes = topk_rows(gene_df, "abs_delta", 10)
 
         # Set fallback-specific title
         if used_fallback:
@@ -159,10 +132,8 @@ for fname, df in methylation_dfs.items():
         plt.axvline(0, color="gray", linestyle="--")
         plt.title(title, loc='center')
         plt.tight_layout()
-        plot_path = os.path.join(args.outdir, filename)
-        plt.savefig(plot_path)
+        archive.savefig(plt.gcf(), filename)
         plt.close()
-        top10dmplot_filenames.append(plot_path)
 
     comparisons = [
         ("Baseline", "Post-Treatment", "baseline_post"),
@@ -171,7 +142,9 @@ for fname, df in methylation_dfs.items():
     ]
 
     for t1, t2, suffix in comparisons:
+        metrics.begin("stats", comparison=suffix)
         top_df = calculate_deltas(collapsed, t1, t2)
+        metrics.begin("render", comparison=suffix)
         plot_top10_diff_cgi_subregions(
             top_df,
             f"Top 10 Differentially Methylated Subregions of CpG Islands ({t1} vs {t2})",
@@ -183,14 +156,8 @@ for fname, df in methylation_dfs.items():
             f"multi_CpG_genes_{suffix}.png"
         )
 
-# Zip output
-zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
-with zipfile.ZipFile(zip_filename, 'w') as zipf:
-    for plot_filename in top10dmplot_filenames:
-        zipf.write(plot_filename, arcname=os.path.basename(plot_filename))
-
-# Clean up
-for plot_filename in top10dmplot_filenames:
-    os.remove(plot_filename)
+# Finish the zip file
+metrics.begin("archive")
+archive.close()
 
 print(f'\n✅ Saved plots and zipped them in {zip_filename}')
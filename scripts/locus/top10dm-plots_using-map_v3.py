@@ -2,10 +2,14 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import glob
-import zipfile
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.topk import topk_rows
+from methpipe.dataset import load_analysis_dataset
+from methpipe.archive import FigureArchive
 
 class Args:
     patients = ""
@@ -31,6 +35,7 @@ else:
     raise FileNotFoundError("No matrix file found in the output folder.")
 
 # Load CpG → Gene mapping
+metrics.begin("load")
 map_file = os.path.join(output_folder, "gene_cgi_map.csv")
 if not os.path.exists(map_file):
     raise FileNotFoundError("The gene_cgi_map.csv file is missing from the 'output/' folder.")
@@ -39,7 +44,7 @@ gene_map_df.columns = gene_map_df.columns.str.strip()
 gene_map_df["cgi_id"] = gene_map_df["cgi_id"].astype(str).str.strip()
 cgi_to_gene = dict(zip(gene_map_df["cgi_id"], gene_map_df["gene_name"]))
 
-methylation_dfs = {}
+methylation_files = {}
 patient_ids = []
 os.makedirs(args.outdir, exist_ok=True)
 
@@ -49,69 +54,39 @@ if "patient" in args.patients.lower():
     patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
 
 # Read methylation matrix
-df = pd.read_excel(args.methylation)
-methylation_dfs[os.path.basename(args.methylation)] = df
-
-# Metadata helpers
-def get_patient(sample):
-    for pid in patient_ids:
-        if pid in sample:
-            return pid
-    return None
-
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
-# Track plot filenames
-top10dmplot_filenames = []
+methylation_files[os.path.basename(args.methylation)] = args.methylation
+
+# Plots and tables are rendered in memory and written straight into the zip
+zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
+archive = FigureArchive(zip_filename)
 
 # Process each file
-for fname, df in methylation_dfs.items():
+for fname, path in methylation_files.items():
     print(f"\n=== Processing file: {fname} ===")
     base_fname = os.path.splitext(fname)[0]
 
-    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-    cpg_island_df = df.iloc[start_idx:].reset_index(drop=True)
-    cpg_island_df.rename(columns={cpg_island_df.columns[0]: "CpG_Island"}, inplace=True)
-    cpg_island_df["CpG_Island"] = cpg_island_df["CpG_Island"].astype(str).str.strip()
-    cpg_island_df.dropna(how="all", subset=cpg_island_df.columns[1:], inplace=True)
+    # Locus-level matrix and replicate-collapsed matrix (parsed once, then loaded from the dataset cache)
+    metrics.begin("load", file=fname)
+    dataset = load_analysis_dataset(path, patient_ids)
+    cgi_labels = dataset.cgi_matrix.index.astype(str).str.strip()
 
     # Save cpg_island_df as CSV
-    cpg_island_csv = os.path.join(args.outdir, f"{base_fname}_cpg_island_df.csv")
-    cpg_island_df.to_csv(cpg_island_csv, index=False)
-    top10dmplot_filenames.append(cpg_island_csv)
-
-    samples = cpg_island_df.columns[1:]
-    sample_meta = pd.DataFrame({
-        "Sample": samples,
-        "Patient": [get_patient(s) for s in samples],
-        "Timepoint": [normalize_timepoint(s) for s in samples]
-    })
-    valid_samples = sample_meta.dropna()
-    valid_samples = valid_samples[valid_samples["Timepoint"] != "Healthy"]
-
-    matrix = cpg_island_df.set_index("CpG_Island")[valid_samples["Sample"].tolist()]
-    matrix.columns = pd.MultiIndex.from_frame(valid_samples[["Patient", "Timepoint"]])
-    matrix = matrix.apply(pd.to_numeric, errors='coerce')
+    metrics.begin("archive")
+    cpg_island_df = dataset.cgi_matrix.set_axis(cgi_labels, axis=0).rename_axis("CpG_Island").reset_index()
+    cpg_island_csv = f"{base_fname}_cpg_island_df.csv"
+    archive.write_csv(cpg_island_df, cpg_island_csv, index=False)
+
+    matrix = dataset.matrix.set_axis(cgi_labels, axis=0)
 
     # Save matrix as CSV
-    matrix_csv = os.path.join(args.outdir, f"{base_fname}_matrix.csv")
-    matrix.to_csv(matrix_csv)
-    top10dmplot_filenames.append(matrix_csv)
+    matrix_csv = f"{base_fname}_matrix.csv"
+    archive.write_csv(matrix, matrix_csv)
 
-    collapsed = matrix.T.groupby(level=[0, 1]).mean().T
+    collapsed = dataset.collapsed.set_axis(cgi_labels, axis=0)
 
     # Save collapsed as CSV
-    collapsed_csv = os.path.join(args.outdir, f"{base_fname}_collapsed.csv")
-    collapsed.to_csv(collapsed_csv)
-    top10dmplot_filenames.append(collapsed_csv)
+    collapsed_csv = f"{base_fname}_collapsed.csv"
+    archive.write_csv(collapsed, collapsed_csv)
 
     def calculate_deltas(collapsed, timepoint1, timepoint2):
         changes = []
@@ -135,10 +110,8 @@ for fname, df in methylation_dfs.items():
         ax.set_title("")
         fig.text(0.17, 0.98, title, ha='left', va='top', fontsize=12)
         fig.tight_layout(rect=[0, 0, 1, 0.96])
-        plot_path = os.path.join(args.outdir, filename)
-        fig.savefig(plot_path)
+        archive.savefig(fig, filename)
         plt.close(fig)
-        top10dmplot_filenames.append(plot_path)
 
     def plot_multi_cpg_genes(df, title, filename):
         df["CpG_Island"] = df["CpG_Island"].astype(str).str.strip()
@@ -155,19 +128,17 @@ for fname, df in methylation_dfs.items():
         ).reset_index()
 
         # Save gene_df as CSV
-        gene_df_csv = os.path.join(args.outdir, f"{title.replace(' ', '_')}_gene_df.csv")
-        gene_df.to_csv(gene_df_csv, index=False)
-        top10dmplot_filenames.append(gene_df_csv)
+        gene_df_csv = f"{title.replace(' ', '_')}_gene_df.csv"
+        archive.write_csv(gene_df, gene_df_csv, index=False)
 
         multi_cpg_genes = gene_df[gene_df["count"] > 1].sort_values("avg_delta")
         if multi_cpg_genes.empty:
             gene_df["abs_delta"] = gene_df["avg_delta"].abs()
-            multi_cpg_genes = gene_df.sort_values("abs_delta", ascending=False).head(10)
+            multi_cpg_genes = topk_rows(gene_df, "abs_delta", 10)
 
         # Save multi_cpg_genes as CSV
-        multi_cpg_genes_csv = os.path.join(args.outdir, f"{title.replace(' ', '_')}_multi_cpg_genes.csv")
-        multi_cpg_genes.to_csv(multi_cpg_genes_csv, index=False)
-        top10dmplot_filenames.append(multi_cpg_genes_csv)
+        multi_cpg_genes_csv = f"{title.replace(' ', '_')}_multi_cpg_genes.csv"
+        archive.write_csv(multi_cpg_genes, multi_cpg_genes_csv, index=False)
 
         plt.figure(figsize=(10, 6))
         sns.barplot(data=multi_cpg_genes, x="avg_delta", y="Gene", color='darkblue')
@@ -175,10 +146,8 @@ for fname, df in methylation_dfs.items():
         plt.axvline(0, color="gray", linestyle="--")
         plt.title(title, loc='center')
         plt.tight_layout()
-        plot_path = os.path.join(args.outdir, filename)
-        plt.savefig(plot_path)
+        archive.savefig(plt.gcf(), filename)
         plt.close()
-        top10dmplot_filenames.append(plot_path)
 
     comparisons = [
         ("Baseline", "Post-Treatment", "baseline_post"),
@@ -187,13 +156,14 @@ for fname, df in methylation_dfs.items():
     ]
 
     for t1, t2, suffix in comparisons:
+        metrics.begin("stats", comparison=suffix)
         top_df = calculate_deltas(collapsed, t1, t2)
 
         # Save deltas as CSV
-        deltas_csv = os.path.join(args.outdir, f"{base_fname}_deltas_{suffix}.csv")
-        top_df.to_csv(deltas_csv, index=False)
-        top10dmplot_filenames.append(deltas_csv)
+        deltas_csv = f"{base_fname}_deltas_{suffix}.csv"
+        archive.write_csv(top_df, deltas_csv, index=False)
 
+        metrics.begin("render", comparison=suffix)
         plot_top10_diff_cgi_subregions(
             top_df,
             f"Top 10 Differentially Methylated Subregions of CpG Islands ({t1} vs {t2})",
@@ -205,14 +175,8 @@ for fname, df in methylation_dfs.items():
             f"multi_CpG_genes_{suffix}.png"
         )
 
-# Zip output
-zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
-with zipfile.ZipFile(zip_filename, 'w') as zipf:
-    for plot_filename in top10dmplot_filenames:
-        zipf.write(plot_filename, arcname=os.path.basename(plot_filename))
-
-# Clean up
-for plot_filename in top10dmplot_filenames:
-    os.remove(plot_filename)
+# Finish the zip file
+metrics.begin("archive")
+archive.close()
 
 print(f'\n✅ Saved plots and zipped them in {zip_filename}')
@@ -2,10 +2,21 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import glob
-import zipfile
+import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.topk import topk_rows
+from methpipe.chromosomes import chromosome_codes, shard_cgi_deltas
+from methpipe.shards import chromosome_shards, default_workers, map_shards, shard_pool
+from methpipe.dataset import load_analysis_dataset
+from methpipe.archive import FigureArchive
+
+parser = argparse.ArgumentParser(description="Plot the top 10 differentially methylated CGIs and genes.")
+parser.add_argument("--workers", type=int, default=default_workers(), help="Worker processes for the deltas; the CGI rows are split by chromosome and shared with the workers (default: $METHPIPE_WORKERS or 1)")
+cli_args = parser.parse_args()
 
 class Args:
     patients = ""
@@ -31,6 +42,7 @@ else:
     raise FileNotFoundError("No matrix file found in the output folder.")
 
 # Load CpG → Gene mapping
+metrics.begin("load")
 map_file = os.path.join(output_folder, "gene_cgi_map.csv")
 if not os.path.exists(map_file):
     raise FileNotFoundError("The gene_cgi_map.csv file is missing from the 'output/' folder.")
@@ -39,7 +51,7 @@ gene_map_df.columns = gene_map_df.columns.str.strip()
 gene_map_df["cgi_id"] = gene_map_df["cgi_id"].astype(str).str.strip()
 cgi_to_gene = dict(zip(gene_map_df["cgi_id"], gene_map_df["gene_name"]))
 
-methylation_dfs = {}
+methylation_files = {}
 patient_ids = []
 os.makedirs(args.outdir, exist_ok=True)
 
@@ -49,87 +61,73 @@ if "patient" in args.patients.lower():
     patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
 
 # Read methylation matrix
-df = pd.read_excel(args.methylation)
-methylation_dfs[os.path.basename(args.methylation)] = df
-
-# Metadata helpers
-def get_patient(sample):
-    for pid in patient_ids:
-        if pid in sample:
-            return pid
-    return None
-
-def normalize_timepoint(sample):
-    if "Baseline" in sample:
-        return "Baseline"
-    elif "Off-tx" in sample:
-        return "Post-Treatment"
-    elif "INNOV" in sample:
-        return "Healthy"
-    else:
-        return "On-Treatment"
-
-# Track plot filenames
-top10dmplot_filenames = []
+methylation_files[os.path.basename(args.methylation)] = args.methylation
+
+# Plots and tables are rendered in memory and written straight into the zip
+zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
+archive = FigureArchive(zip_filename)
 
 # Process each file
-for fname, df in methylation_dfs.items():
+for fname, path in methylation_files.items():
     print(f"\n=== Processing file: {fname} ===")
     base_fname = os.path.splitext(fname)[0]
 
-    start_idx = df[df.iloc[:, 0].astype(str).str.contains("CGI_chr", na=False)].index[0]
-    cpg_island_df = df.iloc[start_idx:].reset_index(drop=True)
-    cpg_island_df.rename(columns={cpg_island_df.columns[0]: "CpG_Island"}, inplace=True)
-    cpg_island_df["CpG_Island"] = cpg_island_df["CpG_Island"].astype(str).str.strip()
-    cpg_island_df.dropna(how="all", subset=cpg_island_df.columns[1:], inplace=True)
+    # Locus-level matrix and replicate-collapsed matrix (parsed once, then loaded from the dataset cache)
+    metrics.begin("load", file=fname)
+    dataset = load_analysis_dataset(path, patient_ids)
+    cgi_labels = dataset.cgi_matrix.index.astype(str).str.strip()
 
     # Save cpg_island_df as CSV
-    cpg_island_csv = os.path.join(args.outdir, f"{base_fname}_cpg_island_df.csv")
-    cpg_island_df.to_csv(cpg_island_csv, index=False)
-    top10dmplot_filenames.append(cpg_island_csv)
-
-    samples = cpg_island_df.columns[1:]
-    sample_meta = pd.DataFrame({
-        "Sample": samples,
-        "Patient": [get_patient(s) for s in samples],
-        "Timepoint": [normalize_timepoint(s) for s in samples]
-    })
-    valid_samples = sample_meta.dropna()
-    valid_samples = valid_samples[valid_samples["Timepoint"] != "Healthy"]
-
-    matrix = cpg_island_df.set_index("CpG_Island")[valid_samples["Sample"].tolist()]
-    matrix.columns = pd.MultiIndex.from_frame(valid_samples[["Patient", "Timepoint"]])
-    matrix = matrix.apply(pd.to_numeric, errors='coerce')
+    metrics.begin("archive")
+    cpg_island_df = dataset.cgi_matrix.set_axis(cgi_labels, axis=0).rename_axis("CpG_Island").reset_index()
+    cpg_island_csv = f"{base_fname}_cpg_island_df.csv"
+    archive.write_csv(cpg_island_df, cpg_island_csv, index=False)
+
+    matrix = dataset.matrix.set_axis(cgi_labels, axis=0)
 
     # Save matrix as CSV
-    matrix_csv = os.path.join(args.outdir, f"{base_fname}_matrix.csv")
-    matrix.to_csv(matrix_csv)
-    top10dmplot_filenames.append(matrix_csv)
+    matrix_csv = f"{base_fname}_matrix.csv"
+    archive.write_csv(matrix, matrix_csv)
 
-    collapsed = matrix.T.groupby(level=[0, 1]).mean().T
+    collapsed = dataset.collapsed.set_axis(cgi_labels, axis=0)
 
     # Save collapsed as CSV
-    collapsed_csv = os.path.join(args.outdir, f"{base_fname}_collapsed.csv")
-    collapsed.to_csv(collapsed_csv)
-    top10dmplot_filenames.append(collapsed_csv)
-
-    def calculate_deltas(collapsed, timepoint1, timepoint2):
-        changes = []
-        for cpg in collapsed.index:
-            deltas = []
-            for patient in collapsed.columns.levels[0]:
-                if (patient, timepoint1) in collapsed.columns and (patient, timepoint2) in collapsed.columns:
-                    t1 = collapsed.loc[cpg, (patient, timepoint1)]
-                    t2 = collapsed.loc[cpg, (patient, timepoint2)]
-                    if not pd.isna(t1) and not pd.isna(t2):
-                        deltas.append(t2 - t1)
-            if len(deltas) >= 2:
-                changes.append((cpg, np.mean(deltas), len(deltas)))
-        return pd.DataFrame(changes, columns=["CpG_Island", "Avg_Delta", "n"]).sort_values("Avg_Delta")
+    collapsed_csv = f"{base_fname}_collapsed.csv"
+    archive.write_csv(collapsed, collapsed_csv)
+
+    def calculate_deltas(collapsed, comparisons):
+        # Mean change per CGI over the patients that have both timepoints (at least 2), for every
+        # comparison; one task per chromosome, with the collapsed matrix shared with the workers
+        position = {label: i for i, label in enumerate(collapsed.columns)}
+        pairs = []
+        for timepoint1, timepoint2, _ in comparisons:
+            patients = [p for p in collapsed.columns.levels[0] if (p, timepoint1) in position and (p, timepoint2) in position]
+            pairs.append((np.array([position[(p, timepoint1)] for p in patients], dtype=np.intp),
+                          np.array([position[(p, timepoint2)] for p in patients], dtype=np.intp)))
+
+        means = [np.full(len(collapsed), np.nan) for _ in comparisons]
+        counts = [np.zeros(len(collapsed), dtype=np.int64) for _ in comparisons]
+        workers = cli_args.workers
+        with chromosome_shards({"values": collapsed.to_numpy()}, chromosome_codes(collapsed.index), shared=workers > 1) as shards:
+            tasks = [(chrom, pairs) for chrom in shards.rows]
+            pool = shard_pool(min(workers, len(tasks)))
+            for (chrom, _), results in zip(tasks, map_shards(shard_cgi_deltas, shards, tasks, pool)):
+                rows = shards.order[shards.rows[chrom]]
+                for i, (mean, n) in enumerate(results):
+                    means[i][rows] = mean
+                    counts[i][rows] = n
+            if pool:
+                pool.shutdown()
+
+        frames = []
+        for mean, n in zip(means, counts):
+            keep = ~np.isnan(mean)
+            frames.append(pd.DataFrame({"CpG_Island": collapsed.index[keep], "Avg_Delta": mean[keep], "n": n[keep]}).sort_values("Avg_Delta"))
+        return frames
 
     def plot_top10_diff_cgi_subregions(df, title, filename):
         df["abs_delta"] = df["Avg_Delta"].abs()
-        top10 = df.sort_values("abs_delta", ascending=False).head(10)
+        top10 = topk_rows(df, "abs_delta", 10)
 
         fig, ax = plt.subplots(figsize=(10, 6))
         sns.barplot(data=top10, x="Avg_Delta", y="CpG_Island", color='darkblue', ax=ax)
@@ -138,10 +136,8 @@ for fname, df in methylation_dfs.items():
         ax.set_title("")
         fig.text(0.17, 0.98, title, ha='left', va='top', fontsize=12)
         fig.tight_layout(rect=[0, 0, 1, 0.96])
-        plot_path = os.path.join(args.outdir, filename)
-        fig.savefig(plot_path)
+        archive.savefig(fig, filename)
         plt.close(fig)
-        top10dmplot_filenames.append(plot_path)
 
     def plot_multi_cpg_genes(df, title, filename):
         df["CpG_Island"] = df["CpG_Island"].astype(str).str.strip()
@@ -155,18 +151,16 @@ for fname, df in methylation_dfs.items():
             avg_delta=("Avg_Delta", "mean")
         ).reset_index()
 
-        gene_df_csv = os.path.join(args.outdir, f"{title.replace(' ', '_')}_gene_df.csv")
-        gene_df.to_csv(gene_df_csv, index=False)
-        top10dmplot_filenames.append(gene_df_csv)
+        gene_df_csv = f"{title.replace(' ', '_')}_gene_df.csv"
+        archive.write_csv(gene_df, gene_df_csv, index=False)
 
         multi_cpg_genes = gene_df[gene_df["count"] > 1].sort_values("avg_delta")
         if multi_cpg_genes.empty:
             gene_df["abs_delta"] = gene_df["avg_delta"].abs()
-            multi_cpg_genes = gene_df.sort_values("abs_delta", ascending=False).head(10)
+            multi_cpg_genes = topk_rows(gene_df, "abs_delta", 10)
 
-        multi_cpg_genes_csv = os.path.join(args.outdir, f"{title.replace(' ', '_')}_multi_cpg_genes.csv")
-        multi_cpg_genes.to_csv(multi_cpg_genes_csv, index=False)
-        top10dmplot_filenames.append(multi_cpg_genes_csv)
+        multi_cpg_genes_csv = f"{title.replace(' ', '_')}_multi_cpg_genes.csv"
+        archive.write_csv(multi_cpg_genes, multi_cpg_genes_csv, index=False)
 
         plt.figure(figsize=(10, 6))
         sns.barplot(data=multi_cpg_genes, x="avg_delta", y="Gene", color='darkblue')
@@ -174,10 +168,8 @@ for fname, df in methylation_dfs.items():
         plt.axvline(0, color="gray", linestyle="--")
         plt.title(title, loc='center')
         plt.tight_layout()
-        plot_path = os.path.join(args.outdir, filename)
-        plt.savefig(plot_path)
+        archive.savefig(plt.gcf(), filename)
         plt.close()
-        top10dmplot_filenames.append(plot_path)
 
     comparisons = [
         ("Baseline", "Post-Treatment", "baseline_post"),
@@ -185,13 +177,15 @@ for fname, df in methylation_dfs.items():
         ("On-Treatment", "Post-Treatment", "on_post"),
     ]
 
-    for t1, t2, suffix in comparisons:
-        top_df = calculate_deltas(collapsed, t1, t2)
+    metrics.begin("stats")
+    delta_frames = calculate_deltas(collapsed, comparisons)
 
-        deltas_csv = os.path.join(args.outdir, f"{base_fname}_deltas_{suffix}.csv")
-        top_df.to_csv(deltas_csv, index=False)
-        top10dmplot_filenames.append(deltas_csv)
+    for (t1, t2, suffix), top_df in zip(comparisons, delta_frames):
+        metrics.begin("archive", comparison=suffix)
+        deltas_csv = f"{base_fname}_deltas_{suffix}.csv"
+        archive.write_csv(top_df, deltas_csv, index=False)
 
+        metrics.begin("render", comparison=suffix)
         plot_top10_diff_cgi_subregions(
             top_df,
             f"Top 10 Differentially Methylated Subregions of CpG Islands ({t1} vs {t2})",
@@ -203,14 +197,8 @@ for fname, df in methylation_dfs.items():
             f"multi_CpG_genes_{suffix}.png"
         )
 
-# Zip output
-zip_filename = os.path.join(args.outdir, 'top-10-differential-methylation-plots.zip')
-with zipfile.ZipFile(zip_filename, 'w') as zipf:
-    for plot_filename in top10dmplot_filenames:
-        zipf.write(plot_filename, arcname=os.path.basename(plot_filename))
-
-# Clean up
-for plot_filename in top10dmplot_filenames:
-    os.remove(plot_filename)
+# Finish the zip file
+metrics.begin("archive")
+archive.close()
 
 print(f'\n✅ Saved plots and zipped them in {zip_filename}')
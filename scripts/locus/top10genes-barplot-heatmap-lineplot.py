@@ -2,14 +2,18 @@ import os
 import glob
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import argparse
-from tqdm import tqdm
 import zipfile
 import re
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
+from methpipe.geneindex import gene_index
+from methpipe.progress import progress
+from methpipe.topk import topk_series
+from methpipe.archive import figure_bytes
+from methpipe.figcache import FigureCache, script_salt
 
 # === Argument Parser ===
 parser = argparse.ArgumentParser(description='Generate gene-level methylation barplots, heatmaps, and line plots based on delta values.')
@@ -46,6 +50,7 @@ def sort_timepoints(tp):
     return 98
 
 # === Load Data ===
+metrics.begin("load")
 output_folder = 'output'
 data_folder = 'data'
 cpg_matrix_file = find_file(output_folder, "merged_output_glob20")
@@ -56,30 +61,19 @@ cpg_matrix = pd.read_excel(cpg_matrix_file, index_col=0) if cpg_matrix_file.ends
 patient_df = pd.read_excel(patient_list_file)
 gene_annot_raw = pd.read_excel(gene_annotation_file) if gene_annotation_file.endswith('.xlsx') else pd.read_csv(gene_annotation_file)
 
-gene_annot = gene_annot_raw[gene_annot_raw['gene_name'].notna()].copy()
-gene_annot['gene_name'] = gene_annot['gene_name'].astype(str)
-cpg_headers = cpg_matrix.index.astype(str).tolist()
-
-matched = []
-for _, row in tqdm(gene_annot.iterrows(), total=gene_annot.shape[0], desc="Matching CpGs"):
-    gene = row['gene_name']
-    matched_cpgs = [h for h in cpg_headers if gene in h]
-    for cpg in matched_cpgs:
-        matched.append({'cgi_id': cpg, 'gene_name': gene})
-
-gene_annot = pd.DataFrame(matched)
-cpg_gene_counts = gene_annot['gene_name'].value_counts()
+metrics.begin("match")
+# CGI rows of every gene, from the gene index saved next to the matrix (built by the first run)
+index = gene_index(cpg_matrix.index, gene_annot_raw['gene_name'], cpg_matrix_file)
+cpg_gene_counts = index.match_counts()
 all_genes = cpg_gene_counts.index.tolist()
 
 patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
 
 # === Generate Gene Methylation Matrix (Raw Fragment Counts) ===
+metrics.begin("aggregate")
 gene_rows = []
-for gene in tqdm(all_genes, desc="Building gene methylation matrix"):
-    cpgs = gene_annot[gene_annot['gene_name'] == gene]['cgi_id']
-    gene_data = cpg_matrix.loc[cpg_matrix.index.intersection(cpgs)]
-    if gene_data.empty:
-        continue
+for gene in progress(all_genes, desc="Building gene methylation matrix"):
+    gene_data = cpg_matrix.iloc[index.rows(gene)]
     summed_row = gene_data.sum(axis=0)
     summed_row.name = gene
     gene_rows.append(summed_row)
@@ -91,8 +85,9 @@ gene_methylation_matrix.to_csv(os.path.join(args.output_dir, "gene_methylation_m
 print(f"Gene methylation matrix saved to {os.path.join(args.output_dir, 'gene_methylation_matrix.csv')}")
 
 # === Plot Top Genes Heatmap Across Detailed Timepoints ===
+metrics.begin("render")
 baseline_means = gene_methylation_matrix.filter(like="Baseline").mean(axis=1)
-top_genes = baseline_means.abs().sort_values(ascending=False).head(10).index.tolist()
+top_genes = topk_series(baseline_means.abs(), 10).index.tolist()
 ordered_top_genes = top_genes
 
 heatmap_df = gene_methylation_matrix.loc[ordered_top_genes]
@@ -134,12 +129,24 @@ plt.savefig(os.path.join(lineplot_dir, "multi_gene_avg_lineplot_detailed.png"))
 plt.close()
 
 # Line Plot Per Patient
-for patient_id, subdf in melted.groupby('Patient'):
+def draw_patient_lineplot(patient_id, subdf):
     plt.figure(figsize=(12, 6))
     sns.lineplot(data=subdf, x='Timepoint', y='Methylation', hue='Gene', marker='o')
     plt.title(f"Patient {patient_id} - Methylation per Gene (Detailed Timepoints)")
     plt.tight_layout()
-    plt.savefig(os.path.join(lineplot_dir, f"lineplot_patient_{patient_id}_detailed.png"))
+    png_bytes = figure_bytes(plt.gcf(), "png")
     plt.close()
+    return png_bytes
+
+# Patients whose gene × timepoint slice is unchanged are copied from the figure cache
+figure_cache = FigureCache(salt=script_salt(__file__))
+for patient_id, subdf in melted.groupby('Patient'):
+    figure_cache.fetch_file(
+        figure_cache.key("patient_lineplot", patient_id, subdf),
+        os.path.join(lineplot_dir, f"lineplot_patient_{patient_id}_detailed.png"),
+        lambda: draw_patient_lineplot(patient_id, subdf),
+    )
+figure_cache.save()
+print(figure_cache.summary())
 
 print(f"Line plots saved to {lineplot_dir}")
@@ -3,14 +3,16 @@ import os
 import glob
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import argparse
-from scipy.stats import ttest_rel
-from tqdm import tqdm
-import zipfile
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from methpipe.headless import plt, sns, ttest_rel
+from methpipe import metrics
+from methpipe.geneindex import gene_index
+from methpipe.progress import progress
+from methpipe.topk import topk_series
+from methpipe.archive import FigureArchive, figure_bytes
+from methpipe.figcache import FigureCache, script_salt
 
 # === Argument Parser ===
 parser = argparse.ArgumentParser(description='Generate gene-level methylation barplots and heatmaps based on delta values.')
@@ -39,6 +41,7 @@ def get_patient(sample):
     return next((pid for pid in patient_ids if pid in sample), None)
 
 # === Load Data ===
+metrics.begin("load")
 output_folder = 'output'
 data_folder = 'data'
 cpg_matrix_file = find_file(output_folder, "matrix")
@@ -49,19 +52,10 @@ cpg_matrix = pd.read_excel(cpg_matrix_file, index_col=0) if cpg_matrix_file.ends
 patient_df = pd.read_excel(patient_list_file)
 gene_annot_raw = pd.read_excel(gene_annotation_file) if gene_annotation_file.endswith('.xlsx') else pd.read_csv(gene_annotation_file)
 
-gene_annot = gene_annot_raw[gene_annot_raw['gene_name'].notna()].copy()
-gene_annot['gene_name'] = gene_annot['gene_name'].astype(str)
-cpg_headers = cpg_matrix.index.astype(str).tolist()
-
-matched = []
-for _, row in tqdm(gene_annot.iterrows(), total=gene_annot.shape[0], desc="Matching CpGs"):
-    gene = row['gene_name']
-    matched_cpgs = [h for h in cpg_headers if gene in h]
-    for cpg in matched_cpgs:
-        matched.append({'cgi_id': cpg, 'gene_name': gene})
-
-gene_annot = pd.DataFrame(matched)
-cpg_gene_counts = gene_annot['gene_name'].value_counts()
+metrics.begin("match")
+# CGI rows of every gene, from the gene index saved next to the matrix (built by the first run)
+index = gene_index(cpg_matrix.index, gene_annot_raw['gene_name'], cpg_matrix_file)
+cpg_gene_counts = index.match_counts()
 all_genes = cpg_gene_counts.index.tolist()
 
 patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
@@ -72,11 +66,8 @@ def calculate_deltas(tp1, tp2):
     stats = []
     gene_patient_deltas = {}
 
-    for gene in tqdm(all_genes, desc=f"Calculating deltas for {tp1} vs {tp2}"):
-        cpgs = gene_annot[gene_annot['gene_name'] == gene]['cgi_id']
-        gene_data = cpg_matrix.loc[cpg_matrix.index.intersection(cpgs)]
-        if gene_data.empty:
-            continue
+    for gene in progress(all_genes, desc=f"Calculating deltas for {tp1} vs {tp2}"):
+        gene_data = cpg_matrix.iloc[index.rows(gene)]
         avg_gene_methylation = gene_data.mean(axis=0)
         df = avg_gene_methylation.reset_index()
         df.columns = ['Sample', 'Methylation']
@@ -96,11 +87,13 @@ def calculate_deltas(tp1, tp2):
     return deltas, pd.DataFrame(stats), pd.DataFrame(gene_patient_deltas).T
 
 # === Run Delta Comparisons ===
+metrics.begin("stats")
 baseline_post, stats_bp, bp_patient_deltas = calculate_deltas("Baseline", "Post-Treatment")
 baseline_on, stats_bo, bo_patient_deltas = calculate_deltas("Baseline", "On-Treatment")
 on_post, stats_op, op_patient_deltas = calculate_deltas("On-Treatment", "Post-Treatment")
 
 # === Save Delta and T-Test Results ===
+metrics.begin("archive")
 pd.DataFrame({
     'Baseline → Post-Treatment': pd.Series(baseline_post),
     'Baseline → On-Treatment': pd.Series(baseline_on),
@@ -117,12 +110,10 @@ bo_patient_deltas.to_csv(os.path.join(args.output_dir, "patient_deltas_baseline_
 op_patient_deltas.to_csv(os.path.join(args.output_dir, "patient_deltas_on_to_post.csv"))
 
 # === Generate Gene Methylation Matrix (Raw Fragment Counts) ===
+metrics.begin("aggregate")
 gene_rows = []
-for gene in tqdm(all_genes, desc="Building gene methylation matrix"):
-    cpgs = gene_annot[gene_annot['gene_name'] == gene]['cgi_id']
-    gene_data = cpg_matrix.loc[cpg_matrix.index.intersection(cpgs)]
-    if gene_data.empty:
-        continue
+for gene in progress(all_genes, desc="Building gene methylation matrix"):
+    gene_data = cpg_matrix.iloc[index.rows(gene)]
     summed_row = gene_data.sum(axis=0)
     summed_row.name = gene
     gene_rows.append(summed_row)
@@ -134,7 +125,8 @@ gene_methylation_matrix.to_csv(os.path.join(args.output_dir, "gene_methylation_m
 print(f"Gene methylation matrix saved to {os.path.join(args.output_dir, 'gene_methylation_matrix.csv')}")
 
 # === Plot Barplots and Save Delta Tables for Top 10 Genes ===
-top_genes = pd.Series(baseline_post).abs().sort_values(ascending=False).head(10).index.tolist()
+metrics.begin("render")
+top_genes = topk_series(pd.Series(baseline_post).abs(), 10).index.tolist()
 comparisons = {
     "Baseline → Post-Treatment": (baseline_post, bp_patient_deltas),
     "Baseline → On-Treatment": (baseline_on, bo_patient_deltas),
@@ -198,6 +190,24 @@ sample_metadata = pd.DataFrame({
     'Patient': [get_patient(col) for col in gene_methylation_matrix.columns]
 }).dropna(subset=["Patient"])
 
+def draw_patient_heatmap(patient_data, patient_id):
+    fig, ax = plt.subplots(figsize=(8, 6))
+    sns.heatmap(patient_data, cmap="coolwarm", linewidths=0.5,
+                cbar_kws={"label": "Methylated Fragment Count"}, ax=ax)
+    ax.set_title(f"Gene Methylation for Patient {patient_id}", fontsize=12)
+    ax.set_xlabel("Sample")
+    ax.set_ylabel("Gene")
+    plt.tight_layout()
+    png_bytes = figure_bytes(fig, "png")
+    plt.close()
+    return png_bytes
+
+# Heatmaps are rendered once in memory: the bytes go into the zip and the loose copy.
+# Patients whose heatmap slice is unchanged since the last run are copied from the figure cache.
+zip_path = os.path.join(args.output_dir, "per_patient_heatmaps.zip")
+archive = FigureArchive(zip_path)
+figure_cache = FigureCache(salt=script_salt(__file__))
+
 for patient_id in sample_metadata["Patient"].unique():
     patient_samples = sample_metadata[sample_metadata["Patient"] == patient_id]
     patient_cols = patient_samples["Sample"].tolist()
@@ -217,23 +227,17 @@ for patient_id in sample_metadata["Patient"].unique():
     ]
     patient_data = patient_data.loc[pd.Index(ordered_top_genes).intersection(patient_data.index)]
 
-    fig, ax = plt.subplots(figsize=(8, 6))
-    sns.heatmap(patient_data, cmap="coolwarm", linewidths=0.5,
-                cbar_kws={"label": "Methylated Fragment Count"}, ax=ax)
-    ax.set_title(f"Gene Methylation for Patient {patient_id}", fontsize=12)
-    ax.set_xlabel("Sample")
-    ax.set_ylabel("Gene")
-    plt.tight_layout()
-    fig_path = os.path.join(per_patient_output_dir, f"heatmap_top10_genes_patient_{patient_id}.png")
-    plt.savefig(fig_path)
-    plt.close()
-
-zip_path = os.path.join(args.output_dir, "per_patient_heatmaps.zip")
-with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-    for root, _, files in os.walk(per_patient_output_dir):
-        for file in files:
-            if file.endswith(".png"):
-                zipf.write(os.path.join(root, file), arcname=file)
+    fig_name = f"heatmap_top10_genes_patient_{patient_id}.png"
+    png_bytes = figure_cache.fetch_file(
+        figure_cache.key("patient_heatmap", patient_id, patient_data),
+        os.path.join(per_patient_output_dir, fig_name),
+        lambda: draw_patient_heatmap(patient_data, patient_id),
+    )
+    archive.write(fig_name, png_bytes)
+
+archive.close()
+figure_cache.save()
+print(figure_cache.summary())
 
 print(f"Per-patient heatmaps saved to: {per_patient_output_dir}")
 print(f"All heatmaps zipped at: {zip_path}")
@@ -1,11 +1,14 @@
 # this is a temporary script to create line plots of manually assembled data (Scaled_LOI-in-EMseq-16-18-20_by-Cycle.xlsx)
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from methpipe.headless import plt, sns
+from methpipe import metrics
 
 # Load your data (replace 'your_data.csv' with the actual data file)
 # Make sure the data is structured with rows as patients and columns containing timepoints
+metrics.begin("load")
 data_file = "data/Scaled_LOI-in-EMseq-16-18-20_by-Cycle.xlsx"
 data = pd.read_excel(data_file)
 
@@ -20,6 +23,7 @@ data = pd.read_excel(data_file)
 melted_data = data.melt(id_vars=["Patient ID"], var_name="Timepoint", value_name="Scaled Fragment Count Ratio")
 
 # Create a line plot using seaborn
+metrics.begin("render")
 plt.figure(figsize=(12, 6))
 sns.lineplot(data=melted_data, x="Timepoint", y="Scaled Fragment Count Ratio", hue="Patient ID", marker="o")
 
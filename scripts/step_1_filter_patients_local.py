@@ -1,37 +1,25 @@
 # Step 1: Filter Methylation Files by Patient ID (Local Version)
 
-import pandas as pd
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from methpipe import metrics
+from methpipe.steps import filter_patient_columns, load_raw_runs
 
 # Set input and output directories
 input_dir = "data"
 output_dir = "output"
 os.makedirs(output_dir, exist_ok=True)
 
-# Initialize containers
-methylation_dfs = {}
-patient_ids = []
-
-# Load all Excel files from input_dir
-for fname in os.listdir(input_dir):
-    if fname.endswith(".xlsx") or fname.endswith(".xls"):
-        fpath = os.path.join(input_dir, fname)
-        if "patient" in fname.lower():
-            # Load patient ID file
-            patient_df = pd.read_excel(fpath)
-            patient_ids = patient_df.iloc[:, 0].dropna().astype(str).tolist()
-        else:
-            # Load methylation data file
-            methylation_dfs[fname] = pd.read_excel(fpath)
+# Load the patient ID file and all methylation Excel files from input_dir
+metrics.begin("load")
+methylation_dfs, patient_ids = load_raw_runs(input_dir)
 
 # Filter methylation files by patient IDs
+metrics.begin("filter")
 filtered_methylation_dfs = {}
 for fname, df in methylation_dfs.items():
-    filtered = df[
-        [df.columns[0]] + 
-        [col for col in df.columns[1:] if any(pid in str(col) for pid in patient_ids)]
-    ]
-    filtered_methylation_dfs[fname] = filtered
+    filtered_methylation_dfs[fname] = filter_patient_columns(df, patient_ids)
 
 # Preview filtered output
 for name, df in filtered_methylation_dfs.items():
@@ -39,6 +27,7 @@ for name, df in filtered_methylation_dfs.items():
     print(df.head())
 
 # Save filtered DataFrames to Excel
+metrics.begin("archive")
 for name, df in filtered_methylation_dfs.items():
     output_path = os.path.join(output_dir, f"{name}_samples-of-interest.xlsx")
     df.to_excel(output_path, index=False)
@@ -1,4 +1,9 @@
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from methpipe import metrics
+from methpipe.steps import save_ratio_store
+
 import pandas as pd
 
 # STEP1: Auto-detect input files in the "output" directory
@@ -11,10 +16,12 @@ if not glob20_file or not globmin80_file:
     raise FileNotFoundError("One or both input files ('output_glob20_*.xlsx', 'output_globmin80_*.xlsx') not found in the 'output' directory.")
 
 # STEP2: Load the Excel files
+metrics.begin("load")
 glob20_df = pd.read_excel(glob20_file)
 globmin80_df = pd.read_excel(globmin80_file)
 
 # STEP3: Filter rows independently for each DataFrame
+metrics.begin("filter")
 filter_condition_glob20 = glob20_df.iloc[:, 0].str.contains("CGI_chr") | (glob20_df.iloc[:, 0] == "Total CpG island fragments counts for this particular spreadsheet")
 filtered_glob20 = glob20_df[filter_condition_glob20]
 
@@ -22,6 +29,7 @@ filter_condition_globmin80 = globmin80_df.iloc[:, 0].str.contains("CGI_chr") | (
 filtered_globmin80 = globmin80_df[filter_condition_globmin80]
 
 # STEP4: Align rows by their first column (ensure they have the same labels)
+metrics.begin("align")
 aligned_glob20 = filtered_glob20[filtered_glob20.iloc[:, 0].isin(filtered_globmin80.iloc[:, 0])]
 aligned_globmin80 = filtered_globmin80[filtered_globmin80.iloc[:, 0].isin(filtered_glob20.iloc[:, 0])]
 
@@ -32,6 +40,7 @@ print("Shape of aligned_globmin80:", aligned_globmin80.shape)
 # Ensure the aligned DataFrames have the same shape
 assert aligned_glob20.shape == aligned_globmin80.shape, "Aligned DataFrames do not have the same shape."
 
+metrics.begin("ratio")
 # STEP5: Divide the values in the output_glob20 file by the corresponding values in the output_globmin80 file and multiply by 100000
 ratio_df = (aligned_glob20.iloc[:, 1:].astype(float).reset_index(drop=True) /
             aligned_globmin80.iloc[:, 1:].astype(float).reset_index(drop=True)) * 100000
@@ -55,7 +64,9 @@ summary_rows = pd.concat([total_glob20_row, total_globmin80_row], ignore_index=T
 result_df = pd.concat([summary_rows, result_df], ignore_index=True)
 
 # STEP8: Export results
+metrics.begin("archive")
 output_file = os.path.join(output_dir, "scaled_fragment_ratios_matrix.xlsx")
 result_df.to_excel(output_file, index=False)
+save_ratio_store(output_file)
 
 print(f"Saved output to {output_file}")
@@ -1,4 +1,9 @@
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from methpipe import metrics
+from methpipe.steps import save_ratio_store
+
 import pandas as pd
 from openpyxl import load_workbook
 from openpyxl.styles import PatternFill
@@ -13,16 +18,19 @@ if not glob20_file or not globmin80_file:
     raise FileNotFoundError("One or both input files not found.")
 
 # STEP2: Load Excel files
+metrics.begin("load")
 glob20_df = pd.read_excel(glob20_file)
 globmin80_df = pd.read_excel(globmin80_file)
 
 # STEP3: Filter CGI rows only
+metrics.begin("filter")
 label_col = glob20_df.columns[0]
 cpg_label = "Total CpG island fragments counts for this particular spreadsheet"
 filtered_glob20 = glob20_df[glob20_df[label_col].str.startswith("CGI_")].copy()
 filtered_globmin80 = globmin80_df[globmin80_df[label_col].str.startswith("CGI_")].copy()
 
 # STEP4: Align by row and column labels
+metrics.begin("align")
 filtered_glob20.set_index(label_col, inplace=True)
 filtered_globmin80.set_index(label_col, inplace=True)
 shared_rows = filtered_glob20.index.intersection(filtered_globmin80.index)
@@ -31,11 +39,13 @@ aligned_glob20 = filtered_glob20.loc[shared_rows, shared_columns].sort_index().s
 aligned_globmin80 = filtered_globmin80.loc[shared_rows, shared_columns].sort_index().sort_index(axis=1)
 
 # STEP5: Safe division with INF handling
+metrics.begin("ratio")
 with pd.option_context('mode.use_inf_as_na', True):
     ratio_raw = (aligned_glob20 / aligned_globmin80.replace(0, pd.NA)) * 100000
     ratio_df = ratio_raw.fillna("INF")
 
 # STEP6: Count and log INF values
+metrics.begin("stats")
 inf_mask = ratio_df == "INF"
 inf_count = inf_mask.sum().sum()
 print(f"⚠️ Total 'INF' values (division by zero): {inf_count}")
@@ -65,6 +75,7 @@ if not total_globmin80_row.empty:
 result_df = pd.concat([total_glob20_row, total_globmin80_row, ratio_df], ignore_index=True)
 
 # STEP8: Export Excel with red highlight for INF
+metrics.begin("archive")
 output_file = os.path.join(output_dir, "scaled_fragment_ratios_matrix.xlsx")
 result_df.to_excel(output_file, index=False)
 
@@ -79,4 +90,5 @@ for row in ws.iter_rows(min_row=3, min_col=2, max_col=ws.max_column):
             cell.fill = red_fill
 
 wb.save(output_file)
+save_ratio_store(output_file)
 print(f"✅ Final Excel output saved with red-highlighted INF cells: {output_file}")